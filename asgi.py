@@ -0,0 +1,27 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from src import init_app
+from src.middleware import AsyncWsgiAdapter
+
+uvicorn_logger = logging.getLogger("uvicorn.error")
+if uvicorn_logger.handlers:
+    # Module loggers, e.g. for the inference layout logged while loading the voices
+    logging.getLogger("src").handlers = uvicorn_logger.handlers
+    logging.getLogger("src").setLevel(uvicorn_logger.level)
+
+flask_app = init_app()
+
+# Serve with an ASGI server, e.g. uvicorn asgi:app
+app = AsyncWsgiAdapter(
+    flask_app,
+    ThreadPoolExecutor(
+        max_workers=flask_app.config["ASGI_SYNTHESIS_THREADS"],
+        thread_name_prefix="asgi",
+    ),
+    max_body_bytes=flask_app.config["MAX_CONTENT_LENGTH"],
+)
+
+if uvicorn_logger.handlers:
+    flask_app.logger.handlers = uvicorn_logger.handlers
+    flask_app.logger.setLevel(uvicorn_logger.level)
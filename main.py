@@ -2,6 +2,12 @@ import logging
 
 from src import init_app
 
+if __name__ != "__main__":
+    # Module loggers, e.g. for the inference layout logged while loading the voices
+    gunicorn_logger = logging.getLogger("gunicorn.error")
+    logging.getLogger("src").handlers = gunicorn_logger.handlers
+    logging.getLogger("src").setLevel(gunicorn_logger.level)
+
 app = init_app()
 
 if __name__ == "__main__":
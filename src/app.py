@@ -11,22 +11,91 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import base64
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-
-from flask import Response, current_app, jsonify, render_template, stream_with_context
+from typing import Any, Dict, Iterable, Optional
+
+from flask import (
+    Response,
+    current_app,
+    jsonify,
+    render_template,
+    send_file,
+    stream_with_context,
+    url_for,
+)
 from flask_apispec import FlaskApiSpec, doc, marshal_with, use_kwargs
 from webargs.flaskparser import FlaskParser, abort
+from werkzeug.exceptions import HTTPException
 
-from src import schemas
+from src import ffmpeg, schemas, sndfile
 
 # This requires the Flask app context to be initialized. Should probably be refactored a
 # bit.
-from src.auth.api_key import require_api_key
+from src.auth.api_key import project_priority, require_api_key
 from src.logging_utils import clean_request
 
-from src.voices import OutputFormat, VoiceManager  # noqa:E402 isort:skip
-
-g_synthesizers = VoiceManager.from_pbtxt(Path(current_app.config["SYNTHESIS_SET_PB"]))
+from src.tasks import SynthesisTaskManager  # noqa:E402 isort:skip
+from src.voices import OutputFormat, VoiceBase, VoiceManager  # noqa:E402 isort:skip
+from src.voices.admission import OverloadedError  # noqa:E402 isort:skip
+from src.voices.cache import SegmentCache, SynthesisCache  # noqa:E402 isort:skip
+from src.voices.priority import Priority, PriorityGate  # noqa:E402 isort:skip
+
+g_cache = (
+    SynthesisCache(
+        max_memory_bytes=current_app.config["SYNTHESIS_CACHE_MAX_BYTES"],
+        disk_cache_dir=(
+            Path(current_app.config["SYNTHESIS_CACHE_DIR"])
+            if current_app.config["SYNTHESIS_CACHE_DIR"]
+            else None
+        ),
+        max_disk_bytes=current_app.config["SYNTHESIS_CACHE_DISK_MAX_BYTES"],
+    )
+    if current_app.config["SYNTHESIS_CACHE_MAX_BYTES"] > 0
+    else None
+)
+g_segment_cache = (
+    SegmentCache(max_bytes=current_app.config["SEGMENT_CACHE_MAX_BYTES"])
+    if current_app.config["SEGMENT_CACHE_MAX_BYTES"] > 0
+    else None
+)
+ffmpeg.configure(
+    max_processes=current_app.config["FFMPEG_MAX_PROCESSES"],
+    warm_processes=current_app.config["FFMPEG_WARM_PROCESSES"],
+)
+if current_app.config["AUDIO_ENCODER"] == "soundfile":
+    for fmt in ("ogg_vorbis", "mp3"):
+        if not sndfile.is_supported(fmt):
+            current_app.logger.warning(
+                "AUDIO_ENCODER is soundfile, but libsndfile can't encode %s, "
+                "encoding it with ffmpeg instead",
+                fmt,
+            )
+g_synthesizers = VoiceManager.from_pbtxt(
+    Path(current_app.config["SYNTHESIS_SET_PB"]),
+    cache=g_cache,
+    segment_cache=g_segment_cache,
+    priority_gate=(
+        PriorityGate(
+            max_bulk_delay_ms=current_app.config["SYNTHESIS_BULK_MAX_DELAY_MS"]
+        )
+        if current_app.config["SYNTHESIS_BULK_MAX_DELAY_MS"] > 0
+        else None
+    ),
+)
+g_tasks = (
+    SynthesisTaskManager(
+        Path(current_app.config["SYNTHESIS_TASK_DIR"]),
+        max_workers=current_app.config["SYNTHESIS_TASK_WORKERS"],
+        max_overload_wait_ms=current_app.config[
+            "SYNTHESIS_TASK_MAX_OVERLOAD_WAIT_MS"
+        ],
+    )
+    if current_app.config["SYNTHESIS_TASK_DIR"]
+    else None
+)
 docs = FlaskApiSpec(current_app)
 
 # Use code 400 for invalid requests
@@ -65,6 +134,13 @@ def handle_error(err):
         return jsonify({"message": message}), err.code
 
 
+@current_app.errorhandler(404)
+def handle_not_found(err):
+    """Handle unknown resources."""
+    response_body = jsonify({"message": "Not found."})
+    return response_body, err.code
+
+
 @current_app.errorhandler(405)
 def handle_method_not_allowed(err):
     """Handle authorization errors."""
@@ -72,6 +148,14 @@ def handle_method_not_allowed(err):
     return response_body, err.code
 
 
+@current_app.errorhandler(OverloadedError)
+def handle_overloaded(err: OverloadedError):
+    """Handle requests rejected by a voice's admission control."""
+    current_app.logger.warning("Request rejected: %s", err)
+    response_body = jsonify({"message": "Too many requests, try again later."})
+    return response_body, err.status_code, {"Retry-After": str(err.retry_after)}
+
+
 @current_app.errorhandler(500)
 @current_app.errorhandler(Exception)
 def handle_internal_error(err):
@@ -100,33 +184,66 @@ def handle_internal_error(err):
 )
 @marshal_with({}, code=200, description="Audio or speech marks content")
 @marshal_with(schemas.Error, code=400, description="Bad request")
+@marshal_with(schemas.Error, code=429, description="Voice overloaded, queue full")
 @marshal_with(schemas.Error, code=500, description="Service error")
+@marshal_with(schemas.Error, code=503, description="Voice overloaded, timed out")
 @require_api_key
 def route_synthesize_speech(**kwargs):
     current_app.logger.info("Got request: %s", clean_request(kwargs))
 
+    kwargs["Priority"] = _request_priority(kwargs, project_priority())
+    voice = _validate_synthesis_request(kwargs)
+    text = kwargs["Text"]
+
+    output_content_type = OutputFormat(
+        "json" if kwargs.get("IncludeSpeechMarks") else kwargs["OutputFormat"],
+        [kwargs["SampleRate"]],
+    ).content_type
+
+    # If TextType is not supplied, we assume by default that we should synthesize normal text.
+    synthesize_ssml: bool = (
+        kwargs.get("TextType") != None and kwargs.get("TextType") == "ssml"
+    )
+    try:
+        return Response(
+            stream_with_context(
+                voice.synthesize(
+                    text=text,
+                    ssml=synthesize_ssml,
+                    **kwargs,
+                )
+            ),
+            content_type=output_content_type,
+        )
+    except (NotImplementedError, ValueError) as ex:
+        current_app.logger.warning("Synthesis failed: %s", ex)
+        abort(400)
+
+
+def _validate_synthesis_request(kwargs: Dict[str, Any]) -> VoiceBase:
+    """Validate a synthesis request and fill in defaults, returning its voice."""
     if "Engine" not in kwargs:
         kwargs["Engine"] = "standard"
 
-    output_content_type = "application/x-json-stream"
     voice_id = kwargs["VoiceId"]
-    text = kwargs["Text"]
     kwargs["SampleRate"] = kwargs.get("SampleRate", "16000")
 
     # TODO(rkjaran): error out with a nicer message
     if kwargs["OutputFormat"] == "json" and kwargs.get("SpeechMarkTypes") != ["word"]:
         abort(400)
 
+    if kwargs.get("IncludeSpeechMarks") and (
+        kwargs["OutputFormat"] == "json"
+        or kwargs.get("SpeechMarkTypes", ["word"]) != ["word"]
+    ):
+        abort(400)
+
     if (kwargs["OutputFormat"], kwargs["SampleRate"]) not in g_synthesizers[
         voice_id
     ].properties.supported_output_formats:
         current_app.logger.info("Client requested unsupported output format")
         abort(400)
 
-    output_content_type = OutputFormat(
-        kwargs["OutputFormat"], [kwargs["SampleRate"]]
-    ).content_type
-
     voice = g_synthesizers[voice_id]
     if (
         "LanguageCode" in kwargs
@@ -134,28 +251,214 @@ def route_synthesize_speech(**kwargs):
     ):
 
         abort(400)
+    return voice
 
-    # If TextType is not supplied, we assume by default that we should synthesize normal text.
-    synthesize_ssml: bool = (
-        kwargs.get("TextType") != None and kwargs.get("TextType") == "ssml"
+
+def _request_priority(
+    kwargs: Dict[str, Any], project: Optional[str] = None
+) -> Priority:
+    """Get the priority of a request, a bulk priority project makes it bulk."""
+    if project == "bulk":
+        return "bulk"
+    return kwargs.get("Priority", "interactive")
+
+
+docs.register(route_synthesize_speech)
+
+
+@current_app.route("/v0/speech:batch", methods=["POST"])
+@use_kwargs(schemas.SynthesizeSpeechBatchRequest)
+@doc(
+    description=(
+        "Synthesize a batch of requests. A JSON line with the result of each request "
+        + "is streamed back as soon as it's done, so not necessarily in order."
+    ),
+    tags=["speech"],
+    produces=["application/x-json-stream"],
+)
+@marshal_with(
+    schemas.SynthesizeSpeechBatchResult,
+    code=200,
+    description="A JSON line for each request of the batch",
+)
+@marshal_with(schemas.Error, code=400, description="Bad request")
+@marshal_with(schemas.Error, code=500, description="Service error")
+@require_api_key
+def route_synthesize_speech_batch(**kwargs):
+    items = kwargs["Requests"]
+    current_app.logger.info(
+        "Got batch request: %s", [clean_request(item) for item in items]
     )
-    try:
-        return Response(
-            stream_with_context(
-                voice.synthesize(
-                    text=text,
-                    ssml=synthesize_ssml,
-                    **kwargs,
+    app = current_app._get_current_object()  # type: ignore
+    # Needs the request context, which the workers don't have
+    project = project_priority()
+    for item in items:
+        item["Priority"] = _request_priority(item, project)
+
+    def synthesize_item(idx: int, item: Dict[str, Any]) -> Dict[str, Any]:
+        with app.app_context():
+            try:
+                voice = _validate_synthesis_request(item)
+                content = b"".join(
+                    voice.synthesize(
+                        text=item["Text"], ssml=item.get("TextType") == "ssml", **item
+                    )
                 )
-            ),
-            content_type=output_content_type,
+            except (HTTPException, NotImplementedError, ValueError) as ex:
+                app.logger.warning("Synthesis of batch item %d failed: %s", idx, ex)
+                return {"Index": idx, "StatusCode": 400, "message": "Invalid request."}
+            except OverloadedError as ex:
+                app.logger.warning("Batch item %d rejected: %s", idx, ex)
+                return {
+                    "Index": idx,
+                    "StatusCode": ex.status_code,
+                    "RetryAfter": ex.retry_after,
+                    "message": "Too many requests, try again later.",
+                }
+            except Exception:
+                app.logger.exception("Synthesis of batch item %d failed", idx)
+                return {
+                    "Index": idx,
+                    "StatusCode": 500,
+                    "message": "An unknown conditon has caused a service failure.",
+                }
+
+        return {
+            "Index": idx,
+            "StatusCode": 200,
+            "ContentType": OutputFormat(
+                "json" if item.get("IncludeSpeechMarks") else item["OutputFormat"],
+                [item["SampleRate"]],
+            ).content_type,
+            "Content": base64.b64encode(content).decode("ascii"),
+        }
+
+    def generate_results() -> Iterable[bytes]:
+        # Items are synthesized concurrently so their segments can be batched by the
+        # voices, see BatchingConfig in voice.proto
+        executor = ThreadPoolExecutor(
+            max_workers=current_app.config["SYNTHESIS_BATCH_WORKERS"],
+            thread_name_prefix="speech-batch",
         )
-    except (NotImplementedError, ValueError) as ex:
-        current_app.logger.warning("Synthesis failed: %s", ex)
-        abort(400)
+        futures = [
+            executor.submit(synthesize_item, idx, item)
+            for idx, item in enumerate(items)
+        ]
+        try:
+            for future in as_completed(futures):
+                yield json.dumps(future.result()).encode("utf-8") + b"\n"
+        finally:
+            # The client may have gone away
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    return Response(
+        stream_with_context(generate_results()),
+        content_type="application/x-json-stream",
+    )
 
 
-docs.register(route_synthesize_speech)
+docs.register(route_synthesize_speech_batch)
+
+
+@current_app.route("/v0/speech-tasks", methods=["POST"])
+@use_kwargs(schemas.StartSpeechSynthesisTaskRequest)
+@doc(
+    description=(
+        "Start an asynchronous synthesis task for long-form text. The output can be "
+        + "fetched from OutputUri once the task has completed."
+    ),
+    tags=["speech"],
+    produces=["application/json"],
+)
+@marshal_with(schemas.SynthesisTaskResponse, code=200, description="Scheduled task")
+@marshal_with(schemas.Error, code=400, description="Bad request")
+@marshal_with(schemas.Error, code=404, description="Synthesis tasks not enabled")
+@marshal_with(schemas.Error, code=500, description="Service error")
+@require_api_key
+def route_start_speech_synthesis_task(**kwargs):
+    current_app.logger.info("Got task request: %s", clean_request(kwargs))
+    if not g_tasks:
+        abort(404)
+
+    # Tasks are long-form and asynchronous, so never ahead of interactive requests
+    kwargs["Priority"] = "bulk"
+    voice = _validate_synthesis_request(kwargs)
+    task = g_tasks.start(
+        voice,
+        kwargs["Text"],
+        ssml=kwargs.get("TextType") == "ssml",
+        **kwargs,
+    )
+    return jsonify({"SynthesisTask": _with_output_uri(task)})
+
+
+docs.register(route_start_speech_synthesis_task)
+
+
+@current_app.route("/v0/speech-tasks/<task_id>", methods=["GET"])
+@doc(
+    description="Get the status of a synthesis task",
+    tags=["speech"],
+    produces=["application/json"],
+)
+@marshal_with(schemas.SynthesisTaskResponse, code=200, description="The task")
+@marshal_with(schemas.Error, code=404, description="Task not found")
+@marshal_with(schemas.Error, code=500, description="Service error")
+@require_api_key
+def route_get_speech_synthesis_task(task_id: str):
+    task = g_tasks.get(task_id) if g_tasks else None
+    if not task:
+        abort(404)
+    return jsonify({"SynthesisTask": _with_output_uri(task)})
+
+
+docs.register(route_get_speech_synthesis_task)
+
+
+@current_app.route("/v0/speech-tasks/<task_id>/output", methods=["GET"])
+@doc(
+    description="Get the output of a completed synthesis task",
+    tags=["speech"],
+    produces=[
+        "audio/mpeg",
+        "audio/ogg",
+        "application/x-json-stream",
+        "audio/x-wav",
+    ],
+)
+@marshal_with({}, code=200, description="Audio or speech marks content")
+@marshal_with(schemas.Error, code=404, description="Task or output not found")
+@marshal_with(schemas.Error, code=500, description="Service error")
+@require_api_key
+def route_get_speech_synthesis_task_output(task_id: str):
+    task = g_tasks.get(task_id) if g_tasks else None
+    output_path = g_tasks.output_path(task_id) if g_tasks else None
+    if not task or not output_path:
+        abort(404)
+
+    return send_file(
+        output_path,
+        mimetype=OutputFormat(
+            "json" if task.get("IncludeSpeechMarks") else task["OutputFormat"],
+            [task.get("SampleRate")],
+        ).content_type,
+    )
+
+
+docs.register(route_get_speech_synthesis_task_output)
+
+
+def _with_output_uri(task: Dict[str, Any]) -> Dict[str, Any]:
+    if task["TaskStatus"] != "completed":
+        return task
+    return {
+        **task,
+        "OutputUri": url_for(
+            "route_get_speech_synthesis_task_output", task_id=task["TaskId"]
+        ),
+    }
 
 
 @current_app.route("/v0/voices", methods=["GET"])
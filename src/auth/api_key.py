@@ -2,6 +2,7 @@
 # for this small Flask custom auth decorator tutorial.
 
 from functools import wraps
+from typing import Optional
 from flask import request, abort, current_app
 
 def require_api_key(f):
@@ -16,3 +17,17 @@ def require_api_key(f):
         else:
             abort(401)
     return decorated_function
+
+
+def project_priority() -> Optional[str]:
+    """Get the synthesis priority of the project owning the request's API key, if
+    any."""
+    if current_app.config["AUTH_DISABLED"]:
+        return None
+
+    from src.models.key import Key  # noqa:E402 isort:skip
+
+    key = Key.query.filter_by(
+        key=request.headers.get("authorization"), is_active=True
+    ).one_or_none()
+    return key.project.priority if key else None
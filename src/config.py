@@ -34,5 +34,61 @@ class EnvvarConfig(metaclass=flask_env.MetaFlaskEnv):
     # Enable to use ffmpeg executable to encode ogg_vorbis/mp3
     USE_FFMPEG = True
 
+    # Encoder for ogg_vorbis/mp3 output, either "ffmpeg" (a subprocess per response)
+    # or "soundfile" (in-process with libsndfile). MP3 requires libsndfile >= 1.1.0
+    # and soundfile >= 0.11, otherwise it is encoded with ffmpeg.
+    AUDIO_ENCODER = "ffmpeg"
+
+    # How SSML <prosody> is applied to synthesized audio, either "ffmpeg" (audio
+    # filters, requires USE_FFMPEG), "native" (in-process NumPy DSP) or "model" (rate
+    # and pitch through the duration/pitch controls of the acoustic model where
+    # supported, the rest in-process)
+    PROSODY_MODE = "ffmpeg"
+
+    # Maximum number of concurrent ffmpeg processes per worker process (0 for no
+    # limit), and the number of idle ffmpeg processes kept spawned ahead of time for
+    # repeatedly used arguments. Idle processes come on top of the maximum.
+    FFMPEG_MAX_PROCESSES = 16
+    FFMPEG_WARM_PROCESSES = 0
+
+    # Number of segments that can be queued between the acoustic model, vocoder and
+    # encoder stages of a FastSpeech2 request, which run concurrently. 0 runs the
+    # stages sequentially.
+    SYNTHESIS_PIPELINE_DEPTH = 1
+
+    # Size of the thread pool that runs requests (including the synthesis of streamed
+    # responses) when served over ASGI with asgi:app. Writing responses to clients
+    # doesn't use these threads.
+    ASGI_SYNTHESIS_THREADS = 8
+
     # Use this variable to enable or disable auth(orization|entication)
     AUTH_DISABLED = True
+
+    # Response cache for /v0/speech, keyed on the voice version and request. Set
+    # SYNTHESIS_CACHE_MAX_BYTES to 0 to disable the cache.
+    SYNTHESIS_CACHE_MAX_BYTES = 128 * 1024 * 1024
+    # Optional on-disk tier for the response cache, disabled if empty
+    SYNTHESIS_CACHE_DIR = ""
+    SYNTHESIS_CACHE_DISK_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+    # Number of items of a /v0/speech:batch request synthesized concurrently, which
+    # lets voices with acoustic/vocoder batching configured run them together
+    SYNTHESIS_BATCH_WORKERS = 8
+
+    # Directory for the status and output of asynchronous synthesis tasks
+    # (/v0/speech-tasks), which are disabled if empty. Has to be shared by all worker
+    # processes, e.g. a volume or a mounted object store bucket.
+    SYNTHESIS_TASK_DIR = ""
+    # Number of synthesis tasks run concurrently per worker process
+    SYNTHESIS_TASK_WORKERS = 1
+    # Maximum total time a synthesis task waits for an overloaded voice (see
+    # AdmissionConfig in voice.proto) before it fails, in milliseconds
+    SYNTHESIS_TASK_MAX_OVERLOAD_WAIT_MS = 600000
+
+    # Maximum time each sentence of a bulk priority request waits for interactive
+    # requests to be synthesized, in milliseconds. Set to 0 to disable priorities.
+    SYNTHESIS_BULK_MAX_DELAY_MS = 2000
+
+    # Cache for individually synthesized segments (sentences) shared by all local
+    # voices. Set to 0 to disable.
+    SEGMENT_CACHE_MAX_BYTES = 64 * 1024 * 1024
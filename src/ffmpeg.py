@@ -11,12 +11,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import contextlib
+import functools
 import shutil
 import subprocess as sp
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import List, Literal, Optional
+from typing import Iterable, Iterator, List, Literal, Optional, Tuple
 
 
+@functools.lru_cache(maxsize=None)
 def _find_ffmpeg() -> str:
     path = shutil.which("external/ffmpeg/ffmpeg")
     if path:
@@ -27,12 +32,173 @@ def _find_ffmpeg() -> str:
     raise RuntimeError("ffmpeg not found")
 
 
-_FFMPEG_ARGS = [
-    _find_ffmpeg(),
-    "-hide_banner",
-    "-loglevel",
-    "error",
-]
+def _ffmpeg_args() -> List[str]:
+    # The executable is looked up lazily, so this module can be imported in
+    # deployments that don't use ffmpeg
+    return [
+        _find_ffmpeg(),
+        "-hide_banner",
+        "-loglevel",
+        "error",
+    ]
+
+
+# Number of recently used argument lists remembered per warm process, to tell
+# repeatedly used arguments from one-off ones
+_SEEN_ARGS_PER_WARM = 4
+
+
+class _ProcessPool:
+    """Bounds the number of concurrent ffmpeg processes and keeps some warm.
+
+    ffmpeg processes can't be reused for multiple inputs, so each process is only used
+    once. Warm processes are spawned ahead of time with the same arguments as recently
+    used processes, which moves the spawn cost off the request path. Only argument
+    lists that are used repeatedly get warm processes, one-off arguments (e.g. of a
+    prosody conversion) don't.
+
+    Warm processes are idle until taken, and don't count against max_processes. At
+    most max_processes + warm_processes ffmpeg processes exist at a time.
+
+    Streaming encoders hold their process for a whole response while the response's
+    segments might still need one-shot conversions (e.g. for prosody). To prevent them
+    from starving those conversions, streaming encoders can only use max_processes - 1
+    of the slots.
+
+    """
+
+    _slots: Optional[threading.BoundedSemaphore]
+    _stream_slots: Optional[threading.BoundedSemaphore]
+    _max_warm: int
+    _warm: "OrderedDict[Tuple[str, ...], List[sp.Popen]]"
+    _seen: "OrderedDict[Tuple[str, ...], None]"
+    _lock: threading.Lock
+
+    def __init__(self, max_processes: int = 0, warm_processes: int = 0):
+        """Initialize a _ProcessPool.
+
+        Args:
+          max_processes: Maximum number of concurrently running (non-warm) ffmpeg
+              processes, 0 for no limit. Has to be at least 2 if set.
+
+          warm_processes: Total number of idle processes kept ready for the most
+              recently used argument lists, in addition to max_processes.
+
+        """
+        if max_processes == 1 or max_processes < 0:
+            raise ValueError("max_processes has to be 0 (unlimited) or at least 2")
+        self._slots = (
+            threading.BoundedSemaphore(max_processes) if max_processes else None
+        )
+        self._stream_slots = (
+            threading.BoundedSemaphore(max_processes - 1) if max_processes else None
+        )
+        self._max_warm = warm_processes
+        self._warm = OrderedDict()
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def process(self, args: List[str], stream: bool = False) -> Iterator[sp.Popen]:
+        """Get an ffmpeg process with args, blocking until a slot is available.
+
+        The process has its stdin and stdout connected to pipes. It is killed if it's
+        still running when the context exits.
+        """
+        acquired: List[threading.BoundedSemaphore] = []
+        try:
+            for slots in (self._stream_slots if stream else None, self._slots):
+                if slots:
+                    slots.acquire()
+                    acquired.append(slots)
+
+            proc = self._take_warm(args) or _spawn(args)
+            try:
+                yield proc
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                proc.wait()
+                for pipe in (proc.stdin, proc.stdout):
+                    if pipe:
+                        pipe.close()
+        finally:
+            for slots in reversed(acquired):
+                slots.release()
+
+    def _take_warm(self, args: List[str]) -> Optional[sp.Popen]:
+        if not self._max_warm:
+            return None
+
+        key = tuple(args)
+        proc = None
+        with self._lock:
+            # Arguments are hot if they have a warm process or have been used recently
+            hot = key in self._warm or key in self._seen
+            self._seen[key] = None
+            self._seen.move_to_end(key)
+            while len(self._seen) > _SEEN_ARGS_PER_WARM * self._max_warm:
+                self._seen.popitem(last=False)
+
+            procs = self._warm.get(key, [])
+            if key in self._warm:
+                self._warm.move_to_end(key)
+            while procs and proc is None:
+                candidate = procs.pop()
+                if candidate.poll() is None:
+                    proc = candidate
+
+        if hot:
+            threading.Thread(
+                target=self._add_warm, args=(key,), name="ffmpeg-warm", daemon=True
+            ).start()
+        return proc
+
+    def _add_warm(self, key: Tuple[str, ...]) -> None:
+        proc = _spawn(list(key))
+        evicted = []
+        with self._lock:
+            self._warm.setdefault(key, []).append(proc)
+            n_warm = sum(len(procs) for procs in self._warm.values())
+            # Evict processes for the least recently used arguments first
+            for procs in self._warm.values():
+                while procs and n_warm > self._max_warm:
+                    evicted.append(procs.pop(0))
+                    n_warm -= 1
+            for stale_key in [k for k, procs in self._warm.items() if not procs]:
+                if stale_key != key:
+                    del self._warm[stale_key]
+
+        for proc in evicted:
+            proc.kill()
+            proc.wait()
+
+
+def _spawn(args: List[str]) -> sp.Popen:
+    return sp.Popen(args, stdin=sp.PIPE, stdout=sp.PIPE)
+
+
+_pool = _ProcessPool()
+
+
+def configure(max_processes: int = 0, warm_processes: int = 0) -> None:
+    """Configure the ffmpeg process pool of this process.
+
+    Args:
+      max_processes: Maximum number of concurrent ffmpeg processes, 0 for no limit.
+      warm_processes: Number of pre-spawned idle ffmpeg processes.
+
+    """
+    global _pool
+    _pool = _ProcessPool(max_processes=max_processes, warm_processes=warm_processes)
+
+
+def _check_output(args: List[str], audio_content: bytes) -> bytes:
+    with _pool.process(args) as proc:
+        content, _ = proc.communicate(audio_content)
+        if proc.returncode != 0:
+            raise sp.CalledProcessError(proc.returncode, args, output=content)
+    return content
 
 
 @dataclass
@@ -41,6 +207,15 @@ class Prosody:
     pitch: Optional[float] = None
     volume: Optional[float] = None
 
+    @property
+    def is_default(self) -> bool:
+        """Whether applying this prosody leaves the audio unchanged."""
+        return (
+            self.rate in (None, 1.0)
+            and self.pitch in (None, 1.0)
+            and self.volume in (None, 0.0)
+        )
+
 
 def _input_args(
     src_sample_rate: str = "22050",
@@ -105,6 +280,19 @@ def _filter_args(
     )
 
 
+def _output_args(
+    out_format: Literal["ogg_vorbis", "mp3", "pcm"], sample_rate: str
+) -> List[str]:
+    if out_format == "ogg_vorbis":
+        return ["-acodec", "libvorbis", "-ar", sample_rate, "-f", "ogg", "-"]
+    elif out_format == "mp3":
+        return ["-ar", sample_rate, "-f", "mp3", "-"]
+    elif out_format == "pcm":
+        return ["-ar", sample_rate, "-f", "s16le", "-"]
+    else:
+        raise ValueError("Invalid output format")
+
+
 def to_format(
     *,
     out_format: Literal["ogg_vorbis", "mp3", "pcm"],
@@ -143,22 +331,13 @@ def to_s16le(
       Signed linear 16 bit little endian PCM encoded audio content
 
     """
-    content = sp.check_output(
-        _FFMPEG_ARGS
-        + input_args
-        + [
-            "-ar",
-            sample_rate,
-            "-f",
-            "s16le",
-            "-",
-        ],
-        input=audio_content,
+    content = _check_output(
+        _ffmpeg_args() + input_args + _output_args("pcm", sample_rate),
+        audio_content,
     )
     return content
 
 
-# TODO(rkjaran): Implement these using generators/streams to decrease latency
 def to_ogg_vorbis(
     audio_content: bytes,
     sample_rate: str,
@@ -175,19 +354,9 @@ def to_ogg_vorbis(
       Ogg Vorbis encoded audio content
 
     """
-    content = sp.check_output(
-        _FFMPEG_ARGS
-        + input_args
-        + [
-            "-acodec",
-            "libvorbis",
-            "-ar",
-            sample_rate,
-            "-f",
-            "ogg",
-            "-",
-        ],
-        input=audio_content,
+    content = _check_output(
+        _ffmpeg_args() + input_args + _output_args("ogg_vorbis", sample_rate),
+        audio_content,
     )
     return content
 
@@ -208,16 +377,92 @@ def to_mp3(
       MP3 encoded audio content
 
     """
-    content = sp.check_output(
-        _FFMPEG_ARGS
-        + input_args
-        + [
-            "-ar",
-            sample_rate,
-            "-f",
-            "mp3",
-            "-",
-        ],
-        input=audio_content,
+    content = _check_output(
+        _ffmpeg_args() + input_args + _output_args("mp3", sample_rate),
+        audio_content,
     )
     return content
+
+
+def to_format_stream(
+    chunks: Iterable[bytes],
+    *,
+    out_format: Literal["ogg_vorbis", "mp3", "pcm"],
+    sample_rate: str,
+    src_sample_rate: str = "22050",
+    src_fmt: str = "s16le",
+    read_size: int = 4096,
+) -> Iterator[bytes]:
+    """Encode a stream of audio chunks with a single ffmpeg process
+
+    All chunks are written to the stdin of the same ffmpeg process, so the result is
+    a single continuous stream in the output format (e.g. one Ogg stream instead of
+    concatenated Ogg files). Encoded bytes are yielded as soon as ffmpeg outputs them.
+
+    Args:
+      chunks: Raw audio chunks in the source format, e.g. one per synthesized segment
+      out_format: The output format
+      sample_rate: Output sample rate in Hertz
+      src_sample_rate: Sample rate of the chunks in Hertz
+      src_fmt: ffmpeg format of the chunks
+      read_size: Maximum size of each yielded chunk
+
+    Yields:
+      Chunks of encoded audio content
+
+    """
+    if out_format == "pcm" and src_fmt == "s16le" and src_sample_rate == sample_rate:
+        yield from chunks
+        return
+
+    with _pool.process(
+        _ffmpeg_args()
+        + _input_args(src_sample_rate=src_sample_rate, src_fmt=src_fmt)
+        + _output_args(out_format, sample_rate),
+        stream=True,
+    ) as proc:
+        yield from _stream_through(proc, chunks, read_size)
+
+
+def _stream_through(
+    proc: sp.Popen, chunks: Iterable[bytes], read_size: int
+) -> Iterator[bytes]:
+    assert proc.stdin and proc.stdout
+    stdin, stdout = proc.stdin, proc.stdout
+    failures: List[Exception] = []
+
+    def feed() -> None:
+        try:
+            for chunk in chunks:
+                try:
+                    stdin.write(chunk)
+                    stdin.flush()
+                except (BrokenPipeError, ValueError):
+                    # ffmpeg has exited or the consumer has stopped reading
+                    return
+        except Exception as ex:
+            # Synthesis failed, which the consumer has to see instead of a
+            # truncated stream
+            failures.append(ex)
+            proc.kill()
+        finally:
+            try:
+                stdin.close()
+            except OSError:
+                pass
+            if hasattr(chunks, "close"):
+                chunks.close()  # type: ignore
+
+    writer = threading.Thread(target=feed, name="ffmpeg-stream-writer", daemon=True)
+    writer.start()
+    while True:
+        content = stdout.read1(read_size)  # type: ignore
+        if not content:
+            break
+        yield content
+    writer.join()
+    returncode = proc.wait()
+    if failures:
+        raise failures[0]
+    if returncode != 0:
+        raise sp.CalledProcessError(returncode, proc.args)
@@ -11,17 +11,36 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import copy
 import re
 import string
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import Callable, Dict, Iterable, List, Literal, NewType, Optional, Union
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    NewType,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import ice_g2p.transcriber
 
+from src.utils.cache import LRUCache
 from src.utils.version import VersionedThing, hash_from_impl
 
-from .lexicon import LangID, LexiconBase, SimpleInMemoryLexicon, read_kaldi_lexicon
+from .lexicon import (
+    LangID,
+    LexiconBase,
+    MmapLexicon,
+    SimpleInMemoryLexicon,
+    read_kaldi_lexicon,
+)
 from .phonemes import (
     SHORT_PAUSE,
     Aligner,
@@ -56,6 +75,23 @@ class GraphemeToPhonemeTranslatorBase(VersionedThing, ABC):
         """
         ...
 
+    def translate_batch(
+        self,
+        texts: Sequence[str],
+        lang: LangID,
+        alphabet: Alphabet = "ipa",
+    ) -> List[PhoneSeq]:
+        """Translate several texts, e.g. the distinct words of a request
+
+        The default implementation translates the texts one by one, subclasses can
+        translate them together.
+
+        Returns:
+            The translation of each text, in the same order as texts.
+
+        """
+        return [self.translate(text, lang, alphabet=alphabet) for text in texts]
+
     def translate_words(
         self,
         words: Iterable[Word],
@@ -66,6 +102,11 @@ class GraphemeToPhonemeTranslatorBase(VersionedThing, ABC):
         #   single word inputs. Need to figure out an interface that includes the
         #   necessary context.
 
+        # All words are split up first, so each distinct one is only translated once,
+        # in a single batch
+        g2p_words: List[Optional[List[str]]] = []
+        words = list(words)
+
         ssml_tag_skiplist: List[str] = ["phoneme"]
         for word in words:
 
@@ -85,11 +126,22 @@ class GraphemeToPhonemeTranslatorBase(VersionedThing, ABC):
                 # TODO(rkjaran): Cover more punctuation (Unicode)
                 punctuation = re.sub(r"[{}\[\]]", "", string.punctuation)
                 g2p_word = re.sub(r"([{}])".format(punctuation), r" \1 ", word.symbol)
+                g2p_words.append(g2p_word.split())
+            else:
+                g2p_words.append(None)
+
+        distinct = list(
+            dict.fromkeys(g2p_w for g2p_ws in g2p_words if g2p_ws for g2p_w in g2p_ws)
+        )
+        translations = dict(
+            zip(distinct, self.translate_batch(distinct, lang, alphabet=alphabet))
+        )
+
+        for word, g2p_ws in zip(words, g2p_words):
+            if g2p_ws is not None:
                 word.phone_sequence = []
-                for g2p_w in g2p_word.split():
-                    word.phone_sequence.extend(
-                        self.translate(g2p_w, lang, alphabet=alphabet)
-                    )
+                for g2p_w in g2p_ws:
+                    word.phone_sequence.extend(translations[g2p_w])
             yield word
             if word.is_spoken() and alphabet == "x-sampa+syll+stress":
                 yield Word(phone_sequence=["."])
@@ -100,6 +152,39 @@ class EmbeddedPhonemeTranslatorBase(GraphemeToPhonemeTranslatorBase):
     def _translate(self, w: str, lang: LangID, alphabet: Alphabet = "ipa"):
         ...
 
+    def _translate_batch(
+        self, ws: Sequence[str], lang: LangID, alphabet: Alphabet = "ipa"
+    ) -> List[PhoneSeq]:
+        return [self._translate(w, lang, alphabet=alphabet) for w in ws]
+
+    def translate_batch(
+        self,
+        texts: Sequence[str],
+        lang: LangID,
+        alphabet: Alphabet = "ipa",
+    ) -> List[PhoneSeq]:
+        # Plain words go straight to _translate_batch, anything with embedded
+        # phonemes or pauses is processed as in translate
+        plain = [
+            idx
+            for idx, text in enumerate(texts)
+            if not any(char in text for char in "{}., ")
+        ]
+        results = dict(
+            zip(
+                plain,
+                self._translate_batch(
+                    [texts[idx] for idx in plain], lang, alphabet=alphabet
+                ),
+            )
+        )
+        return [
+            results[idx]
+            if idx in results
+            else self.translate(text, lang, alphabet=alphabet)
+            for idx, text in enumerate(texts)
+        ]
+
     def translate(
         self,
         text: str,
@@ -211,6 +296,114 @@ class ComposedTranslator(GraphemeToPhonemeTranslatorBase):
                 break
         return phone
 
+    def translate_batch(
+        self,
+        texts: Sequence[str],
+        lang: LangID,
+        alphabet: Alphabet = "ipa",
+    ) -> List[PhoneSeq]:
+        phones: List[PhoneSeq] = [[] for _ in texts]
+        # Each translator only gets the texts the previous ones couldn't translate
+        pending = list(range(len(texts)))
+        for t in self._translators:
+            if not pending:
+                break
+            translated = t.translate_batch(
+                [texts[idx] for idx in pending], lang, alphabet=alphabet
+            )
+            for idx, phone in zip(pending, translated):
+                phones[idx] = phone
+            pending = [idx for idx in pending if not phones[idx]]
+        return phones
+
+
+TranslationCache = LRUCache[Tuple[str, str, str, str], Tuple[str, ...]]
+
+
+class MemoizedTranslator(GraphemeToPhonemeTranslatorBase):
+    """MemoizedTranslator
+
+    Memoize the translations of another translator. Since translate_words translates
+    text word by word, a cache of a few thousand entries absorbs the translations of
+    the most common words, which are most of the words in any text.
+
+    The cache is keyed on the version hash of the translator, so it can be shared by
+    several translators.
+
+    Example:
+      >>> MemoizedTranslator(ComposedTranslator(...), LRUCache(max_size=10000))
+    """
+
+    _translator: GraphemeToPhonemeTranslatorBase
+    _cache: TranslationCache
+
+    def __init__(
+        self,
+        translator: GraphemeToPhonemeTranslatorBase,
+        cache: TranslationCache,
+    ):
+        self._translator = translator
+        self._cache = cache
+
+    @property
+    def version_hash(self) -> str:
+        # Memoization doesn't change the translations
+        return self._translator.version_hash
+
+    @property
+    def cache(self) -> TranslationCache:
+        """The cache, with hit and miss counters."""
+        return self._cache
+
+    def translate(
+        self,
+        text: str,
+        lang: LangID,
+        alphabet: Alphabet = "ipa",
+    ) -> PhoneSeq:
+        key = (self._translator.version_hash, text, lang, alphabet)
+        phones = self._cache.get(key)
+        if phones is None:
+            phones = tuple(self._translator.translate(text, lang, alphabet=alphabet))
+            self._cache.put(key, phones)
+        # A copy, so callers can't modify the cached translation
+        return list(phones)
+
+    def translate_batch(
+        self,
+        texts: Sequence[str],
+        lang: LangID,
+        alphabet: Alphabet = "ipa",
+    ) -> List[PhoneSeq]:
+        version_hash = self._translator.version_hash
+        cached = [
+            self._cache.get((version_hash, text, lang, alphabet)) for text in texts
+        ]
+        misses = list(
+            dict.fromkeys(text for text, phones in zip(texts, cached) if phones is None)
+        )
+        translated = dict(
+            zip(
+                misses,
+                (
+                    tuple(phones)
+                    for phones in self._translator.translate_batch(
+                        misses, lang, alphabet=alphabet
+                    )
+                ),
+            )
+        )
+        for text, phones in translated.items():
+            self._cache.put((version_hash, text, lang, alphabet), phones)
+        return [
+            list(phones if phones is not None else translated[text])
+            for text, phones in zip(texts, cached)
+        ]
+
+    def seed(self, words: Iterable[str], lang: LangID, alphabet: Alphabet) -> None:
+        """Translate words into the cache, e.g. the most frequent words of lang."""
+        self.translate_batch(list(words), lang, alphabet=alphabet)
+
 
 class LexiconGraphemeToPhonemeTranslator(EmbeddedPhonemeTranslatorBase):
     _lookup_lexicon: LexiconBase
@@ -223,8 +416,16 @@ class LexiconGraphemeToPhonemeTranslator(EmbeddedPhonemeTranslatorBase):
         lexicon: Path,
         language_code: LangID,
         alphabet: Alphabet,
+        precompute_stress: bool = False,
+        lexicon_format: Literal["kaldi", "compiled"] = "kaldi",
     ):
-        self._lookup_lexicon = SimpleInMemoryLexicon(lexicon, alphabet)
+        if lexicon_format == "compiled":
+            # The alphabet and stressed forms are fixed when the lexicon is compiled
+            self._lookup_lexicon = MmapLexicon(lexicon)
+        else:
+            self._lookup_lexicon = SimpleInMemoryLexicon(
+                lexicon, alphabet, precompute_stress=precompute_stress
+            )
         self._language_code = language_code
         # TODO(rkjaran): By default LexiconBase.get(...) returns IPA, change this once
         #   we add a parameter for the alphabet to .get()
@@ -246,6 +447,13 @@ class LexiconGraphemeToPhonemeTranslator(EmbeddedPhonemeTranslatorBase):
         w_lower = w.lower()
         lexicon = self._lookup_lexicon
         if lexicon:
+            if alphabet == "x-sampa+syll+stress":
+                # Stressed forms of the entries themselves can be precomputed
+                phones = lexicon.get_xsampa_with_stress(w, [])
+                if not phones:
+                    phones = lexicon.get_xsampa_with_stress(w_lower, [])
+                if phones:
+                    return phones
             phones = lexicon.get(w, [])
             if not phones:
                 phones = lexicon.get(w_lower, [])
@@ -261,12 +469,18 @@ class LexiconGraphemeToPhonemeTranslator(EmbeddedPhonemeTranslatorBase):
 
 class IceG2PTranslator(EmbeddedPhonemeTranslatorBase):
     _transcriber: ice_g2p.transcriber.Transcriber
+    _unsyllabified_transcriber: ice_g2p.transcriber.Transcriber
     _version_hash: Optional[str] = None
 
     def __init__(self):
         self._transcriber = ice_g2p.transcriber.Transcriber(
             use_dict=True, syllab_symbol=".", stress_label=True
         )
+        # A shallow copy shares the loaded g2p model and dictionaries. With a
+        # transcriber per configuration none is modified while translating, so
+        # concurrent requests can use the same translator.
+        self._unsyllabified_transcriber = copy.copy(self._transcriber)
+        self._unsyllabified_transcriber.syllab_symbol = ""
 
     @property
     def version_hash(self) -> str:
@@ -298,22 +512,39 @@ class IceG2PTranslator(EmbeddedPhonemeTranslatorBase):
         lang: LangID,
         alphabet: Alphabet = "ipa",
     ) -> PhoneSeq:
-        punctuation = re.sub(r"[{}\[\]]", "", string.punctuation)
-        text = re.sub(r"([{}])".format(punctuation), "", text)
+        return self._translate_batch([text], lang, alphabet=alphabet)[0]
 
-        if text.strip() == "":
-            return []
-
-        if alphabet != "x-sampa+syll+stress":
-            syllab_symbol = self._transcriber.syllab_symbol
-            self._transcriber.syllab_symbol = ""
-            out = self._transcriber.transcribe(text.lower())
-            self._transcriber.syllab_symbol = syllab_symbol
-        else:
-            out = self._transcriber.transcribe(text.lower())
-
-        phone_seq = out.split()
-        if alphabet == "ipa":
-            return convert_xsampa_to_ipa(phone_seq)
-
-        return phone_seq
+    def _translate_batch(
+        self,
+        texts: Sequence[str],
+        lang: LangID,
+        alphabet: Alphabet = "ipa",
+    ) -> List[PhoneSeq]:
+        punctuation = re.sub(r"[{}\[\]]", "", string.punctuation)
+        words = [
+            re.sub(r"([{}])".format(punctuation), "", text).lower() for text in texts
+        ]
+
+        # Distinct words are transcribed together, with a single transcriber setup
+        distinct = [w for w in dict.fromkeys(words) if w.strip() != ""]
+        transcriptions = dict(zip(distinct, self._transcribe(distinct, alphabet)))
+
+        phone_seqs: List[PhoneSeq] = []
+        for w in words:
+            if w.strip() == "":
+                phone_seqs.append([])
+                continue
+            phone_seq = transcriptions[w].split()
+            if alphabet == "ipa":
+                phone_seq = convert_xsampa_to_ipa(phone_seq)
+            phone_seqs.append(phone_seq)
+        return phone_seqs
+
+    def _transcribe(self, words: Sequence[str], alphabet: Alphabet) -> List[str]:
+        """Transcribe words to X-SAMPA, syllabified if alphabet requires it."""
+        transcriber = (
+            self._transcriber
+            if alphabet == "x-sampa+syll+stress"
+            else self._unsyllabified_transcriber
+        )
+        return [transcriber.transcribe(w) for w in words]
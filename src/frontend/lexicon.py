@@ -11,12 +11,22 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import mmap
 import re
+import struct
+import sys
 from abc import ABC, abstractmethod
+from array import array
 from pathlib import Path
-from typing import Any, Dict, List, Literal, NewType, Optional
+from typing import Any, Dict, List, Literal, NewType, Optional, Sequence, Tuple
 
-from .phonemes import PhoneSeq, convert_ipa_to_xsampa, convert_xsampa_to_ipa
+from .phonemes import (
+    PhoneSeq,
+    convert_ipa_to_xsampa,
+    convert_xsampa_to_ipa,
+    convert_xsampa_to_xsampa_with_stress,
+    convert_xsampa_to_xsampa_with_stress_batch,
+)
 
 LangID = NewType("LangID", str)
 
@@ -130,18 +140,73 @@ class LexiconBase(ABC):
         """
         ...
 
+    def get_xsampa_with_stress(
+        self,
+        grapheme: str,
+        default: Optional[PhoneSeq] = None,
+        properties: Optional[LexWord.Properties] = None,
+    ) -> PhoneSeq:
+        """Get the phoneme for grapheme as syllabified X-SAMPA with stress labels or
+        default if it doesn't exist.
+
+        Args:
+          grapheme: The grapheme to look up.
+          default: This PhoneSeq will be returned if grapheme is not
+              found, defaults to an empty list.
+          properties: Ignored for now.
+
+        Returns:
+          The PhoneSeq for grapheme if it exists in the lexicon,
+          otherwise default.
+        """
+        phoneme = self.get(grapheme, properties=properties)
+        if not phoneme:
+            return default or []
+        return convert_xsampa_to_xsampa_with_stress(
+            convert_ipa_to_xsampa(phoneme), grapheme
+        )
+
 
 class SimpleInMemoryLexicon(LexiconBase):
     _lexicon: Dict[str, PhoneSeq]
+    _stressed: Dict[str, PhoneSeq]
     _native_alphabet: Literal["x-sampa", "ipa"]
 
-    def __init__(self, lex_path: Path, alphabet: Literal["x-sampa", "ipa"]):
+    def __init__(
+        self,
+        lex_path: Path,
+        alphabet: Literal["x-sampa", "ipa"],
+        precompute_stress: bool = False,
+    ):
+        """Load a Kaldi style lexicon into memory.
+
+        Args:
+          lex_path: Path to the lexicon.
+          alphabet: The alphabet of the lexicon.
+          precompute_stress: Syllabify and add stress labels to all entries up front,
+              so get_xsampa_with_stress doesn't have to at lookup time.
+        """
         self._lexicon = read_kaldi_lexicon(lex_path)
         self._native_alphabet = alphabet
+        self._stressed = {}
+        if precompute_stress:
+            graphemes = list(self._lexicon)
+            self._stressed = dict(
+                zip(
+                    graphemes,
+                    convert_xsampa_to_xsampa_with_stress_batch(
+                        [
+                            (grapheme, convert_ipa_to_xsampa(self.get(grapheme)))
+                            for grapheme in graphemes
+                        ]
+                    ),
+                )
+            )
 
     def insert(self, entry: LexWord) -> None:
         """Insert a new entry into to lexicon."""
         self._lexicon[entry.grapheme] = entry.phoneme
+        self._stressed.pop(entry.grapheme, None)
 
     def get(
         self,
@@ -192,3 +257,288 @@ class SimpleInMemoryLexicon(LexiconBase):
         if self._native_alphabet != "x-sampa":
             phoneme = convert_ipa_to_xsampa(phoneme)
         return phoneme
+
+    def get_xsampa_with_stress(
+        self,
+        grapheme: str,
+        default: Optional[PhoneSeq] = None,
+        properties: Optional[LexWord.Properties] = None,
+    ) -> PhoneSeq:
+        stressed = self._stressed.get(grapheme)
+        if stressed:
+            # A copy, so callers can't modify the lexicon
+            return list(stressed)
+        return super().get_xsampa_with_stress(grapheme, default, properties)
+
+
+# Layout of the header of a compiled lexicon: magic, format version, alphabet (0 for
+# X-SAMPA, 1 for IPA), whether stressed forms are included, number of entries and
+# number of distinct phones. The header is followed by the sections listed in
+# _COMPILED_SECTIONS, each aligned to 8 bytes.
+_COMPILED_MAGIC = b"TIROLEX\0"
+_COMPILED_VERSION = 1
+_COMPILED_HEADER = struct.Struct("<8sHBBII")
+_COMPILED_ALPHABETS: Tuple[Literal["x-sampa", "ipa"], ...] = ("x-sampa", "ipa")
+_COMPILED_SECTIONS = (
+    "phone_offsets",
+    "phones",
+    "key_offsets",
+    "keys",
+    "pron_offsets",
+    "prons",
+    "stressed_offsets",
+    "stressed",
+)
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def compile_lexicon(
+    lex_path: Path,
+    out_path: Path,
+    alphabet: Literal["x-sampa", "ipa"],
+    precompute_stress: bool = False,
+) -> int:
+    """Compile a Kaldi style lexicon to the format read by MmapLexicon.
+
+    Args:
+      lex_path: Path to the Kaldi style lexicon.
+      out_path: Path to write the compiled lexicon to.
+      alphabet: The alphabet of the lexicon.
+      precompute_stress: Include syllabified X-SAMPA with stress labels for each
+          entry, see SimpleInMemoryLexicon.
+
+    Returns:
+      The number of entries in the compiled lexicon.
+    """
+    if sys.byteorder != "little":
+        raise RuntimeError(
+            "Compiled lexicons are only supported on little endian hosts"
+        )
+
+    lexicon = SimpleInMemoryLexicon(
+        lex_path, alphabet, precompute_stress=precompute_stress
+    )
+    # pylint: disable=protected-access
+    prons_by_grapheme, stressed_by_grapheme = lexicon._lexicon, lexicon._stressed
+    # Sorted by their UTF-8 encoding, which is what lookups compare
+    entries = sorted(
+        (grapheme.encode("utf-8"), grapheme) for grapheme in prons_by_grapheme
+    )
+
+    phone_ids: Dict[str, int] = {}
+
+    def encode_pron(pron: PhoneSeq) -> List[int]:
+        return [phone_ids.setdefault(phone, len(phone_ids)) for phone in pron]
+
+    key_offsets, keys = array("I", [0]), bytearray()
+    pron_offsets, prons = array("I", [0]), array("H")
+    stressed_offsets, stressed = array("I", [0]), array("H")
+    for key, grapheme in entries:
+        keys.extend(key)
+        key_offsets.append(len(keys))
+        prons.extend(encode_pron(prons_by_grapheme[grapheme]))
+        pron_offsets.append(len(prons))
+        if precompute_stress:
+            stressed.extend(encode_pron(stressed_by_grapheme.get(grapheme, [])))
+            stressed_offsets.append(len(stressed))
+    if len(phone_ids) > 2**16:
+        raise ValueError("Too many distinct phones for a compiled lexicon")
+
+    phone_offsets, phones = array("I", [0]), bytearray()
+    for phone in phone_ids:
+        phones.extend(phone.encode("utf-8"))
+        phone_offsets.append(len(phones))
+
+    sections = {
+        "phone_offsets": phone_offsets.tobytes(),
+        "phones": bytes(phones),
+        "key_offsets": key_offsets.tobytes(),
+        "keys": bytes(keys),
+        "pron_offsets": pron_offsets.tobytes(),
+        "prons": prons.tobytes(),
+        "stressed_offsets": stressed_offsets.tobytes() if precompute_stress else b"",
+        "stressed": stressed.tobytes(),
+    }
+    section_table = struct.Struct(f"<{2 * len(_COMPILED_SECTIONS)}Q")
+
+    offset = _align(_COMPILED_HEADER.size + section_table.size)
+    positions: List[int] = []
+    for name in _COMPILED_SECTIONS:
+        positions.extend((offset, len(sections[name])))
+        offset = _align(offset + len(sections[name]))
+
+    with out_path.open("wb") as out_f:
+        out_f.write(
+            _COMPILED_HEADER.pack(
+                _COMPILED_MAGIC,
+                _COMPILED_VERSION,
+                _COMPILED_ALPHABETS.index(alphabet),
+                precompute_stress,
+                len(entries),
+                len(phone_ids),
+            )
+        )
+        out_f.write(section_table.pack(*positions))
+        for name, position in zip(_COMPILED_SECTIONS, positions[::2]):
+            out_f.write(b"\0" * (position - out_f.tell()))
+            out_f.write(sections[name])
+    return len(entries)
+
+
+class MmapLexicon(LexiconBase):
+    """A read-only lexicon compiled with compile_lexicon and memory mapped.
+
+    Lookups are a binary search over the sorted keys in the file, with the
+    pronunciations stored as indices into a table of phones. Only the pages that are
+    used are read, and they are shared through the page cache by every process
+    using the same file, unlike a SimpleInMemoryLexicon which each process holds as
+    Python objects.
+
+    Inserted entries are kept in memory and take precedence over the file.
+    """
+
+    _mmap: mmap.mmap
+    _native_alphabet: Literal["x-sampa", "ipa"]
+    _n_entries: int
+    _phones: List[str]
+    _key_offsets: Sequence[int]
+    _keys_start: int
+    _pron_offsets: Sequence[int]
+    _prons: Sequence[int]
+    _stressed_offsets: Optional[Sequence[int]]
+    _stressed: Sequence[int]
+    _inserted: Dict[str, PhoneSeq]
+
+    def __init__(self, lex_path: Path):
+        if sys.byteorder != "little":
+            raise RuntimeError(
+                "Compiled lexicons are only supported on little endian hosts"
+            )
+        with lex_path.open("rb") as lex_f:
+            self._mmap = mmap.mmap(lex_f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            version,
+            alphabet,
+            has_stressed,
+            self._n_entries,
+            n_phones,
+        ) = _COMPILED_HEADER.unpack_from(self._mmap)
+        if magic != _COMPILED_MAGIC or version != _COMPILED_VERSION:
+            raise ValueError(f"{lex_path} is not a compiled lexicon")
+        self._native_alphabet = _COMPILED_ALPHABETS[alphabet]
+
+        positions = struct.unpack_from(
+            f"<{2 * len(_COMPILED_SECTIONS)}Q", self._mmap, _COMPILED_HEADER.size
+        )
+        view = memoryview(self._mmap)
+        sections = {
+            name: view[start : start + length]
+            for name, start, length in zip(
+                _COMPILED_SECTIONS, positions[::2], positions[1::2]
+            )
+        }
+        self._keys_start = positions[2 * _COMPILED_SECTIONS.index("keys")]
+
+        phone_offsets = sections["phone_offsets"].cast("I")
+        phones = bytes(sections["phones"])
+        self._phones = [
+            phones[phone_offsets[idx] : phone_offsets[idx + 1]].decode("utf-8")
+            for idx in range(n_phones)
+        ]
+        self._key_offsets = sections["key_offsets"].cast("I")
+        self._pron_offsets = sections["pron_offsets"].cast("I")
+        self._prons = sections["prons"].cast("H")
+        self._stressed_offsets = (
+            sections["stressed_offsets"].cast("I") if has_stressed else None
+        )
+        self._stressed = sections["stressed"].cast("H")
+        self._inserted = {}
+
+    def _find(self, grapheme: str) -> Optional[int]:
+        """Get the index of grapheme in the file, or None if it isn't there."""
+        if not isinstance(grapheme, str):
+            return None
+        key = grapheme.encode("utf-8")
+        lo, hi = 0, self._n_entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self._mmap[
+                self._keys_start
+                + self._key_offsets[mid] : self._keys_start
+                + self._key_offsets[mid + 1]
+            ]
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def _lookup(self, grapheme: str) -> PhoneSeq:
+        """Get the phonemes of grapheme in the native alphabet."""
+        if grapheme in self._inserted:
+            return self._inserted[grapheme]
+        idx = self._find(grapheme)
+        if idx is None:
+            return []
+        return [
+            self._phones[phone_id]
+            for phone_id in self._prons[
+                self._pron_offsets[idx] : self._pron_offsets[idx + 1]
+            ]
+        ]
+
+    def insert(self, entry: LexWord) -> None:
+        """Insert a new entry into to lexicon."""
+        self._inserted[entry.grapheme] = entry.phoneme
+
+    def get(
+        self,
+        grapheme: str,
+        default: Optional[PhoneSeq] = None,
+        properties: Optional[LexWord.Properties] = None,
+    ) -> PhoneSeq:
+        phoneme = self._lookup(grapheme)
+        if not phoneme:
+            return default or []
+        if self._native_alphabet != "ipa":
+            phoneme = convert_xsampa_to_ipa(phoneme)
+        return phoneme
+
+    def get_xsampa(
+        self,
+        grapheme: str,
+        default: Optional[PhoneSeq] = None,
+        properties: Optional[LexWord.Properties] = None,
+    ) -> PhoneSeq:
+        phoneme = self._lookup(grapheme)
+        if not phoneme:
+            return default or []
+        if self._native_alphabet != "x-sampa":
+            phoneme = convert_ipa_to_xsampa(phoneme)
+        return phoneme
+
+    def get_xsampa_with_stress(
+        self,
+        grapheme: str,
+        default: Optional[PhoneSeq] = None,
+        properties: Optional[LexWord.Properties] = None,
+    ) -> PhoneSeq:
+        if self._stressed_offsets is not None and grapheme not in self._inserted:
+            idx = self._find(grapheme)
+            if idx is not None:
+                stressed = [
+                    self._phones[phone_id]
+                    for phone_id in self._stressed[
+                        self._stressed_offsets[idx] : self._stressed_offsets[idx + 1]
+                    ]
+                ]
+                if stressed:
+                    return stressed
+        return super().get_xsampa_with_stress(grapheme, default, properties)
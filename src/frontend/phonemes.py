@@ -11,9 +11,10 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
 import os
 import sys
-from typing import List, Literal
+from typing import List, Literal, Sequence, Tuple
 
 import ice_g2p.stress
 import ice_g2p.syllab_stress_processing
@@ -210,16 +211,49 @@ def convert_xsampa_to_xsampa_with_stress(phoneme: PhoneSeq, word: str) -> PhoneS
     if not phoneme:
         return []
 
-    phoneme = [ph for ph in phoneme if ph != "sp"]
+    # Memoized, the same words and embedded phonemes come up again and again
+    return list(_xsampa_with_stress(tuple(phoneme), word))
+
+
+@functools.lru_cache(maxsize=2**16)
+def _xsampa_with_stress(phoneme: Tuple[str, ...], word: str) -> Tuple[str, ...]:
+    return tuple(convert_xsampa_to_xsampa_with_stress_batch([(word, list(phoneme))])[0])
+
+
+def convert_xsampa_to_xsampa_with_stress_batch(
+    entries: Sequence[Tuple[str, PhoneSeq]]
+) -> List[PhoneSeq]:
+    """Syllabify and add stress labels to the X-SAMPA phonemes of many words at once.
+
+    Args:
+      entries: Pairs of distinct words and their X-SAMPA phonemes
+
+    Returns:
+      The stressed and syllabified phonemes of each entry, in the same order. Entries
+      without phonemes stay empty.
+    """
+    non_empty = [
+        (idx, word, [ph for ph in phoneme if ph != "sp"])
+        for idx, (word, phoneme) in enumerate(entries)
+        if phoneme
+    ]
+    results: List[PhoneSeq] = [[] for _ in entries]
+    if not non_empty:
+        return results
 
     # From here: https://github.com/grammatek/ice-g2p/blob/d318f91/src/ice_g2p/transcriber.py#L53
-    entries = ice_g2p.syllab_stress_processing.init_pron_dict_from_tuples(
-        [(word, " ".join(phoneme))], syllab_symbol="."
+    pron_dict = ice_g2p.syllab_stress_processing.init_pron_dict_from_tuples(
+        [(word, " ".join(phoneme)) for _, word, phoneme in non_empty],
+        syllab_symbol=".",
+    )
+    syllabified_dict = ice_g2p.syllab_stress_processing.syllabify_and_label(pron_dict)
+    stressed = ice_g2p.stress.set_stress(
+        [syllabified_dict[word] for _, word, _ in non_empty]
     )
-    syllabified_dict = ice_g2p.syllab_stress_processing.syllabify_and_label(entries)
-    stressed = ice_g2p.stress.set_stress([syllabified_dict[word]])
 
-    return stressed[0].simple_stress_format().split()
+    for (idx, _, _), entry in zip(non_empty, stressed):
+        results[idx] = entry.simple_stress_format().split()
+    return results
 
 
 def align_ipa_from_xsampa(phoneme_string: str) -> str:
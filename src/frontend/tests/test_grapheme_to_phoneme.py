@@ -1,7 +1,18 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import ice_g2p.transcriber
 import pytest
 
-from src.frontend.grapheme_to_phoneme import IceG2PTranslator
+from src.frontend.grapheme_to_phoneme import (
+    ComposedTranslator,
+    GraphemeToPhonemeTranslatorBase,
+    IceG2PTranslator,
+    MemoizedTranslator,
+)
 from src.frontend.words import LangID, Word
+from src.utils.cache import LRUCache
 
 
 @pytest.fixture()
@@ -115,3 +126,116 @@ class TestIceG2PTranslator:
         # The version hash is something that looks like a sha1 hash
         assert isinstance(self._translator.version_hash, str)
         assert len(self._translator.version_hash) == 40
+
+
+class CountingTranslator(GraphemeToPhonemeTranslatorBase):
+    calls: List[str]
+
+    def __init__(self, known: str = ""):
+        self.calls = []
+        self._known = known
+
+    def translate(self, text, lang, alphabet="ipa"):
+        self.calls.append(text)
+        if self._known and text not in self._known.split():
+            return []
+        return list(text)
+
+    @property
+    def version_hash(self) -> str:
+        return "counting"
+
+
+class TestMemoizedTranslator:
+    _lang = LangID("is-IS")
+
+    def test_translate_words(self):
+        backend = CountingTranslator()
+        translator = MemoizedTranslator(backend, LRUCache(max_size=100))
+        words = [Word(original_symbol=w, symbol=w) for w in ("og", "að", "og")]
+
+        output = list(translator.translate_words(words, self._lang, alphabet="ipa"))
+        assert [word.phone_sequence for word in output] == [
+            ["o", "g"],
+            ["a", "ð"],
+            ["o", "g"],
+        ]
+        assert backend.calls == ["og", "að"]
+        assert translator.cache.misses == 2
+
+        list(translator.translate_words(words, self._lang, alphabet="ipa"))
+        assert backend.calls == ["og", "að"]
+        assert translator.cache.hits == 2
+
+        # The alphabet is part of the key
+        translator.translate("og", self._lang, alphabet="x-sampa")
+        assert backend.calls == ["og", "að", "og"]
+
+    def test_seed(self):
+        backend = CountingTranslator()
+        translator = MemoizedTranslator(backend, LRUCache(max_size=100))
+        translator.seed(["og", "að"], self._lang, alphabet="ipa")
+        assert translator.translate("að", self._lang, alphabet="ipa") == ["a", "ð"]
+        assert backend.calls == ["og", "að"]
+
+    def test_cached_translation_is_copied(self):
+        translator = MemoizedTranslator(CountingTranslator(), LRUCache(max_size=100))
+        translator.translate("og", self._lang).append("x")
+        assert translator.translate("og", self._lang) == ["o", "g"]
+
+
+class TestTranslateBatch:
+    _lang = LangID("is-IS")
+
+    def test_translate_words_translates_distinct_words(self):
+        translator = CountingTranslator()
+        words = [
+            Word(original_symbol=w, symbol=w) for w in ("og", "að,", "og", "að")
+        ]
+        output = list(translator.translate_words(words, self._lang, alphabet="ipa"))
+        assert [word.phone_sequence for word in output] == [
+            ["o", "g"],
+            ["a", "ð", ","],
+            ["o", "g"],
+            ["a", "ð"],
+        ]
+        assert translator.calls == ["og", "að", ","]
+
+    def test_composed_translator_falls_back(self):
+        lexicon = CountingTranslator(known="og")
+        backoff = CountingTranslator()
+        translator = ComposedTranslator(lexicon, backoff)
+        assert translator.translate_batch(["og", "að"], self._lang) == [
+            ["o", "g"],
+            ["a", "ð"],
+        ]
+        assert backoff.calls == ["að"]
+
+
+class FakeTranscriber:
+    def __init__(self, use_dict: bool, syllab_symbol: str, stress_label: bool):
+        self.syllab_symbol = syllab_symbol
+
+    def transcribe(self, text: str) -> str:
+        syllab_symbol = self.syllab_symbol
+        # Give other threads a chance to interfere
+        time.sleep(0.001)
+        return f"{text} {syllab_symbol}"
+
+
+class TestIceG2PTranslatorConcurrency:
+    def test_concurrent_alphabets(self, monkeypatch):
+        monkeypatch.setattr(ice_g2p.transcriber, "Transcriber", FakeTranscriber)
+        translator = IceG2PTranslator()
+        lang = LangID("is-IS")
+
+        def translate(idx: int):
+            alphabet = "x-sampa+syll+stress" if idx % 2 else "x-sampa"
+            return alphabet, translator.translate(f"orð{idx}", lang, alphabet=alphabet)
+
+        with ThreadPoolExecutor(4) as executor:
+            for alphabet, phones in executor.map(translate, range(40)):
+                if alphabet == "x-sampa+syll+stress":
+                    assert phones[-1] == "."
+                else:
+                    assert len(phones) == 1
@@ -0,0 +1,102 @@
+import argparse
+from pathlib import Path
+
+import pytest
+
+from src.scripts import compile_lexicon as compile_lexicon_script
+
+from .. import grapheme_to_phoneme, lexicon
+from ..grapheme_to_phoneme import LexiconGraphemeToPhonemeTranslator
+from ..lexicon import LexWord, MmapLexicon, SimpleInMemoryLexicon, compile_lexicon
+
+_LEXICON = """\
+maður m a: D Y r
+og O: G
+kona k_h O: n a
+ást au s t
+á au:
+"""
+
+
+@pytest.fixture
+def lex_path(tmp_path: Path) -> Path:
+    lex_path = tmp_path / "lexicon.txt"
+    lex_path.write_text(_LEXICON, encoding="utf-8")
+    return lex_path
+
+
+class TestMmapLexicon:
+    def test_same_as_in_memory(self, lex_path: Path, tmp_path: Path):
+        compiled_path = tmp_path / "lexicon.bin"
+        assert compile_lexicon(lex_path, compiled_path, "x-sampa") == 5
+
+        lexicon = MmapLexicon(compiled_path)
+        reference = SimpleInMemoryLexicon(lex_path, "x-sampa")
+        for grapheme in ("maður", "og", "kona", "ást", "á", "", "kon", "konan", 1):
+            assert lexicon.get(grapheme) == reference.get(grapheme)
+            assert lexicon.get_xsampa(grapheme) == reference.get_xsampa(grapheme)
+        assert lexicon.get_xsampa("kona") == ["k_h", "O:", "n", "a"]
+
+    def test_insert(self, lex_path: Path, tmp_path: Path):
+        compiled_path = tmp_path / "lexicon.bin"
+        compile_lexicon(lex_path, compiled_path, "x-sampa")
+
+        lexicon = MmapLexicon(compiled_path)
+        lexicon.insert(LexWord("kona", ["k_h", "O", "n", "a"]))
+        lexicon.insert(LexWord("hús", ["h", "u:", "s"]))
+        assert lexicon.get_xsampa("kona") == ["k_h", "O", "n", "a"]
+        assert lexicon.get_xsampa("hús") == ["h", "u:", "s"]
+
+    def test_precomputed_stress(self, lex_path: Path, tmp_path: Path):
+        compiled_path = tmp_path / "lexicon.bin"
+        compile_lexicon(lex_path, compiled_path, "x-sampa", precompute_stress=True)
+
+        lexicon = MmapLexicon(compiled_path)
+        reference = SimpleInMemoryLexicon(lex_path, "x-sampa", precompute_stress=True)
+        for grapheme in ("maður", "og", "kona", "ást", "á", "kon"):
+            assert lexicon.get_xsampa_with_stress(
+                grapheme
+            ) == reference.get_xsampa_with_stress(grapheme)
+
+    def test_not_compiled(self, lex_path: Path):
+        with pytest.raises(ValueError):
+            MmapLexicon(lex_path)
+
+
+class TestLexiconGraphemeToPhonemeTranslator:
+    def test_precomputed_stress_of_capitalized_word(self, lex_path: Path, monkeypatch):
+        monkeypatch.setattr(
+            lexicon,
+            "convert_xsampa_to_xsampa_with_stress_batch",
+            lambda entries: [[f"{phone}1" for phone in pron] for _, pron in entries],
+        )
+
+        def syllabify(phones, word):
+            raise AssertionError(f"'{word}' should have a precomputed stressed form")
+
+        monkeypatch.setattr(
+            grapheme_to_phoneme, "convert_xsampa_to_xsampa_with_stress", syllabify
+        )
+        translator = LexiconGraphemeToPhonemeTranslator(
+            lex_path, "is-IS", "x-sampa", precompute_stress=True
+        )
+        assert translator.translate("Kona", "is-IS", "x-sampa+syll+stress") == [
+            "k_h1",
+            "O:1",
+            "n1",
+            "a1",
+        ]
+
+
+def test_compile_lexicon_script(lex_path: Path, tmp_path: Path):
+    compiled_path = tmp_path / "lexicon.bin"
+    compile_lexicon_script.main(
+        argparse.Namespace(
+            lexicon=lex_path,
+            output=compiled_path,
+            alphabet="x-sampa",
+            precompute_stress=False,
+            log_level="INFO",
+        )
+    )
+    assert MmapLexicon(compiled_path).get_xsampa("og") == ["O:", "G"]
@@ -274,3 +274,14 @@ class TestSimpleInMemoryLexicon:
 
         # Assert that the insertion overwrote the existing entry
         assert self._lexicon.get_xsampa(insertion_grapheme) == insertion_phoneme
+
+    # === get_xsampa_with_stress tests start here ===
+
+    def test_precomputed_stress(self):
+        precomputed = SimpleInMemoryLexicon(
+            lex_path=self._lex_path, alphabet=self._alphabet, precompute_stress=True
+        )
+        for grapheme in ("útlendingastofnun", "bollaleggingar", "dvergasúpa"):
+            assert precomputed.get_xsampa_with_stress(
+                grapheme
+            ) == self._lexicon.get_xsampa_with_stress(grapheme)
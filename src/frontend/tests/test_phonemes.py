@@ -1,11 +1,17 @@
+import ice_g2p.stress
+import ice_g2p.syllab_stress_processing
+import pytest
 from pytest import raises
 
 from ..phonemes import (
     SHORT_PAUSE,
     _align_ipa,
+    _xsampa_with_stress,
     align_ipa_from_xsampa,
     convert_ipa_to_xsampa,
     convert_xsampa_to_ipa,
+    convert_xsampa_to_xsampa_with_stress,
+    convert_xsampa_to_xsampa_with_stress_batch,
 )
 
 
@@ -150,3 +156,48 @@ class TestAlignIpa:
     def test_toad_xsampa(self):
         with raises(ValueError):
             _align_ipa("tO:a:D")
+
+
+class FakeStressEntry:
+    def __init__(self, transcript: str):
+        self.transcript = transcript
+
+    def simple_stress_format(self) -> str:
+        return " ".join(f"{phone}1" for phone in self.transcript.split())
+
+
+class TestConvertXsampaToXsampaWithStress:
+    @pytest.fixture
+    def syllabify_calls(self, monkeypatch):
+        calls = []
+
+        def syllabify_and_label(entries):
+            calls.append([word for word, _ in entries])
+            return {word: FakeStressEntry(transcript) for word, transcript in entries}
+
+        monkeypatch.setattr(
+            ice_g2p.syllab_stress_processing,
+            "init_pron_dict_from_tuples",
+            lambda tuples, syllab_symbol: list(tuples),
+        )
+        monkeypatch.setattr(
+            ice_g2p.syllab_stress_processing, "syllabify_and_label", syllabify_and_label
+        )
+        monkeypatch.setattr(ice_g2p.stress, "set_stress", lambda entries: entries)
+        _xsampa_with_stress.cache_clear()
+        yield calls
+        _xsampa_with_stress.cache_clear()
+
+    def test_batch(self, syllabify_calls):
+        output = convert_xsampa_to_xsampa_with_stress_batch(
+            [("og", ["O:", "sp", "G"]), ("tómt", []), ("að", ["a:", "D"])]
+        )
+        assert output == [["O:1", "G1"], [], ["a:1", "D1"]]
+        assert syllabify_calls == [["og", "að"]]
+
+    def test_memoized(self, syllabify_calls):
+        for _ in range(3):
+            output = convert_xsampa_to_xsampa_with_stress(["O:", "G"], "og")
+            assert output == ["O:1", "G1"]
+            output.append("x")
+        assert syllabify_calls == [["og"]]
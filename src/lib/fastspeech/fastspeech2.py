@@ -112,6 +112,65 @@ class FastSpeech2(nn.Module):
 
         return mel_postnet, d_prediction
 
+    @torch.jit.export
+    def batch_inference(
+        self,
+        src_seq: torch.Tensor,
+        src_len: torch.Tensor,
+        d_control: float = 1.0,
+        p_control: float = 1.0,
+        e_control: float = 1.0,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Run inference on a zero padded batch of phone sequences
+
+        Args:
+          src_seq: A (batch, max(src_len)) tensor of zero padded phone IDs
+          src_len: The unpadded length of each sequence in src_seq
+
+        Returns:
+          A tuple of tensors (mel_postnet, duration_prediction, mel_len), where only
+          the first mel_len[i] frames of mel_postnet[i] are valid.
+        """
+        mel_len: Optional[torch.Tensor] = None
+        d_target: Optional[torch.Tensor] = None
+        p_target: Optional[torch.Tensor] = None
+        e_target: Optional[torch.Tensor] = None
+        max_src_len: Optional[int] = None
+        max_mel_len: Optional[int] = None
+
+        _, mel_postnet, d_prediction, _, _, _, _, mel_len_out = self.forward(
+            src_seq,
+            src_len,
+            mel_len,
+            d_target,
+            p_target,
+            e_target,
+            max_src_len,
+            max_mel_len,
+            d_control,
+            p_control,
+            e_control,
+        )
+
+        return mel_postnet, d_prediction, mel_len_out
+
+    @torch.jit.export
+    def durations_only(self, src_seq: torch.Tensor) -> torch.Tensor:
+        """Run only the encoder and the duration predictor
+
+        This is enough to compute timings (e.g. for speech marks), without the cost of
+        the length regulator, the decoder and the postnet.
+
+        Returns:
+          The log duration prediction, before any duration control is applied
+        """
+        src_len = torch.tensor([src_seq.shape[1]])
+        max_src_len: Optional[int] = None
+        src_mask = get_mask_from_lengths(src_len, max_src_len)
+
+        encoder_output = self.encoder(src_seq, src_mask)
+        return self.variance_adaptor.duration_predictor(encoder_output, src_mask)
+
     @torch.jit.export
     def mobile_inference(
         self,
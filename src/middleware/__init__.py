@@ -11,4 +11,5 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from src.middleware.asgi import AsyncWsgiAdapter
 from src.middleware.request_id import RequestIdWrapper
@@ -0,0 +1,197 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import contextvars
+import io
+import sys
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+_DONE = object()
+
+
+class AsyncWsgiAdapter:
+    """ASGI application serving a WSGI app, e.g. Flask, from an executor
+
+    Example usage:
+    >>> app = init_app()
+    >>> asgi_app = AsyncWsgiAdapter(app, ThreadPoolExecutor(8))
+
+    The WSGI app and the iteration of its responses, i.e. the synthesis of a
+    streaming response, run on the executor. The response chunks are sent to the
+    client from the event loop, with the next chunk being produced while the
+    previous one is sent. A slow client therefore only holds a coroutine and at most
+    a chunk of read-ahead, not an executor thread, and the size of the executor
+    bounds the number of concurrent syntheses regardless of the number of
+    connections.
+
+    Streaming stops once the client disconnects.
+
+    """
+
+    _wsgi_app: Callable
+    _executor: Executor
+    _max_body_bytes: Optional[int]
+
+    def __init__(
+        self,
+        wsgi_app: Callable,
+        executor: Executor,
+        max_body_bytes: Optional[int] = None,
+    ):
+        self._wsgi_app = wsgi_app
+        self._executor = executor
+        self._max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope: Dict[str, Any], receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope type '{scope['type']}'")
+
+        body = await self._read_body(receive)
+        if body is None:
+            await send({"type": "http.response.start", "status": 413, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        try:
+            await self._respond(_environ(scope, body), send, disconnected)
+        finally:
+            disconnected.cancel()
+
+    async def _respond(
+        self, environ: Dict[str, Any], send, disconnected: asyncio.Future
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        # Flask keeps its request context in context variables, so every call for
+        # this request has to run in the same context, whichever thread runs it
+        context = contextvars.copy_context()
+
+        def run(fn: Callable, *args) -> asyncio.Future:
+            return loop.run_in_executor(self._executor, context.run, fn, *args)
+
+        response_start: Dict[str, Any] = {}
+
+        def start_response(
+            status: str, headers: List[Tuple[str, str]], exc_info=None
+        ) -> Callable:
+            response_start.update(
+                type="http.response.start",
+                status=int(status.split(" ", 1)[0]),
+                headers=[
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers
+                ],
+            )
+            return _unsupported_write
+
+        result = await run(self._wsgi_app, environ, start_response)
+        next_chunk: Optional[asyncio.Future] = None
+        try:
+            chunks = iter(result)
+            chunk = await run(next, chunks, _DONE)
+            await send(response_start)
+            while chunk is not _DONE and not disconnected.done():
+                # Produce the next chunk while this one is being sent
+                next_chunk = run(next, chunks, _DONE)
+                if chunk:
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+                chunk = await next_chunk
+                next_chunk = None
+            if not disconnected.done():
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            if next_chunk is not None:
+                # The response can't be closed while a chunk is being produced
+                await asyncio.wait([next_chunk])
+            if hasattr(result, "close"):
+                await run(result.close)
+
+    async def _read_body(self, receive) -> Optional[bytes]:
+        """Read the request body, returning None if it's too large."""
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            body.extend(message.get("body", b""))
+            if self._max_body_bytes is not None and len(body) > self._max_body_bytes:
+                return None
+            if not message.get("more_body", False):
+                break
+        return bytes(body)
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self._executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+async def _wait_for_disconnect(receive) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+def _unsupported_write(data: bytes) -> None:
+    raise NotImplementedError("The WSGI write callable is not supported")
+
+
+def _environ(scope: Dict[str, Any], body: bytes) -> Dict[str, Any]:
+    """Create a WSGI environ for an ASGI HTTP scope, see PEP 3333."""
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = (
+            scope["client"][0],
+            str(scope["client"][1]),
+        )
+
+    for raw_name, raw_value in scope.get("headers", []):
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name == "CONTENT_LENGTH":
+            continue
+        if name == "CONTENT_TYPE":
+            environ[name] = value
+            continue
+        name = "HTTP_" + name
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    # The body has been read in full
+    environ["CONTENT_LENGTH"] = str(len(body))
+    return environ
@@ -24,6 +24,10 @@ class Project(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
     name = db.Column(db.String, nullable=False)
     description = db.Column(db.String, nullable=True)
+    # Synthesis priority of the project's requests, "interactive" or "bulk"
+    priority = db.Column(
+        db.String, nullable=False, default="interactive", server_default="interactive"
+    )
     created_at = db.Column(db.DateTime, nullable=False)
     updated_at = db.Column(db.DateTime, nullable=False)
 
@@ -39,13 +43,16 @@ class Project(db.Model):
     )
 
     @staticmethod
-    def create(user_id: int, name: str, description: str):
+    def create(
+        user_id: int, name: str, description: str, priority: str = "interactive"
+    ):
         """Adds a new entry to the table."""
         db.session.add(
             Project(
                 user_id=user_id,
                 name=name,
                 description=description,
+                priority=priority,
                 created_at=datetime.utcnow(),
                 updated_at=datetime.utcnow(),
             )
@@ -23,6 +23,29 @@ class SynthesizeSpeechRequest(Schema):
         description="Specify which engine to use",
         validate=validate.OneOf(["standard"]),
     )
+    IncludeSpeechMarks = fields.Bool(
+        required=False,
+        description=textwrap.dedent(
+            """\
+            Return word speech marks along with the audio, from a single synthesis
+            pass. Only valid for the audio output formats.
+
+            The response is then a stream of JSON lines (`application/x-json-stream`)
+            where the speech marks, as described for `SpeechMarkTypes`, are
+            interleaved with base64 encoded chunks of the audio in `OutputFormat`.
+            The speech marks of a word always come before its audio. E.g.
+
+                {"time": 0, "type": "word", "start": 0, "end": 3, "value": "Hæ"}
+                {"type": "audio", "data": "SUQzBAAAAAAAI1RTU0UAAAAPAAADTGF2ZjU4Lj..."}
+                {"time": 186, "type": "word", "start": 5, "end": 8, "value": "Ég"}
+                {"type": "audio", "data": "//NkxAAAAANIAAAAAExBTUUzLjEwMFVVVVVV..."}
+
+            Concatenating the decoded audio chunks gives the same audio as a request
+            without IncludeSpeechMarks.
+            """
+        ),
+        example=False,
+    )
     LanguageCode = fields.Str(required=False, example="is-IS")
     LexiconNames = fields.List(
         fields.Str(),
@@ -46,6 +69,19 @@ class SynthesizeSpeechRequest(Schema):
         validate=validate.OneOf(["json", "pcm", "mp3", "ogg_vorbis"]),
         example="pcm",
     )
+    Priority = fields.Str(
+        required=False,
+        description=textwrap.dedent(
+            """\
+            Scheduling priority of the request. Interactive requests, the default,
+            go ahead of bulk requests, whose synthesis is held back between
+            sentences while interactive requests are being synthesized. Requests
+            with an API key of a bulk priority project are always bulk.
+            """
+        ),
+        validate=validate.OneOf(["interactive", "bulk"]),
+        example="interactive",
+    )
     SampleRate = fields.Str(
         required=False,
         description=textwrap.dedent(
@@ -237,6 +273,88 @@ class SynthesizeSpeechRequest(Schema):
     )
 
 
+class SynthesizeSpeechBatchRequest(Schema):
+    Requests = fields.List(
+        fields.Nested(SynthesizeSpeechRequest),
+        required=True,
+        description=textwrap.dedent(
+            """\
+            The synthesis requests of the batch, each with the same parameters as a
+            request to /v0/speech. The requests are synthesized concurrently, so that
+            voices with batched inference can run them through the acoustic model and
+            vocoder together.
+            """
+        ),
+        validate=validate.Length(min=1, max=100),
+    )
+
+
+class SynthesizeSpeechBatchResult(Schema):
+    Index = fields.Int(
+        required=True, description="Index of the request in the batch", example=0
+    )
+    StatusCode = fields.Int(
+        required=True,
+        description="The HTTP status code the request would have had on its own",
+        example=200,
+    )
+    ContentType = fields.Str(required=False, example="audio/mpeg")
+    Content = fields.Str(
+        required=False, description="Base64 encoded audio or speech marks content"
+    )
+    RetryAfter = fields.Int(
+        required=False,
+        description="Seconds to wait before retrying a request rejected with 429/503",
+    )
+    message = fields.Str(required=False, description="Error message for failures")
+
+
+class StartSpeechSynthesisTaskRequest(SynthesizeSpeechRequest):
+    Text = fields.Str(
+        required=True,
+        description=textwrap.dedent(
+            """\
+            Input text to synthesize. Tasks are meant for long-form text, e.g. whole
+            articles or book chapters, which would time out as a regular request.
+            """
+        ),
+        example="Halló! Ég er gervimaður.",
+        validate=validate.Length(min=1, max=100000),
+    )
+
+
+class SynthesisTask(Schema):
+    TaskId = fields.Str(required=True, example="4f1c2b7e0a9d4c3f8e6b5a4d3c2b1a09")
+    TaskStatus = fields.Str(
+        required=True,
+        validate=validate.OneOf(["scheduled", "inProgress", "completed", "failed"]),
+    )
+    TaskStatusReason = fields.Str(
+        required=False, description="Reason for the failure of a failed task"
+    )
+    OutputUri = fields.Str(
+        required=False,
+        description="Where the output of the task can be fetched once completed",
+        example="/v0/speech-tasks/4f1c2b7e0a9d4c3f8e6b5a4d3c2b1a09/output",
+    )
+    CreationTime = fields.Str(required=True, example="2022-06-01T12:00:00+00:00")
+    RequestCharacters = fields.Int(
+        required=True, description="Number of characters in the input text"
+    )
+    Engine = fields.Str(required=False)
+    IncludeSpeechMarks = fields.Bool(required=False)
+    LanguageCode = fields.Str(required=False)
+    OutputFormat = fields.Str(required=True)
+    SampleRate = fields.Str(required=False)
+    SpeechMarkTypes = fields.List(fields.Str(), required=False)
+    TextType = fields.Str(required=False)
+    VoiceId = fields.Str(required=True)
+
+
+class SynthesisTaskResponse(Schema):
+    SynthesisTask = fields.Nested(SynthesisTask)
+
+
 class DescribeVoicesRequest(Schema):
     Engine = fields.Str(
         description="Specify which engine to use",
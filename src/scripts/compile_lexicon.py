@@ -0,0 +1,61 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import logging
+import textwrap
+from pathlib import Path
+
+from src.frontend.lexicon import compile_lexicon
+
+
+def main(args: argparse.Namespace):
+    logging.basicConfig(level=args.log_level)
+
+    n_entries = compile_lexicon(
+        args.lexicon,
+        args.output,
+        alphabet=args.alphabet,
+        precompute_stress=args.precompute_stress,
+    )
+    logging.info("Compiled %d entries to %s", n_entries, args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(
+            """\
+            Compile a Kaldi style lexicon to the memory mapped format used by
+            Lexicon entries with format COMPILED in a synthesis set.
+            """
+        )
+    )
+    parser.add_argument("lexicon", type=Path, help="path to a Kaldi style lexicon")
+    parser.add_argument("output", type=Path, help="path to the compiled lexicon")
+    parser.add_argument(
+        "--alphabet",
+        choices=("x-sampa", "ipa"),
+        default="x-sampa",
+        help="the pronunciation alphabet used in the lexicon",
+    )
+    parser.add_argument(
+        "--precompute-stress",
+        action="store_true",
+        help="include syllabified X-SAMPA with stress labels for each entry",
+    )
+    parser.add_argument(
+        "--log-level", choices=("DEBUG", "INFO", "WARNING", "ERROR"), default="INFO"
+    )
+    args = parser.parse_args()
+
+    main(args)
@@ -193,7 +193,8 @@ def main(args: argparse.Namespace):
         optimized_model._save_for_lite_interpreter(args.output_path)
     else:
         optimized_model = torch.jit.freeze(
-            scripted_model, preserved_attrs=["inference"]
+            scripted_model,
+            preserved_attrs=["inference", "batch_inference", "durations_only"],
         )
         # TODO(rkjaran): Use this once PyTorch actually supports its serialization
         # optimized_model = torch.jit.optimize_for_inference(optimized_model)
@@ -0,0 +1,189 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-process audio encoding using libsndfile, as an alternative to ffmpeg."""
+import functools
+import io
+from typing import Dict, Iterable, Iterator, Literal, Tuple
+
+import numpy as np
+import soundfile
+
+# Output format -> (libsndfile major format, subtype)
+_FORMATS: Dict[str, Tuple[str, str]] = {
+    "ogg_vorbis": ("OGG", "VORBIS"),
+    "mp3": ("MP3", "MPEG_LAYER_III"),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def is_supported(out_format: str) -> bool:
+    """Check whether the installed libsndfile can encode out_format."""
+    if out_format == "pcm":
+        return True
+    if out_format not in _FORMATS:
+        return False
+    major, subtype = _FORMATS[out_format]
+    return major in soundfile.available_formats() and subtype in (
+        soundfile.available_subtypes(major)
+    )
+
+
+# Layer III bitrates in kbps by bitrate index, for MPEG-1 and MPEG-2/2.5
+_MP3_BITRATES = {
+    "mpeg1": (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    "mpeg2": (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG-1
+    2: (22050, 24000, 16000),  # MPEG-2
+    0: (11025, 12000, 8000),  # MPEG-2.5
+}
+
+
+def _strip_mp3_info_frame(content: bytes) -> bytes:
+    """Remove a leading Xing/Info frame from MP3 content.
+
+    LAME reserves the first frame for a Xing/Info tag with the length of the stream,
+    which is filled in when the file is closed. A streamed response can't be updated
+    after the fact, so the (still empty) frame is dropped. This matches what ffmpeg
+    does when writing MP3 to a pipe.
+
+    """
+    if len(content) < 4 or content[0] != 0xFF or content[1] & 0xE0 != 0xE0:
+        return content
+    version = (content[1] >> 3) & 0x3
+    bitrate_idx = content[2] >> 4
+    sample_rate_idx = (content[2] >> 2) & 0x3
+    if version == 1 or bitrate_idx in (0, 15) or sample_rate_idx == 3:
+        return content
+
+    bitrate = _MP3_BITRATES["mpeg1" if version == 3 else "mpeg2"][bitrate_idx]
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_idx]
+    padding = (content[2] >> 1) & 0x1
+    frame_len = (144 if version == 3 else 72) * bitrate * 1000 // sample_rate + padding
+
+    frame = content[:frame_len]
+    if len(frame) == frame_len and (
+        not any(frame[4:]) or b"Xing" in frame or b"Info" in frame
+    ):
+        return content[frame_len:]
+    return content
+
+
+class _StreamWriter:
+    """A write-only file object that hands out the written bytes as they arrive.
+
+    Bytes that have already been handed out are dropped, so memory usage doesn't grow
+    with the length of the stream. Writes to an already handed out position (e.g. a
+    header updated when the file is closed) are ignored.
+
+    """
+
+    _pending: bytearray
+    _pos: int
+    _sent: int
+
+    def __init__(self):
+        self._pending = bytearray()
+        self._pos = 0
+        self._sent = 0
+
+    def write(self, data: bytes) -> int:
+        size = len(data)
+        skip = min(size, max(self._sent - self._pos, 0))
+        self._pos += skip
+        data = data[skip:]
+
+        offset = self._pos - self._sent
+        if offset > len(self._pending):
+            self._pending.extend(bytes(offset - len(self._pending)))
+        self._pending[offset : offset + len(data)] = data
+        self._pos += len(data)
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._sent + len(self._pending)
+        self._pos = offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        return b""
+
+    def take(self) -> bytes:
+        """Return the bytes written since the last call."""
+        content = bytes(self._pending)
+        self._sent += len(self._pending)
+        self._pending.clear()
+        return content
+
+
+def to_format_stream(
+    chunks: Iterable[bytes],
+    *,
+    out_format: Literal["ogg_vorbis", "mp3", "pcm"],
+    sample_rate: str,
+) -> Iterator[bytes]:
+    """Encode a stream of 16 bit linear PCM chunks in-process
+
+    This has the same semantics as `src.ffmpeg.to_format_stream`, except that
+    resampling is not supported, i.e. the chunks already have to be at sample_rate.
+
+    Args:
+      chunks: Signed 16 bit little endian PCM chunks, e.g. one per synthesized segment
+      out_format: The output format
+      sample_rate: Sample rate of the chunks and the output in Hertz
+
+    Returns:
+      An iterator over chunks of encoded audio content
+
+    Raises:
+      ValueError: if the installed libsndfile can't encode out_format
+
+    """
+    if not is_supported(out_format):
+        raise ValueError(f"Output format '{out_format}' not supported by libsndfile")
+    if out_format == "pcm":
+        return iter(chunks)
+    return _encode(chunks, out_format, int(sample_rate))
+
+
+def _encode(chunks: Iterable[bytes], out_format: str, sample_rate: int):
+    major, subtype = _FORMATS[out_format]
+    writer = _StreamWriter()
+    is_first = True
+    with soundfile.SoundFile(
+        writer,
+        mode="w",
+        samplerate=sample_rate,
+        channels=1,
+        format=major,
+        subtype=subtype,
+    ) as sf:
+        for chunk in chunks:
+            sf.write(np.frombuffer(chunk, dtype="<i2"))
+            content = writer.take()
+            if content and is_first and out_format == "mp3":
+                content = _strip_mp3_info_frame(content)
+            if content:
+                is_first = False
+                yield content
+    content = writer.take()
+    if content:
+        yield content
@@ -0,0 +1,191 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Asynchronous synthesis tasks for long-form text, similar to Polly's
+StartSpeechSynthesisTask.
+
+Tasks are synthesized on a small pool of background threads and the status and
+output of each task are stored as files in a directory, so any worker process
+sharing the directory can report on a task.
+"""
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Literal, Optional
+
+from flask import Flask, current_app
+
+from src.voices import VoiceBase
+from src.voices.admission import OverloadedError
+
+TaskStatus = Literal["scheduled", "inProgress", "completed", "failed"]
+
+# Request parameters that are stored with a task
+_TASK_PARAMS = (
+    "Engine",
+    "IncludeSpeechMarks",
+    "LanguageCode",
+    "OutputFormat",
+    "SampleRate",
+    "SpeechMarkTypes",
+    "TextType",
+    "VoiceId",
+)
+
+
+class SynthesisTaskManager:
+    """Runs synthesis tasks in the background and keeps track of their results.
+
+    For each task there is a JSON file with its status, `<task_id>.json`, and once
+    the task has completed, the synthesized content in `<task_id>.out`. Both are
+    written atomically. Tasks that were running when the process stopped are not
+    resumed.
+
+    """
+
+    _output_dir: Path
+    _executor: ThreadPoolExecutor
+    _max_overload_wait: float
+
+    def __init__(
+        self,
+        output_dir: Path,
+        max_workers: int = 1,
+        max_overload_wait_ms: int = 600000,
+    ):
+        """Initialize a SynthesisTaskManager.
+
+        Args:
+          output_dir: Directory for the status and output of tasks, created if it
+              doesn't exist
+          max_workers: Number of tasks synthesized concurrently. Keep this low, the
+              tasks share the voices (and CPU) with interactive requests.
+          max_overload_wait_ms: How long a task waits in total for an overloaded
+              voice to have capacity before it fails
+
+        """
+        if max_workers < 1:
+            raise ValueError("max_workers has to be positive")
+        self._output_dir = output_dir
+        self._output_dir.mkdir(parents=True, exist_ok=True)
+        self._max_overload_wait = max_overload_wait_ms / 1000
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="synthesis-task"
+        )
+
+    def start(
+        self, voice: VoiceBase, text: str, ssml: bool = False, **kwargs
+    ) -> Dict[str, Any]:
+        """Schedule synthesis of text with voice.
+
+        Has to be called within a Flask app context, which is then also used for the
+        synthesis.
+
+        Args:
+          voice: The voice to synthesize with
+          text: Text or SSML to synthesize
+          ssml: Whether text is SSML
+          kwargs: Parameters of the synthesis request, as passed to `voice.synthesize`
+
+        Returns:
+          The newly scheduled task
+
+        """
+        task_id = uuid.uuid4().hex
+        task = {
+            "TaskId": task_id,
+            "TaskStatus": "scheduled",
+            "CreationTime": datetime.now(timezone.utc).isoformat(),
+            "RequestCharacters": len(text),
+            **{key: kwargs[key] for key in _TASK_PARAMS if key in kwargs},
+        }
+        self._write_task(task)
+
+        app: Flask = current_app._get_current_object()  # type: ignore
+        self._executor.submit(self._run, app, task, voice, text, ssml, kwargs)
+        return task
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Get a task by its ID, or None if it doesn't exist."""
+        try:
+            return json.loads(self._task_path(task_id).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def output_path(self, task_id: str) -> Optional[Path]:
+        """Get the path to the output of a completed task, or None."""
+        task = self.get(task_id)
+        if not task or task["TaskStatus"] != "completed":
+            return None
+        return self._output_dir / f"{task_id}.out"
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def _run(
+        self,
+        app: Flask,
+        task: Dict[str, Any],
+        voice: VoiceBase,
+        text: str,
+        ssml: bool,
+        kwargs: Dict[str, Any],
+    ) -> None:
+        task_id = task["TaskId"]
+        self._write_task({**task, "TaskStatus": "inProgress"})
+
+        out_path = self._output_dir / f"{task_id}.out"
+        tmp_path = out_path.with_suffix(".out.tmp")
+        try:
+            with app.app_context():
+                deadline = time.monotonic() + self._max_overload_wait
+                while True:
+                    try:
+                        chunks = voice.synthesize(text, ssml=ssml, **kwargs)
+                        break
+                    except OverloadedError as ex:
+                        # Tasks aren't latency sensitive, wait for the voice to have
+                        # capacity instead of failing, up to the deadline
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise
+                        time.sleep(min(ex.retry_after, remaining))
+                with tmp_path.open("wb") as out_f:
+                    for chunk in chunks:
+                        out_f.write(chunk)
+            os.replace(tmp_path, out_path)
+        except Exception as ex:
+            app.logger.exception("Synthesis task %s failed", task_id)
+            tmp_path.unlink(missing_ok=True)
+            self._write_task(
+                {**task, "TaskStatus": "failed", "TaskStatusReason": str(ex)}
+            )
+            return
+
+        self._write_task({**task, "TaskStatus": "completed"})
+
+    def _task_path(self, task_id: str) -> Path:
+        # Task IDs are hex strings, anything else could escape the output directory
+        if not task_id.isalnum():
+            raise FileNotFoundError(task_id)
+        return self._output_dir / f"{task_id}.json"
+
+    def _write_task(self, task: Dict[str, Any]) -> None:
+        path = self._task_path(task["TaskId"])
+        tmp_path = path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(task, ensure_ascii=False))
+        os.replace(tmp_path, path)
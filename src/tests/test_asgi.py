@@ -0,0 +1,127 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import pytest
+from flask import Flask, Response, current_app, request, stream_with_context
+
+from src.middleware import AsyncWsgiAdapter
+
+
+def make_app() -> Flask:
+    app = Flask(__name__)
+    app.config["CHUNKS"] = 3
+
+    @app.route("/echo", methods=["POST"])
+    def echo():
+        return Response(request.get_data(), content_type="text/plain")
+
+    @app.route("/stream")
+    def stream():
+        def generate():
+            # Requires the request and app contexts during iteration
+            for idx in range(current_app.config["CHUNKS"]):
+                yield f"{request.args['prefix']}{idx}".encode("ascii")
+
+        return Response(stream_with_context(generate()))
+
+    return app
+
+
+class FakeClient:
+    sent: List[Dict[str, Any]]
+
+    def __init__(self, body: bytes = b"", disconnect_after: int = -1):
+        self.sent = []
+        self._body = body
+        self._disconnect_after = disconnect_after
+        self._disconnected = asyncio.Event()
+
+    async def receive(self) -> Dict[str, Any]:
+        if self._body is not None:
+            body, self._body = self._body, None
+            return {"type": "http.request", "body": body, "more_body": False}
+        await self._disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message: Dict[str, Any]) -> None:
+        self.sent.append(message)
+        if len(self.sent) == self._disconnect_after:
+            self._disconnected.set()
+        await asyncio.sleep(0.01)
+
+    @property
+    def body(self) -> bytes:
+        return b"".join(
+            message.get("body", b"")
+            for message in self.sent
+            if message["type"] == "http.response.body"
+        )
+
+
+def http_scope(method: str, path: str, query_string: bytes = b"") -> Dict[str, Any]:
+    return {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query_string,
+        "headers": [(b"content-type", b"text/plain")],
+        "server": ("testserver", 80),
+    }
+
+
+class TestAsyncWsgiAdapter:
+    @pytest.fixture
+    def adapter(self):
+        with ThreadPoolExecutor(2) as executor:
+            yield AsyncWsgiAdapter(make_app(), executor, max_body_bytes=16)
+
+    def test_request_body(self, adapter):
+        client = FakeClient(b"hall\xc3\xb3")
+        asyncio.run(adapter(http_scope("POST", "/echo"), client.receive, client.send))
+        assert client.sent[0]["status"] == 200
+        assert client.body == b"hall\xc3\xb3"
+
+    def test_too_large_body(self, adapter):
+        client = FakeClient(b"x" * 17)
+        asyncio.run(adapter(http_scope("POST", "/echo"), client.receive, client.send))
+        assert client.sent[0]["status"] == 413
+
+    def test_streamed_response(self, adapter):
+        client = FakeClient()
+        asyncio.run(
+            adapter(
+                http_scope("GET", "/stream", b"prefix=x"), client.receive, client.send
+            )
+        )
+        assert client.sent[0]["status"] == 200
+        assert client.body == b"x0x1x2"
+        assert client.sent[-1] == {"type": "http.response.body", "body": b""}
+
+    def test_stops_on_disconnect(self, adapter):
+        client = FakeClient(disconnect_after=2)
+        adapter._wsgi_app.config["CHUNKS"] = 1000
+        asyncio.run(
+            adapter(
+                http_scope("GET", "/stream", b"prefix=x"), client.receive, client.send
+            )
+        )
+        assert len(client.sent) < 10
+
+    def test_not_found(self, adapter):
+        client = FakeClient()
+        asyncio.run(adapter(http_scope("GET", "/nope"), client.receive, client.send))
+        assert client.sent[0]["status"] == 404
@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import base64
 import json
 import os
 from typing import Dict, List
@@ -113,6 +114,65 @@ def test_synthesize_speech_marks_sanity(client):
         assert mark["value"] == original_word
 
 
+def test_synthesize_with_speech_marks_sanity(client):
+    request = {
+        "OutputFormat": "pcm",
+        "SampleRate": "22050",
+        "Text": "Hæ! Ég heiti Gervimaður Finnland, en þú?",
+        "VoiceId": "Alfur",
+    }
+    res = client.post("/v0/speech", json={**request, "IncludeSpeechMarks": True})
+    assert res.content_type == "application/x-json-stream"
+
+    data = res.get_data(as_text=True).split("\n")
+    lines = [json.loads(line) for line in data if line.strip()]
+    assert [line["value"] for line in lines if line["type"] == "word"] == [
+        "Hæ",
+        "Ég",
+        "heiti",
+        "Gervimaður",
+        "Finnland",
+        "en",
+        "þú",
+    ]
+    pcm_data = b"".join(
+        base64.b64decode(line["data"]) for line in lines if line["type"] == "audio"
+    )
+    assert pcm_data == client.post("/v0/speech", json=request).get_data(as_text=False)
+
+
+def test_synthesize_batch_sanity(client):
+    res = client.post(
+        "/v0/speech:batch",
+        json={
+            "Requests": [
+                {
+                    "OutputFormat": "pcm",
+                    "SampleRate": "22050",
+                    "Text": "Hæ! Ég heiti Gervimaður Finnland, en þú?",
+                    "VoiceId": "Alfur",
+                },
+                {
+                    # Speech marks require SpeechMarkTypes
+                    "OutputFormat": "json",
+                    "Text": "Hæ!",
+                    "VoiceId": "Alfur",
+                },
+            ]
+        },
+    )
+    assert res.content_type == "application/x-json-stream"
+
+    data = res.get_data(as_text=True).split("\n")
+    results = sorted(
+        (json.loads(line) for line in data if line.strip()),
+        key=lambda result: result["Index"],
+    )
+    assert [result["StatusCode"] for result in results] == [200, 400]
+    assert results[0]["ContentType"] == "audio/x-wav"
+    assert len(base64.b64decode(results[0]["Content"])) > 4000
+
+
 def test_synthesize_ssml_sanity(client):
     res = client.post(
         "/v0/speech",
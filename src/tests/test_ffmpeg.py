@@ -0,0 +1,76 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import subprocess as sp
+import sys
+import threading
+from typing import List, Tuple
+
+import pytest
+
+from src import ffmpeg
+
+# Copies stdin to stdout, standing in for an ffmpeg process
+_CAT = [
+    sys.executable,
+    "-c",
+    "import shutil, sys; shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)",
+]
+
+
+def _spawn_cat() -> sp.Popen:
+    return sp.Popen(_CAT, stdin=sp.PIPE, stdout=sp.PIPE)
+
+
+class TestStreamThrough:
+    def test_chunks_are_streamed(self):
+        proc = _spawn_cat()
+        content = b"".join(ffmpeg._stream_through(proc, [b"ab", b"cd"], 4096))
+        assert content == b"abcd"
+
+    def test_iterator_failure_is_raised(self):
+        def chunks():
+            yield b"ab"
+            raise ValueError("Non-existent prosody rate specifier")
+
+        proc = _spawn_cat()
+        with pytest.raises(ValueError, match="prosody rate"):
+            b"".join(ffmpeg._stream_through(proc, chunks(), 4096))
+
+
+class TestProcessPool:
+    def _refills(self, pool: ffmpeg._ProcessPool, monkeypatch) -> List[Tuple[str, ...]]:
+        refills: List[Tuple[str, ...]] = []
+        monkeypatch.setattr(pool, "_add_warm", refills.append)
+        return refills
+
+    def _wait_for_refills(self):
+        for thread in threading.enumerate():
+            if thread.name == "ffmpeg-warm":
+                thread.join()
+
+    def test_one_off_args_are_not_warmed(self, monkeypatch):
+        pool = ffmpeg._ProcessPool(warm_processes=2)
+        refills = self._refills(pool, monkeypatch)
+        assert pool._take_warm(["ffmpeg", "-af", "atempo=1.1"]) is None
+        assert pool._take_warm(["ffmpeg", "-af", "atempo=1.2"]) is None
+        self._wait_for_refills()
+        assert refills == []
+
+    def test_repeated_args_are_warmed(self, monkeypatch):
+        pool = ffmpeg._ProcessPool(warm_processes=2)
+        refills = self._refills(pool, monkeypatch)
+        pool._take_warm(["ffmpeg", "-f", "mp3"])
+        pool._take_warm(["ffmpeg", "-f", "mp3"])
+        self._wait_for_refills()
+        assert refills == [("ffmpeg", "-f", "mp3")]
@@ -0,0 +1,82 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+
+import numpy as np
+import pytest
+import soundfile
+
+from src import sndfile
+
+
+def _pcm_chunks(n_chunks: int = 3, sample_rate: int = 16000):
+    t = np.arange(sample_rate // 2) / sample_rate
+    tone = (10000 * np.sin(2 * np.pi * 440 * t)).astype("<i2")
+    return [tone.tobytes() for _ in range(n_chunks)]
+
+
+class TestStreamWriter:
+    def test_take_returns_new_bytes(self):
+        writer = sndfile._StreamWriter()
+        writer.write(b"abc")
+        assert writer.take() == b"abc"
+        writer.write(b"de")
+        assert writer.tell() == 5
+        assert writer.take() == b"de"
+
+    def test_rewrite_of_sent_bytes_is_ignored(self):
+        writer = sndfile._StreamWriter()
+        writer.write(b"abcd")
+        writer.take()
+        writer.write(b"ef")
+        writer.seek(2)
+        writer.write(b"XYZ")
+        assert writer.take() == b"Zf"
+        assert writer.seek(0, io.SEEK_END) == 6
+
+
+class TestToFormatStream:
+    def test_pcm_is_passed_through(self):
+        chunks = _pcm_chunks()
+        encoded = sndfile.to_format_stream(
+            chunks, out_format="pcm", sample_rate="16000"
+        )
+        assert list(encoded) == chunks
+
+    def test_ogg_vorbis_is_a_single_stream(self):
+        content = b"".join(
+            sndfile.to_format_stream(
+                _pcm_chunks(), out_format="ogg_vorbis", sample_rate="16000"
+            )
+        )
+        assert content.count(b"OggS\x00\x02") == 1
+        data, sample_rate = soundfile.read(io.BytesIO(content), dtype="int16")
+        assert sample_rate == 16000
+        assert abs(len(data) - 3 * 8000) < 1000
+
+    @pytest.mark.skipif(
+        not sndfile.is_supported("mp3"), reason="libsndfile without MP3 support"
+    )
+    def test_mp3_has_no_placeholder_frame(self):
+        content = b"".join(
+            sndfile.to_format_stream(
+                _pcm_chunks(), out_format="mp3", sample_rate="16000"
+            )
+        )
+        assert content[0] == 0xFF
+        assert sndfile._strip_mp3_info_frame(content) == content
+
+    def test_unsupported_format(self):
+        with pytest.raises(ValueError):
+            sndfile.to_format_stream([], out_format="flac", sample_rate="16000")
@@ -0,0 +1,62 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+from pathlib import Path
+from typing import Iterable
+
+from flask import Flask, current_app
+
+import synthesize_bulk
+from src.voices.voice_base import OutputFormat, VoiceBase, VoiceProperties
+
+
+class ConfigReadingVoice(VoiceBase):
+    """Reads the app config during synthesis, like the local backends do."""
+
+    def synthesize(self, text: str, ssml: bool = False, **kwargs) -> Iterable[bytes]:
+        yield current_app.config["CONTENT"]
+
+    @property
+    def properties(self) -> VoiceProperties:
+        return VoiceProperties(
+            voice_id="Fake",
+            supported_output_formats=[OutputFormat("pcm", ["22050"])],
+        )
+
+    @property
+    def version_hash(self) -> str:
+        return "fake"
+
+
+def test_items_are_synthesized_in_app_context(tmp_path: Path, monkeypatch):
+    app = Flask(__name__)
+    app.config["CONTENT"] = b"\x01\x00"
+    options = argparse.Namespace(
+        output_dir=tmp_path,
+        output_format="pcm",
+        sample_rate="22050",
+        speech_marks=False,
+        threads=2,
+    )
+    monkeypatch.setattr(synthesize_bulk, "_app", app, raising=False)
+    monkeypatch.setattr(
+        synthesize_bulk, "_voices", {"Fake": ConfigReadingVoice()}, raising=False
+    )
+    monkeypatch.setattr(synthesize_bulk, "_options", options, raising=False)
+
+    results = synthesize_bulk._synthesize_items(
+        [{"Id": "a", "VoiceId": "Fake", "Text": "hæ"}]
+    )
+    assert results == [("a", None)]
+    assert (tmp_path / "a.pcm").read_bytes() == b"\x01\x00"
@@ -0,0 +1,93 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Iterable
+
+import pytest
+from flask import Flask, current_app
+
+from src.tasks import SynthesisTaskManager
+from src.voices import VoiceBase, VoiceProperties
+from src.voices.admission import OverloadedError
+
+REQUEST = {"OutputFormat": "pcm", "SampleRate": "16000", "VoiceId": "Fake"}
+
+
+class FakeVoice(VoiceBase):
+    def synthesize(self, text: str, ssml: bool = False, **kwargs) -> Iterable[bytes]:
+        if current_app.config.get("FAIL"):
+            raise ValueError("synthesis failed")
+        if current_app.config.get("OVERLOADED"):
+            raise OverloadedError("Synthesis queue is full", 429, 1)
+        for word in text.split():
+            yield word.encode("utf-8")
+
+    @property
+    def properties(self) -> VoiceProperties:
+        return VoiceProperties(voice_id="Fake")
+
+    @property
+    def version_hash(self) -> str:
+        return "fake"
+
+
+class TestSynthesisTaskManager:
+    @pytest.fixture
+    def app(self):
+        app = Flask(__name__)
+        with app.app_context():
+            yield app
+
+    @pytest.fixture
+    def tasks(self, tmp_path):
+        tasks = SynthesisTaskManager(tmp_path)
+        yield tasks
+        tasks.shutdown()
+
+    def test_completed_task(self, app, tasks):
+        task = tasks.start(FakeVoice(), "eitt tvö þrjú", **REQUEST)
+        assert task["TaskStatus"] == "scheduled"
+        assert task["RequestCharacters"] == 13
+        tasks.shutdown()
+
+        task = tasks.get(task["TaskId"])
+        assert task["TaskStatus"] == "completed"
+        assert task["OutputFormat"] == "pcm"
+        assert "Text" not in task
+        output = tasks.output_path(task["TaskId"]).read_bytes()
+        assert output == "eitttvöþrjú".encode("utf-8")
+
+    def test_failed_task(self, app, tasks):
+        app.config["FAIL"] = True
+        task = tasks.start(FakeVoice(), "eitt tvö þrjú", **REQUEST)
+        tasks.shutdown()
+
+        task = tasks.get(task["TaskId"])
+        assert task["TaskStatus"] == "failed"
+        assert task["TaskStatusReason"] == "synthesis failed"
+        assert tasks.output_path(task["TaskId"]) is None
+
+    def test_overloaded_task_fails_after_deadline(self, app, tmp_path):
+        app.config["OVERLOADED"] = True
+        tasks = SynthesisTaskManager(tmp_path, max_overload_wait_ms=10)
+        task = tasks.start(FakeVoice(), "eitt tvö þrjú", **REQUEST)
+        tasks.shutdown()
+
+        task = tasks.get(task["TaskId"])
+        assert task["TaskStatus"] == "failed"
+        assert task["TaskStatusReason"] == "Synthesis queue is full"
+
+    def test_unknown_task(self, tasks):
+        assert tasks.get("0123abcd") is None
+        assert tasks.get("../etc/passwd") is None
+        assert tasks.output_path("0123abcd") is None
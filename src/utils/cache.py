@@ -0,0 +1,95 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """A bounded, thread-safe least-recently-used cache.
+
+    The size of the cache is the sum of `size_fn(value)` over all entries, which by
+    default counts each entry as 1. When an insertion makes the cache exceed
+    `max_size` the least recently used entries are evicted.
+
+    Example:
+      >>> cache = LRUCache(max_size=2**20, size_fn=len)  # bounded to 1 MiB of bytes
+      >>> cache.put("key", b"value")
+      >>> cache.get("key")
+      b'value'
+
+    """
+
+    _entries: "OrderedDict[K, V]"
+    _max_size: int
+    _size_fn: Callable[[V], int]
+    _size: int
+    _lock: threading.Lock
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int, size_fn: Optional[Callable[[V], int]] = None):
+        if max_size < 0:
+            raise ValueError("max_size has to be non-negative")
+        self._entries = OrderedDict()
+        self._max_size = max_size
+        self._size_fn = size_fn if size_fn else lambda _: 1
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: K, value: V) -> None:
+        size = self._size_fn(value)
+        if size > self._max_size:
+            # Would evict everything else and still not fit
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._size_fn(self._entries.pop(key))
+            self._entries[key] = value
+            self._size += size
+            while self._size > self._max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= self._size_fn(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __contains__(self, key: K) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,207 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+import threading
+import time
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from .voice_base import VoiceBase, VoiceProperties
+
+# Weight of the latest synthesis duration in the moving average used for Retry-After
+_DURATION_EWMA_WEIGHT = 0.2
+
+
+class OverloadedError(Exception):
+    """Raised when a request isn't admitted for synthesis.
+
+    Attributes:
+      status_code: 429 if the wait queue was full, 503 if the request timed out
+          waiting in the queue
+      retry_after: Suggested number of seconds to wait before retrying
+
+    """
+
+    status_code: int
+    retry_after: int
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Limits the number of concurrent syntheses, with a bounded wait queue.
+
+    Requests beyond max_concurrent wait in FIFO order for at most queue_timeout_ms.
+    If max_queued requests are already waiting, further requests are rejected right
+    away.
+
+    """
+
+    _max_concurrent: int
+    _max_queued: int
+    _queue_timeout: float
+    _lock: threading.Lock
+    _active: int
+    _waiters: List[threading.Event]
+    _avg_duration: Optional[float]
+
+    def __init__(self, max_concurrent: int, max_queued: int, queue_timeout_ms: int):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent has to be positive")
+        self._max_concurrent = max_concurrent
+        self._max_queued = max_queued
+        self._queue_timeout = queue_timeout_ms / 1000
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters = []
+        self._avg_duration = None
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def acquire(self) -> Callable[[], None]:
+        """Wait for a synthesis slot.
+
+        Returns:
+          A function that releases the slot, which is safe to call more than once
+
+        Raises:
+          OverloadedError: if the queue is full or the wait timed out
+
+        """
+        with self._lock:
+            if self._active < self._max_concurrent and not self._waiters:
+                self._active += 1
+                return self._releaser()
+            if len(self._waiters) >= self._max_queued:
+                raise OverloadedError(
+                    "Synthesis queue is full", 429, self._retry_after_locked()
+                )
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+
+        if not waiter.wait(self._queue_timeout):
+            with self._lock:
+                # The slot may have been handed over right after the timeout
+                if not waiter.is_set():
+                    self._waiters.remove(waiter)
+                    raise OverloadedError(
+                        "Timed out waiting for synthesis",
+                        503,
+                        self._retry_after_locked(),
+                    )
+        return self._releaser()
+
+    def _releaser(self) -> Callable[[], None]:
+        start = time.monotonic()
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            with self._lock:
+                if released:
+                    return
+                released = True
+                duration = time.monotonic() - start
+                self._avg_duration = (
+                    duration
+                    if self._avg_duration is None
+                    else _DURATION_EWMA_WEIGHT * duration
+                    + (1 - _DURATION_EWMA_WEIGHT) * self._avg_duration
+                )
+                if self._waiters:
+                    # Hand the slot over to the longest waiting request
+                    self._waiters.pop(0).set()
+                else:
+                    self._active -= 1
+
+        return release
+
+    def _retry_after_locked(self) -> int:
+        """Estimate when a slot is free for a new request, in whole seconds."""
+        if self._avg_duration is None:
+            return max(math.ceil(self._queue_timeout), 1)
+        waves = (len(self._waiters) + 1) / self._max_concurrent
+        return max(math.ceil(waves * self._avg_duration), 1)
+
+
+class _ReleasingIterator:
+    """Iterates chunks and calls release once done, failed or closed."""
+
+    def __init__(self, chunks: Iterable[bytes], release: Callable[[], None]):
+        self._chunks = iter(chunks)
+        self._release = release
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            return next(self._chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        try:
+            if hasattr(self._chunks, "close"):
+                self._chunks.close()  # type: ignore
+        finally:
+            self._release()
+
+    def __del__(self):
+        # Responses that are never iterated, e.g. if the request failed right after
+        # synthesize was called, still have to give back their slot
+        self._release()
+
+
+class AdmittedVoice(VoiceBase):
+    """Wraps a voice with an AdmissionController.
+
+    A slot is taken when synthesize is called, so an overloaded voice raises
+    OverloadedError before any response has been started, and released when the
+    returned chunks have been fully iterated or closed.
+
+    """
+
+    _voice: VoiceBase
+    _admission: AdmissionController
+
+    def __init__(self, voice: VoiceBase, admission: AdmissionController):
+        self._voice = voice
+        self._admission = admission
+
+    def synthesize(self, text: str, ssml: bool = False, **kwargs) -> Iterable[bytes]:
+        release = self._admission.acquire()
+        try:
+            chunks = self._voice.synthesize(text, ssml=ssml, **kwargs)
+        except BaseException:
+            release()
+            raise
+        return _ReleasingIterator(chunks, release)
+
+    @property
+    def properties(self) -> VoiceProperties:
+        return self._voice.properties
+
+    @property
+    def version_hash(self) -> str:
+        return self._voice.version_hash
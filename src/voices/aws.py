@@ -51,6 +51,15 @@ class PollyVoice(VoiceBase):
         return PollySession.get_client().synthesize_speech(*args, **kwargs)
 
     def synthesize(self, text: str, ssml: bool = False, **kwargs) -> Iterable[bytes]:
+        if kwargs.pop("IncludeSpeechMarks", False):
+            raise NotImplementedError(
+                "Combined audio and speech marks are not supported for Polly voices"
+            )
+        # Only used by the local backends, Polly rejects unknown parameters
+        kwargs.pop("Priority", None)
+        return self._synthesize_stream(**kwargs)
+
+    def _synthesize_stream(self, **kwargs) -> Iterable[bytes]:
         resp = self._synthesize_speech(**kwargs)
         if "AudioStream" in resp:
             with contextlib.closing(resp["AudioStream"]) as stream:
@@ -0,0 +1,152 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+_logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class BatchScheduler(Generic[T, R]):
+    """Dynamic micro-batching of work items from concurrent callers.
+
+    Items submitted from different threads (e.g. concurrent requests) are collected by
+    a single worker thread for at most `max_wait_ms` after the first item arrives, or
+    until `max_batch_size` items have been collected. The items are then grouped by
+    `group_key` and each group is passed to `batch_fn` as a single batch. The results
+    are handed back to the submitting threads.
+
+    A scheduler with `max_batch_size` of 1 does not start a worker thread and calls
+    `batch_fn` directly from the submitting thread.
+
+    Example:
+      >>> scheduler = BatchScheduler(
+      >>>     lambda xs: [x * 2 for x in xs], max_batch_size=8, max_wait_ms=10
+      >>> )
+      >>> scheduler.submit(21)
+      42
+
+    """
+
+    _batch_fn: Callable[[List[T]], List[R]]
+    _group_key: Callable[[T], Hashable]
+    _max_batch_size: int
+    _max_wait: float
+    _name: str
+    _queue: "queue.SimpleQueue[Tuple[T, Future]]"
+    _worker: Optional[threading.Thread]
+    _worker_lock: threading.Lock
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[T]], List[R]],
+        max_batch_size: int = 1,
+        max_wait_ms: float = 0.0,
+        group_key: Optional[Callable[[T], Hashable]] = None,
+        name: str = "batch-scheduler",
+    ):
+        """Initialize a BatchScheduler.
+
+        Args:
+          batch_fn: Function that processes a list of items and returns a list of
+              results in the same order.
+
+          max_batch_size: Maximum number of items passed to a single call of batch_fn.
+
+          max_wait_ms: Maximum time to wait for more items after the first item of a
+              batch arrives.
+
+          group_key: Items are only batched with other items with an equal key, e.g.
+              the inference control parameters.
+
+          name: Name of the worker thread
+
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size has to be at least 1")
+        self._batch_fn = batch_fn
+        self._group_key = group_key if group_key else lambda _: None
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._name = name
+        self._queue = queue.SimpleQueue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_batch_size > 1
+
+    def submit(self, item: T) -> R:
+        """Submit an item for processing and block until its result is ready."""
+        if not self.enabled:
+            return self._batch_fn([item])[0]
+
+        self._ensure_worker()
+        future: Future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def _ensure_worker(self) -> None:
+        # The worker is started lazily, since the scheduler might be created before
+        # the process is forked (e.g. by gunicorn)
+        if self._worker and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(
+                target=self._run, name=self._name, daemon=True
+            )
+            self._worker.start()
+
+    def _collect(self) -> List[Tuple[T, Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self._max_wait
+        while len(batch) < self._max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            groups: Dict[Hashable, List[Tuple[T, Future]]] = {}
+            for item, future in batch:
+                if future.set_running_or_notify_cancel():
+                    groups.setdefault(self._group_key(item), []).append(
+                        (item, future)
+                    )
+
+            for group in groups.values():
+                try:
+                    results = self._batch_fn([item for item, _ in group])
+                except Exception as ex:
+                    _logger.debug("Batch of %d failed", len(group), exc_info=ex)
+                    for _, future in group:
+                        future.set_exception(ex)
+                    continue
+                for (_, future), result in zip(group, results):
+                    future.set_result(result)
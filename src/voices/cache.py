@@ -0,0 +1,297 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Hashable, Iterable, List, Optional, Sequence, Tuple, Union
+
+from src.utils.cache import LRUCache
+from src.utils.version import hash_from_string
+
+from .voice_base import VoiceBase, VoiceProperties
+
+_logger = logging.getLogger(__name__)
+
+
+class DiskCache:
+    """A content addressed on-disk cache with size based eviction.
+
+    Entries are stored as one file per key under `cache_dir`. When the total size of
+    the cache exceeds `max_bytes`, the least recently used entries (by modification
+    time, which is refreshed on each hit) are removed until the cache is below
+    `low_water_mark * max_bytes`.
+
+    The directory can be shared between processes, e.g. gunicorn workers, since all
+    writes are atomic renames. Each process keeps its own estimate of the total size
+    and rescans the directory before evicting.
+
+    """
+
+    _cache_dir: Path
+    _max_bytes: int
+    _low_water_mark: float
+    _size: int
+    _lock: threading.Lock
+
+    def __init__(self, cache_dir: Path, max_bytes: int, low_water_mark: float = 0.9):
+        self._cache_dir = cache_dir
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._low_water_mark = low_water_mark
+        self._lock = threading.Lock()
+        self._size = sum(p.stat().st_size for p in self._entries())
+
+    def _entries(self) -> Iterable[Path]:
+        return (p for p in self._cache_dir.glob("*/*") if p.is_file())
+
+    def _path(self, key: str) -> Path:
+        return self._cache_dir / key[:2] / key
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            content = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return content
+
+    def put(self, key: str, content: bytes) -> None:
+        if len(content) > self._max_bytes:
+            return
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp_f:
+                tmp_f.write(content)
+            os.replace(tmp_path, path)
+        except OSError:
+            _logger.exception("Could not write cache entry %s", key)
+            Path(tmp_path).unlink(missing_ok=True)
+            return
+
+        with self._lock:
+            self._size += len(content)
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        self._size = sum(size for _, size, _ in entries)
+        target = self._low_water_mark * self._max_bytes
+        for _, size, path in entries:
+            if self._size <= target:
+                break
+            path.unlink(missing_ok=True)
+            self._size -= size
+
+
+class SynthesisCache:
+    """Two tiered cache for complete synthesis responses.
+
+    The first tier is a bounded in-memory LRU cache and the second, optional, tier is a
+    `DiskCache`. Hits in the disk tier are promoted to the memory tier.
+
+    """
+
+    _memory: LRUCache[str, bytes]
+    _disk: Optional[DiskCache]
+    _max_entry_bytes: int
+
+    def __init__(
+        self,
+        max_memory_bytes: int,
+        disk_cache_dir: Optional[Path] = None,
+        max_disk_bytes: int = 0,
+        max_entry_bytes: int = 16 * 1024 * 1024,
+    ):
+        """Initialize a SynthesisCache.
+
+        Args:
+          max_memory_bytes: Upper bound on the total size of entries kept in memory.
+
+          disk_cache_dir: Directory for the on-disk tier. The tier is disabled if this
+              is None.
+
+          max_disk_bytes: Upper bound on the total size of the on-disk tier.
+
+          max_entry_bytes: Responses larger than this are never cached.
+
+        """
+        self._memory = LRUCache(max_size=max_memory_bytes, size_fn=len)
+        self._disk = (
+            DiskCache(disk_cache_dir, max_bytes=max_disk_bytes)
+            if disk_cache_dir
+            else None
+        )
+        self._max_entry_bytes = max_entry_bytes
+
+    @staticmethod
+    def make_key(version_hash: str, text: str, **kwargs) -> str:
+        """Create a cache key for a synthesis request to a voice at `version_hash`."""
+        return hash_from_string(
+            json.dumps(
+                [
+                    version_hash,
+                    text,
+                    kwargs.get("TextType", "text"),
+                    kwargs.get("OutputFormat"),
+                    kwargs.get("SampleRate"),
+                    sorted(kwargs.get("SpeechMarkTypes") or []),
+                    bool(kwargs.get("IncludeSpeechMarks")),
+                ],
+                ensure_ascii=False,
+            )
+        )
+
+    def get(self, key: str) -> Optional[bytes]:
+        content = self._memory.get(key)
+        if content is None and self._disk:
+            content = self._disk.get(key)
+            if content is not None:
+                self._memory.put(key, content)
+        return content
+
+    def put(self, key: str, content: bytes) -> None:
+        if len(content) > self._max_entry_bytes:
+            return
+        self._memory.put(key, content)
+        if self._disk:
+            self._disk.put(key, content)
+
+    @property
+    def max_entry_bytes(self) -> int:
+        return self._max_entry_bytes
+
+
+class SegmentCache:
+    """An in-memory cache for synthesized segments.
+
+    Synthesizer backends split the input into segments (see
+    `src.frontend.words.preprocess_sentences`) and synthesize each one separately. This
+    cache stores the results per segment, so a request for a slightly edited text
+    only pays for the segments that changed.
+
+    Two kinds of entries are stored: the predicted phone durations (in milliseconds),
+    which only depend on the model and the phone sequence, and the PCM audio chunk,
+    which additionally depends on prosody and the sample rate. The chunks are cached
+    before encoding, since a response is encoded as a single stream.
+
+    """
+
+    _cache: LRUCache[Tuple, Union[bytes, Tuple[float, ...]]]
+
+    def __init__(self, max_bytes: int):
+        self._cache = LRUCache(max_size=max_bytes, size_fn=_segment_entry_size)
+
+    def get_durations(
+        self, version_hash: str, phone_seq: Sequence[str], *controls: Hashable
+    ) -> Optional[List[float]]:
+        durations = self._cache.get(
+            ("durations", version_hash, tuple(phone_seq), controls)
+        )
+        return list(durations) if durations is not None else None  # type: ignore
+
+    def put_durations(
+        self,
+        version_hash: str,
+        phone_seq: Sequence[str],
+        durations: Sequence[float],
+        *controls: Hashable,
+    ) -> None:
+        self._cache.put(
+            ("durations", version_hash, tuple(phone_seq), controls), tuple(durations)
+        )
+
+    def get_audio(
+        self, version_hash: str, phone_seq: Sequence[str], *params: Hashable
+    ) -> Optional[bytes]:
+        chunk = self._cache.get(("audio", version_hash, tuple(phone_seq), params))
+        return chunk  # type: ignore
+
+    def put_audio(
+        self,
+        version_hash: str,
+        phone_seq: Sequence[str],
+        chunk: bytes,
+        *params: Hashable,
+    ) -> None:
+        self._cache.put(("audio", version_hash, tuple(phone_seq), params), chunk)
+
+
+def _segment_entry_size(entry: Union[bytes, Tuple[float, ...]]) -> int:
+    if isinstance(entry, bytes):
+        return len(entry)
+    return 8 * len(entry)
+
+
+class CachedVoice(VoiceBase):
+    """Wraps a voice with a SynthesisCache.
+
+    The content of a response is only added to the cache once the underlying voice
+    has been fully iterated, so interrupted or failed responses are never cached.
+
+    """
+
+    _voice: VoiceBase
+    _cache: SynthesisCache
+
+    def __init__(self, voice: VoiceBase, cache: SynthesisCache):
+        self._voice = voice
+        self._cache = cache
+
+    def synthesize(self, text: str, ssml: bool = False, **kwargs) -> Iterable[bytes]:
+        key = SynthesisCache.make_key(self.version_hash, text, **kwargs)
+        content = self._cache.get(key)
+        if content is not None:
+            return iter((content,))
+        return self._synthesize_and_cache(
+            key, self._voice.synthesize(text, ssml=ssml, **kwargs)
+        )
+
+    def _synthesize_and_cache(
+        self, key: str, chunks: Iterable[bytes]
+    ) -> Iterable[bytes]:
+        content: Optional[List[bytes]] = []
+        content_len = 0
+        for chunk in chunks:
+            if content is not None:
+                content.append(chunk)
+                content_len += len(chunk)
+                if content_len > self._cache.max_entry_bytes:
+                    content = None
+            yield chunk
+
+        if content is not None:
+            self._cache.put(key, b"".join(content))
+
+    @property
+    def properties(self) -> VoiceProperties:
+        return self._voice.properties
+
+    @property
+    def version_hash(self) -> str:
+        return self._voice.version_hash
@@ -0,0 +1,133 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-process implementation of SSML prosody, mirroring the ffmpeg filters in
+`src.ffmpeg._filter_args`.
+"""
+import numpy as np
+import resampy
+
+from src.ffmpeg import Prosody
+
+# ffmpeg's atempo filter doesn't go below 0.5, which _filter_args relies on
+_MIN_RATE = 0.5
+
+_INT16_MIN = np.iinfo(np.int16).min
+_INT16_MAX = np.iinfo(np.int16).max
+
+
+def gain(samples: np.ndarray, volume_db: float) -> np.ndarray:
+    """Scale samples by volume_db decibels."""
+    return samples * (10.0 ** (volume_db / 20.0))
+
+
+def time_stretch(
+    samples: np.ndarray,
+    rate: float,
+    sample_rate: int,
+    frame_ms: float = 40.0,
+    tolerance_ms: float = 10.0,
+) -> np.ndarray:
+    """Change the tempo of samples by rate without changing the pitch.
+
+    Uses WSOLA (waveform similarity overlap-add): output frames are taken from around
+    their nominal input position, shifted by up to tolerance_ms to the position most
+    similar to the natural continuation of the previous frame, and overlap-added with
+    a Hann window.
+
+    Args:
+      samples: 1D array of samples
+      rate: Tempo factor, i.e. 2.0 halves the duration
+      sample_rate: Sample rate of samples
+      frame_ms: Length of the overlap-added frames
+      tolerance_ms: Maximum shift of a frame from its nominal position
+
+    Returns:
+      A float array of about len(samples) / rate samples
+
+    """
+    if rate <= 0.0:
+        raise ValueError("Rate has to be positive")
+    samples = np.asarray(samples, dtype=np.float32)
+    if rate == 1.0 or len(samples) == 0:
+        return samples
+
+    frame_len = max(2 * int(sample_rate * frame_ms / 2000), 2)
+    hop_out = frame_len // 2
+    hop_in = hop_out * rate
+    tolerance = int(sample_rate * tolerance_ms / 1000)
+    out_len = int(len(samples) / rate)
+    n_frames = out_len // hop_out + 1
+
+    # Pad so every candidate frame is within bounds
+    padded = np.zeros(
+        int(n_frames * hop_in) + hop_out + frame_len + 2 * tolerance, dtype=np.float32
+    )
+    padded[tolerance : tolerance + len(samples)] = samples
+    # Periodic Hann windows with 50% overlap sum to one
+    window = np.hanning(frame_len + 1)[:-1].astype(np.float32)
+
+    out = np.zeros(n_frames * hop_out + frame_len, dtype=np.float32)
+    norm = np.zeros_like(out)
+    prev_pos = tolerance
+    for idx in range(n_frames):
+        nominal = tolerance + int(idx * hop_in)
+        if idx == 0:
+            pos = nominal
+        else:
+            natural = padded[prev_pos + hop_out : prev_pos + hop_out + frame_len]
+            region = padded[nominal - tolerance : nominal + tolerance + frame_len]
+            similarity = np.correlate(region, natural, mode="valid")
+            pos = nominal - tolerance + int(np.argmax(similarity))
+        start = idx * hop_out
+        out[start : start + frame_len] += window * padded[pos : pos + frame_len]
+        norm[start : start + frame_len] += window
+        prev_pos = pos
+
+    return (out / np.maximum(norm, 1e-3))[:out_len]
+
+
+def pitch_shift(samples: np.ndarray, pitch: float, sample_rate: int) -> np.ndarray:
+    """Scale the pitch of samples by pitch without changing the duration.
+
+    Equivalent to ffmpeg's asetrate + atempo: the samples are time stretched by
+    1/pitch and then resampled to the original length.
+    """
+    if pitch <= 0.0:
+        raise ValueError("Pitch has to be positive")
+    samples = np.asarray(samples, dtype=np.float32)
+    if pitch == 1.0 or len(samples) == 0:
+        return samples
+    stretched = time_stretch(samples, 1 / pitch, sample_rate)
+    return resampy.resample(stretched, sample_rate * pitch, sample_rate)
+
+
+def apply_prosody(
+    samples: np.ndarray, sample_rate: int, prosody: Prosody
+) -> np.ndarray:
+    """Apply prosody to int16 samples, returning int16 samples.
+
+    The result is the same as with the filters from `src.ffmpeg._filter_args`, but
+    without an ffmpeg process.
+    """
+    if prosody.is_default:
+        return samples
+
+    out = np.asarray(samples, dtype=np.float32)
+    if prosody.pitch:
+        out = pitch_shift(out, prosody.pitch, sample_rate)
+    if prosody.rate:
+        out = time_stretch(out, max(prosody.rate, _MIN_RATE), sample_rate)
+    if prosody.volume:
+        out = gain(out, prosody.volume)
+    return np.clip(np.rint(out), _INT16_MIN, _INT16_MAX).astype(np.int16)
@@ -19,7 +19,7 @@ import sys
 import tempfile
 import zipfile
 from pathlib import Path
-from typing import Dict, Iterable, Literal, Optional
+from typing import Dict, Iterable, List, Literal, Optional, Tuple
 
 import numpy as np
 import resampy
@@ -30,6 +30,7 @@ from espnet2.torch_utils.device_funcs import to_device as espnet2_to_device
 from espnet_model_zoo.downloader import ModelDownloader
 from flask import current_app
 
+from proto.tiro.tts import voice_pb2
 from src import ffmpeg
 from src.frontend.grapheme_to_phoneme import GraphemeToPhonemeTranslatorBase
 from src.frontend.normalization import BasicNormalizer, NormalizerBase
@@ -43,9 +44,21 @@ from src.frontend.words import (
 )
 from src.utils.version import VersionedThing, hash_from_impl
 
-from .utils import wavarray_to_pcm
+from .batching import BatchScheduler
+from .cache import SegmentCache
+from .priority import Priority, PriorityGate
+from .utils import (
+    ProsodyMode,
+    encode_pcm_stream,
+    encode_with_speech_marks,
+    segment_to_pcm,
+    set_word_start_times,
+)
 from .voice_base import OutputFormat, VoiceBase, VoiceProperties
 
+# A tuple of (words, phone sequence, phone count per word, prosody) of a segment
+_Segment = Tuple[List[Word], List[str], List[int], ffmpeg.Prosody]
+
 
 class Espnet2Synthesizer(VersionedThing):
     """Synthesizer backend for ESPNET2 trained voices.
@@ -75,6 +88,9 @@ class Espnet2Synthesizer(VersionedThing):
     _tts_internal: Text2Speech
     _phoneme_map: Dict[str, int]
     _alphabet: Alphabet
+    _segment_cache: Optional[SegmentCache]
+    _priority_gate: Optional[PriorityGate]
+    _vocoder_scheduler: BatchScheduler
     _version_hash: str
 
     def __init__(
@@ -84,10 +100,15 @@ class Espnet2Synthesizer(VersionedThing):
         phonetizer: GraphemeToPhonemeTranslatorBase,
         normalizer: NormalizerBase,
         alphabet: Alphabet,
+        segment_cache: Optional[SegmentCache] = None,
+        vocoder_batching: Optional[voice_pb2.BatchingConfig] = None,
+        priority_gate: Optional[PriorityGate] = None,
     ):
         self._phonetizer = phonetizer
         self._normalizer = normalizer
         self._alphabet = alphabet
+        self._segment_cache = segment_cache
+        self._priority_gate = priority_gate
 
         content_to_hash = b""
 
@@ -146,6 +167,54 @@ class Espnet2Synthesizer(VersionedThing):
             + self._normalizer.version_hash.encode(),
         )
 
+        self._vocoder_scheduler = BatchScheduler(
+            self._do_vocoder_batch,
+            max_batch_size=(
+                max(vocoder_batching.max_batch_size, 1) if vocoder_batching else 1
+            ),
+            max_wait_ms=vocoder_batching.max_wait_ms if vocoder_batching else 0,
+            name="espnet2-vocoder",
+        )
+
+    def _do_vocoder_batch(self, feats: List[torch.Tensor]) -> List[torch.Tensor]:
+        """Run the vocoder on a batch of (frames, odim) features.
+
+        Only (Multi-band) MelGAN vocoders from ParallelWaveGAN are batched, since
+        their generators are purely convolutional. The features are padded to a common
+        length, run through the generator once and each output is trimmed to the hop
+        length scaled length of its features. Other vocoders are run on one item at a
+        time.
+
+        """
+        wrapper = self._tts_internal.vocoder
+        generator = getattr(wrapper, "vocoder", None)
+        if len(feats) == 1 or not hasattr(generator, "melgan"):
+            return [wrapper(feat) for feat in feats]
+
+        feat_lens = [feat.shape[0] for feat in feats]
+        padded = torch.empty(
+            (len(feats), feats[0].shape[1], max(feat_lens)),
+            dtype=feats[0].dtype,
+            device=feats[0].device,
+        )
+        for idx, feat in enumerate(feats):
+            if getattr(wrapper, "normalize_before", False):
+                feat = (feat - generator.mean) / generator.scale
+            # Pad with the quietest frame value of each item
+            padded[idx].fill_(float(feat.min()))
+            padded[idx, :, : feat_lens[idx]] = feat.transpose(0, 1)
+
+        with torch.no_grad():
+            audio = generator.melgan(padded)
+            if getattr(generator, "pqmf", None) is not None:
+                audio = generator.pqmf.synthesis(audio)
+        hop_length = audio.shape[-1] // padded.shape[-1]
+
+        return [
+            audio[idx, 0, : feat_len * hop_length]
+            for idx, feat_len in enumerate(feat_lens)
+        ]
+
     def synthesize(
         self,
         text: str,
@@ -154,10 +223,54 @@ class Espnet2Synthesizer(VersionedThing):
         output_format: Literal["json", "pcm", "mp3", "ogg_vorbis"] = "pcm",
         *,
         use_ffmpeg: bool = True,
+        audio_encoder: Literal["ffmpeg", "soundfile"] = "ffmpeg",
+        prosody_mode: ProsodyMode = "ffmpeg",
+        include_speech_marks: bool = False,
+        priority: Priority = "interactive",
     ) -> Iterable[bytes]:
+        with_speech_marks = output_format == "json" or include_speech_marks
+        if with_speech_marks and not self.supports_speech_marks:
+            raise NotImplementedError(
+                "Speech marks are only supported for models with durations"
+            )
+
+        segments = self._segments(text, ssml)
+        if self._priority_gate:
+            segments = self._priority_gate.prioritized(segments, priority)
         if output_format == "json":
-            raise NotImplementedError("This backend doesn't support speech marks!")
+            return self._synthesize_speech_marks(segments, prosody_mode)
+
+        timed_chunks = self._synthesize_pcm(
+            segments,
+            sample_rate=sample_rate,
+            prosody_mode=prosody_mode,
+            use_ffmpeg=use_ffmpeg,
+            with_start_times=include_speech_marks,
+        )
+        if include_speech_marks:
+            return encode_with_speech_marks(
+                timed_chunks,
+                output_format=output_format,  # type: ignore
+                sample_rate=sample_rate,
+                audio_encoder=audio_encoder,
+                use_ffmpeg=use_ffmpeg,
+            )
+        # A single encoder for the whole response, so multi segment responses are a
+        # single continuous stream
+        return encode_pcm_stream(
+            (chunk for _, chunk in timed_chunks),
+            output_format=output_format,  # type: ignore
+            sample_rate=sample_rate,
+            audio_encoder=audio_encoder,
+            use_ffmpeg=use_ffmpeg,
+        )
+
+    @property
+    def supports_speech_marks(self) -> bool:
+        """Whether the model predicts durations, i.e. is a FastSpeech(2) model."""
+        return "alpha" in self._tts_internal.decode_conf
 
+    def _segments(self, text: str, ssml: bool) -> Iterable[_Segment]:
         def phonetize_fn(*args, **kwargs):
             return self._phonetizer.translate_words(
                 *args, **kwargs, alphabet=self._alphabet
@@ -174,42 +287,175 @@ class Espnet2Synthesizer(VersionedThing):
                 prosody.rate = ssml_props.rate
                 prosody.pitch = ssml_props.pitch
                 prosody.volume = ssml_props.volume
+            yield segment_words, phone_seq, phone_counts, prosody
 
-            batch = espnet2_to_device(
-                {
-                    "text": self._tts_internal.preprocess_fn(
-                        "<dummy>", {"text": " ".join(phone_seq)}
-                    )["text"]
-                }
-            )
+    def _run_acoustic_model(
+        self,
+        phone_seq: List[str],
+        prosody: ffmpeg.Prosody,
+        prosody_mode: ProsodyMode,
+    ) -> Tuple[Dict[str, torch.Tensor], ffmpeg.Prosody]:
+        """Run the acoustic model on a segment.
+
+        Returns:
+          A tuple of the model output and the prosody that is left to apply to the
+          synthesized audio.
+        """
+        batch = espnet2_to_device(
+            {
+                "text": self._tts_internal.preprocess_fn(
+                    "<dummy>", {"text": " ".join(phone_seq)}
+                )["text"]
+            }
+        )
 
-            decode_conf = self._tts_internal.decode_conf
-            out = self._tts_internal.model.inference(
-                **batch, **{**self._tts_internal.decode_conf}
+        decode_conf = {**self._tts_internal.decode_conf}
+        if prosody_mode == "model" and prosody.rate and "alpha" in decode_conf:
+            # Only FastSpeech(2) models have the speed control alpha, which scales the
+            # predicted durations
+            decode_conf["alpha"] = decode_conf["alpha"] / prosody.rate
+            prosody = ffmpeg.Prosody(pitch=prosody.pitch, volume=prosody.volume)
+        with torch.no_grad():
+            out = self._tts_internal.model.inference(**batch, **decode_conf)
+        return out, prosody
+
+    def _phone_durations(
+        self,
+        phone_seq: List[str],
+        prosody: ffmpeg.Prosody,
+        prosody_mode: ProsodyMode,
+        out: Optional[Dict[str, torch.Tensor]] = None,
+    ) -> List[float]:
+        """Get the phone durations of a segment in milliseconds.
+
+        The durations are taken from out, the output of the acoustic model for the
+        segment, if given. Otherwise they are looked up in the segment cache or the
+        acoustic model is run.
+        """
+        rate_applied = prosody_mode == "model" and prosody.rate is not None
+        alpha = 1 / prosody.rate if rate_applied else 1.0  # type: ignore
+        if out is None and self._segment_cache:
+            phone_durations = self._segment_cache.get_durations(
+                self._version_hash, phone_seq, alpha
             )
-            wav = self._tts_internal.vocoder(out["feat_gen"])
-
-            max_wav_value: float = 32768.0
-            wav = wav * (20000 / torch.max(torch.abs(wav)))
-            wav = wav.clamp(min=-max_wav_value, max=max_wav_value - 1)
-            wav = wav.to(dtype=torch.int16)
+            if phone_durations is not None:
+                return phone_durations
+        if out is None:
+            out, _ = self._run_acoustic_model(phone_seq, prosody, prosody_mode)
+
+        # Duration of a single output frame of the acoustic model
+        frame_milli = (
+            1000
+            * self._tts_internal.train_args.feats_extract_conf["hop_length"]
+            / self._tts_internal.fs
+        )
+        # The durations are in frames and include the <sos/eos> token. They are
+        # predicted before the length regulator scales them by alpha.
+        phone_durations = (
+            alpha * out["duration"][: len(phone_seq)].to(torch.float32) * frame_milli
+        ).tolist()
+        if self._segment_cache:
+            self._segment_cache.put_durations(
+                self._version_hash, phone_seq, phone_durations, alpha
+            )
+        return phone_durations
 
-            chunk = wavarray_to_pcm(
-                wav.cpu().numpy(),
-                src_sample_rate=self._tts_internal.fs,
-                dst_sample_rate=sample_rate,
+    def _synthesize_speech_marks(
+        self, segments: Iterable[_Segment], prosody_mode: ProsodyMode
+    ) -> Iterable[bytes]:
+        time_offset = 0
+        for segment_words, phone_seq, phone_counts, prosody in segments:
+            time_offset = set_word_start_times(
+                segment_words,
+                phone_counts,
+                self._phone_durations(phone_seq, prosody, prosody_mode),
+                start_time_milli=time_offset,
+                rate_applied=prosody_mode == "model" and prosody.rate is not None,
             )
+            for word in segment_words:
+                if word.is_spoken():
+                    yield word.to_json().encode("utf-8") + b"\n"
 
-            if use_ffmpeg:
-                yield ffmpeg.to_format(
-                    out_format=output_format,
-                    audio_content=chunk,
-                    src_sample_rate=str(sample_rate),
-                    sample_rate=str(sample_rate),
-                    prosody=prosody,
+    def _synthesize_pcm(
+        self,
+        segments: Iterable[_Segment],
+        *,
+        sample_rate: int,
+        prosody_mode: ProsodyMode,
+        use_ffmpeg: bool,
+        with_start_times: bool = False,
+    ) -> Iterable[Tuple[List[Word], bytes]]:
+        """Synthesize the words and PCM chunk of each segment.
+
+        If with_start_times is set, the start times of the words are set from the
+        durations of the same acoustic model pass that produced the chunk.
+        """
+        time_offset = 0
+        for segment_words, phone_seq, phone_counts, prosody in segments:
+            audio_cache_params = (
+                prosody.rate,
+                prosody.pitch,
+                prosody.volume,
+                sample_rate,
+                prosody_mode,
+                use_ffmpeg,
+            )
+            chunk = None
+            if self._segment_cache:
+                chunk = self._segment_cache.get_audio(
+                    self._version_hash, phone_seq, *audio_cache_params
+                )
+            out = None
+            if chunk is None:
+                out, chunk = self._synthesize_segment(
+                    phone_seq,
+                    prosody,
+                    sample_rate=sample_rate,
+                    prosody_mode=prosody_mode,
+                    use_ffmpeg=use_ffmpeg,
                 )
-            else:
-                yield chunk
+                if self._segment_cache:
+                    self._segment_cache.put_audio(
+                        self._version_hash, phone_seq, chunk, *audio_cache_params
+                    )
+
+            if with_start_times:
+                time_offset = set_word_start_times(
+                    segment_words,
+                    phone_counts,
+                    self._phone_durations(phone_seq, prosody, prosody_mode, out),
+                    start_time_milli=time_offset,
+                    rate_applied=prosody_mode == "model" and prosody.rate is not None,
+                )
+            yield segment_words, chunk
+
+    def _synthesize_segment(
+        self,
+        phone_seq: List[str],
+        prosody: ffmpeg.Prosody,
+        *,
+        sample_rate: int,
+        prosody_mode: ProsodyMode,
+        use_ffmpeg: bool,
+    ) -> Tuple[Dict[str, torch.Tensor], bytes]:
+        """Synthesize a segment, returning the acoustic model output and PCM chunk."""
+        out, prosody = self._run_acoustic_model(phone_seq, prosody, prosody_mode)
+        wav = self._vocoder_scheduler.submit(out["feat_gen"])
+
+        max_wav_value: float = 32768.0
+        wav = wav * (20000 / torch.max(torch.abs(wav)))
+        wav = wav.clamp(min=-max_wav_value, max=max_wav_value - 1)
+        wav = wav.to(dtype=torch.int16)
+
+        chunk = segment_to_pcm(
+            wav.cpu().numpy(),
+            prosody,
+            src_sample_rate=self._tts_internal.fs,
+            dst_sample_rate=sample_rate,
+            prosody_mode=prosody_mode,
+            use_ffmpeg=use_ffmpeg,
+        )
+        return out, chunk
 
     @property
     def version_hash(self) -> str:
@@ -249,6 +495,10 @@ class Espnet2Voice(VoiceBase):
             sample_rate=int(kwargs["SampleRate"]),
             output_format=kwargs["OutputFormat"],
             use_ffmpeg=current_app.config["USE_FFMPEG"],
+            audio_encoder=current_app.config["AUDIO_ENCODER"],
+            prosody_mode=current_app.config["PROSODY_MODE"],
+            include_speech_marks=kwargs.get("IncludeSpeechMarks", False),
+            priority=kwargs.get("Priority", "interactive"),
         )
 
     def synthesize(self, text: str, ssml: bool = False, **kwargs) -> Iterable[bytes]:
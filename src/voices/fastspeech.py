@@ -11,14 +11,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
 import json
 import os
 import re
 import sys
 import typing
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Literal, Optional
 
+import numpy as np
 import torch
 from flask import current_app
 
@@ -33,10 +36,20 @@ from src.frontend.normalization import (
 )
 from src.frontend.phonemes import Alphabet
 from src.frontend.ssml import OldSSMLParser as SSMLParser
-from src.frontend.words import ProsodyProps, preprocess_sentences
+from src.frontend.words import ProsodyProps, Word, preprocess_sentences
 from src.utils.version import VersionedThing, hash_from_impl
 
-from .utils import wavarray_to_pcm
+from .batching import BatchScheduler
+from .cache import SegmentCache
+from .pipeline import pipelined
+from .priority import Priority, PriorityGate
+from .utils import (
+    ProsodyMode,
+    encode_pcm_stream,
+    encode_with_speech_marks,
+    segment_to_pcm,
+    set_word_start_times,
+)
 from .voice_base import OutputFormat, VoiceBase, VoiceProperties
 
 # TODO(rkjaran): Don't hardcode this. Remove it once we've refactored FastSpeech2Voice
@@ -106,6 +119,67 @@ FASTSPEECH2_SYMBOLS = {
 }
 
 
+# Log mel value of silence, i.e. log(1e-5), used for padding MelGAN input
+MELGAN_SILENCE = -11.5129
+
+_DURATION_CONTROL = 1.0
+_PITCH_CONTROL = 1.0
+_ENERGY_CONTROL = 1.0
+
+
+# A tuple of (words, phone sequence, phone count per word, prosody) of a segment
+_Segment = typing.Tuple[
+    typing.List[Word], typing.List[str], typing.List[int], ffmpeg.Prosody
+]
+
+
+@dataclass
+class _AudioSegment:
+    """A segment passed between the stages of the synthesis pipeline."""
+
+    words: typing.List[Word]
+    phone_seq: typing.List[str]
+    phone_counts: typing.List[int]
+    prosody: ffmpeg.Prosody
+    controls: typing.Tuple[float, float, float]
+    cache_params: typing.Tuple
+    with_durations: bool = False
+    chunk: Optional[bytes] = None
+    phone_durations: Optional[typing.List[float]] = None
+    mel: Optional[torch.Tensor] = None
+    wav: Optional[np.ndarray] = None
+
+
+def _controls(
+    prosody: ffmpeg.Prosody, prosody_mode: ProsodyMode
+) -> typing.Tuple[float, float, float]:
+    """Get the (duration, pitch, energy) controls of the model for prosody."""
+    if prosody_mode != "model":
+        return (_DURATION_CONTROL, _PITCH_CONTROL, _ENERGY_CONTROL)
+    return (
+        _DURATION_CONTROL / prosody.rate if prosody.rate else _DURATION_CONTROL,
+        _PITCH_CONTROL * prosody.pitch if prosody.pitch else _PITCH_CONTROL,
+        _ENERGY_CONTROL,
+    )
+
+
+def _with_start_times(
+    audio_segments: typing.Iterable[_AudioSegment], prosody_mode: ProsodyMode
+) -> typing.Iterable[typing.Tuple[typing.List[Word], bytes]]:
+    """Set the word start times of synthesized segments from their phone durations."""
+    time_offset = 0
+    for segment in audio_segments:
+        time_offset = set_word_start_times(
+            segment.words,
+            segment.phone_counts,
+            segment.phone_durations,  # type: ignore
+            start_time_milli=time_offset,
+            # The durations from the model already account for the rate
+            rate_applied=prosody_mode == "model",
+        )
+        yield segment.words, segment.chunk  # type: ignore
+
+
 class FastSpeech2Synthesizer(VersionedThing):
     """A synthesizer wrapper around Fastspeech2 using MelGAN as a vocoder."""
 
@@ -115,6 +189,10 @@ class FastSpeech2Synthesizer(VersionedThing):
     _phonetizer: GraphemeToPhonemeTranslatorBase
     _normalizer: NormalizerBase
     _alphabet: Alphabet
+    _segment_cache: Optional[SegmentCache]
+    _priority_gate: Optional[PriorityGate]
+    _acoustic_scheduler: BatchScheduler
+    _vocoder_scheduler: BatchScheduler
     _version_hash: Optional[str] = None
 
     def __init__(
@@ -124,6 +202,10 @@ class FastSpeech2Synthesizer(VersionedThing):
         phonetizer: GraphemeToPhonemeTranslatorBase,
         normalizer: NormalizerBase,
         alphabet: Alphabet = "ipa",
+        segment_cache: Optional[SegmentCache] = None,
+        acoustic_batching: Optional[voice_pb2.BatchingConfig] = None,
+        vocoder_batching: Optional[voice_pb2.BatchingConfig] = None,
+        priority_gate: Optional[PriorityGate] = None,
     ):
         """Initialize a FastSpeech2Synthesizer.
 
@@ -140,6 +222,18 @@ class FastSpeech2Synthesizer(VersionedThing):
 
           normalizer: A Normalizer used to normalize the input text prior to synthesis
 
+          segment_cache: An optional cache for synthesized segments, can be shared
+              between synthesizers.
+
+          acoustic_batching: Batch FastSpeech2 inference of segments from concurrent
+              requests. Ignored if the model doesn't export `batch_inference`.
+
+          vocoder_batching: Batch MelGAN inference of segments from concurrent
+              requests.
+
+          priority_gate: An optional gate letting interactive requests go ahead of
+              bulk requests, can be shared between synthesizers.
+
         """
         self._device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self._melgan_model = torch.jit.load(
@@ -153,10 +247,122 @@ class FastSpeech2Synthesizer(VersionedThing):
         self._phonetizer = phonetizer
         self._normalizer = normalizer
         self._alphabet = alphabet
+        self._segment_cache = segment_cache
+        self._priority_gate = priority_gate
+
+        max_batch_size = 1
+        if acoustic_batching and hasattr(self._fs_model, "batch_inference"):
+            max_batch_size = max(acoustic_batching.max_batch_size, 1)
+        self._acoustic_scheduler = BatchScheduler(
+            self._do_acoustic_batch,
+            max_batch_size=max_batch_size,
+            max_wait_ms=acoustic_batching.max_wait_ms if acoustic_batching else 0,
+            group_key=lambda item: item[1],
+            name="fastspeech2-acoustic",
+        )
+        self._vocoder_scheduler = BatchScheduler(
+            self._do_vocoder_batch,
+            max_batch_size=(
+                max(vocoder_batching.max_batch_size, 1) if vocoder_batching else 1
+            ),
+            max_wait_ms=vocoder_batching.max_wait_ms if vocoder_batching else 0,
+            name="fastspeech2-vocoder",
+        )
+
+    def _do_acoustic_batch(
+        self,
+        batch: typing.List[
+            typing.Tuple[typing.List[int], typing.Tuple[float, float, float]]
+        ],
+    ) -> typing.List[typing.Tuple[torch.Tensor, torch.Tensor]]:
+        """Run the acoustic model on a batch of phone ID sequences.
+
+        All items in the batch have to share the same (duration, pitch, energy)
+        controls.
+
+        Returns:
+          A list of (mel_postnet, log_duration_output) tuples, each with a batch
+          dimension of 1.
+
+        """
+        d_control, p_control, e_control = batch[0][1]
+        if len(batch) == 1:
+            return [
+                self._fs_model.inference(
+                    torch.tensor([batch[0][0]], dtype=torch.int64, device=self._device),
+                    d_control=d_control,
+                    p_control=p_control,
+                    e_control=e_control,
+                )
+            ]
+
+        src_len = torch.tensor(
+            [len(ids) for ids, _ in batch], dtype=torch.int64, device=self._device
+        )
+        # Zero is the padding symbol ID in the FastSpeech2 models
+        src_seq = torch.zeros(
+            (len(batch), int(src_len.max())), dtype=torch.int64, device=self._device
+        )
+        for idx, (ids, _) in enumerate(batch):
+            src_seq[idx, : len(ids)] = torch.tensor(ids, dtype=torch.int64)
+
+        with torch.no_grad():
+            mel_postnet, log_duration_output, mel_len = self._fs_model.batch_inference(
+                src_seq,
+                src_len,
+                d_control=d_control,
+                p_control=p_control,
+                e_control=e_control,
+            )
+
+        return [
+            (
+                mel_postnet[idx : idx + 1, : int(mel_len[idx])],
+                log_duration_output[idx : idx + 1, : int(src_len[idx])],
+            )
+            for idx in range(len(batch))
+        ]
+
+    def _do_vocoder_batch(
+        self, mels: typing.List[torch.Tensor]
+    ) -> typing.List[torch.Tensor]:
+        """Run MelGAN on a batch of mels, returning float samples for each.
+
+        This mirrors the TorchScript MelGAN `inference` method, which only supports a
+        batch size of 1. The mels are padded to a common length with silence, run
+        through the generator once and each output is trimmed to the hop length scaled
+        length of its mel.
+
+        """
+        if len(mels) == 1:
+            return [self._melgan_model.inference(mels[0])]
+
+        mel_lens = [mel.shape[1] for mel in mels]
+        # Pad with (at least) 10 frames of silence to cut artifacts at the end, see
+        # https://github.com/seungwonpark/melgan/issues/8
+        padded = torch.full(
+            (len(mels), mels[0].shape[2], max(mel_lens) + 10),
+            MELGAN_SILENCE,
+            device=self._device,
+        )
+        for idx, mel in enumerate(mels):
+            padded[idx, :, : mel_lens[idx]] = mel[0].transpose(0, 1)
+
+        with torch.no_grad():
+            audio = self._melgan_model(padded)
+        hop_length = audio.shape[-1] // padded.shape[-1]
+
+        max_wav_value = 32768.0
+        wavs = []
+        for idx, mel_len in enumerate(mel_lens):
+            wav = max_wav_value * audio[idx, 0, : mel_len * hop_length]
+            wav = wav.clamp(min=-max_wav_value, max=max_wav_value - 1)
+            wavs.append(wav * (20000 / torch.max(torch.abs(wav))))
+        return wavs
 
     def _do_vocoder_pass(self, mel: torch.Tensor) -> torch.Tensor:
         """Perform a vocoder pass, returning int16 samples at 22050 Hz."""
-        return self._melgan_model.inference(mel).to(torch.int16)
+        return self._vocoder_scheduler.submit(mel).to(torch.int16)
 
     def synthesize(
         self,
@@ -166,8 +372,13 @@ class FastSpeech2Synthesizer(VersionedThing):
         output_format: Literal["json", "pcm", "mp3", "ogg_vorbis"] = "pcm",
         *,
         use_ffmpeg: bool = True,
+        audio_encoder: Literal["ffmpeg", "soundfile"] = "ffmpeg",
+        prosody_mode: ProsodyMode = "ffmpeg",
+        pipeline_depth: int = 1,
+        include_speech_marks: bool = False,
+        priority: Priority = "interactive",
     ) -> typing.Iterable[bytes]:
-        """Synthesize 16 bit PCM samples or a stream of JSON speech marks.
+        """Synthesize audio or a stream of JSON speech marks.
 
         Args:
           text_string: Text to be synthesized, can contain embedded phoneme
@@ -180,16 +391,91 @@ class FastSpeech2Synthesizer(VersionedThing):
           output_format: The output format is either one of the audio formats or json
                          for speech marks
 
+          use_ffmpeg: Allow ffmpeg to be used for prosody and encoding. If False and
+                      audio_encoder is ffmpeg, the output is always PCM
+
+          audio_encoder: Encode the audio to output_format with an ffmpeg subprocess
+                         or in-process with libsndfile
+
+          prosody_mode: Apply SSML prosody with ffmpeg filters, in-process or, for
+                        rate and pitch, through the duration and pitch controls of
+                        the model
+
+          pipeline_depth: Maximum number of segments waiting between each of the
+                          acoustic model, vocoder and PCM stages, which run
+                          concurrently. Set to 0 to run the stages sequentially.
+
+          include_speech_marks: Return JSON lines with both the word speech marks and
+                                the encoded audio, see `encode_with_speech_marks`.
+                                The start times come from the same acoustic model
+                                pass as the audio. Ignored for json output.
+
+          priority: Segments of bulk requests wait for interactive requests, if the
+                    synthesizer has a priority gate
+
         Yields:
-          bytes: PCM chunk of synthesized audio, or JSON encoded speech marks
+          bytes: Chunks of synthesized audio, or JSON encoded speech marks
 
         """
-        # Segment to decrease latency and memory usage
-        duration_time_offset = 0
+        segments = self._segments(text_string, ssml)
+        if self._priority_gate:
+            segments = self._priority_gate.prioritized(segments, priority)
+        if output_format == "json":
+            return self._synthesize_speech_marks(segments, prosody_mode)
+
+        audio_segments = pipelined(
+            (
+                _AudioSegment(
+                    words=segment_words,
+                    phone_seq=phone_seq,
+                    phone_counts=phone_counts,
+                    prosody=prosody,
+                    controls=_controls(prosody, prosody_mode),
+                    cache_params=(
+                        prosody.rate,
+                        prosody.pitch,
+                        prosody.volume,
+                        sample_rate,
+                        prosody_mode,
+                        use_ffmpeg,
+                    ),
+                    with_durations=include_speech_marks,
+                )
+                for segment_words, phone_seq, phone_counts, prosody in segments
+            ),
+            [
+                self._acoustic_stage,
+                self._vocoder_stage,
+                functools.partial(
+                    self._pcm_stage,
+                    sample_rate=sample_rate,
+                    prosody_mode=prosody_mode,
+                    use_ffmpeg=use_ffmpeg,
+                ),
+            ],
+            maxsize=pipeline_depth,
+            name="fastspeech2",
+        )
+        if include_speech_marks:
+            return encode_with_speech_marks(
+                _with_start_times(audio_segments, prosody_mode),
+                output_format=output_format,  # type: ignore
+                sample_rate=sample_rate,
+                audio_encoder=audio_encoder,
+                use_ffmpeg=use_ffmpeg,
+            )
+        # A single encoder for the whole response, so multi segment responses are a
+        # single continuous stream
+        return encode_pcm_stream(
+            (segment.chunk for segment in audio_segments),  # type: ignore
+            output_format=output_format,  # type: ignore
+            sample_rate=sample_rate,
+            audio_encoder=audio_encoder,
+            use_ffmpeg=use_ffmpeg,
+        )
 
-        duration_control = 1.0
-        pitch_control = 1.0
-        energy_control = 1.0
+    def _segments(self, text_string: str, ssml: bool) -> typing.Iterable[_Segment]:
+        """Preprocess text into segments, skipping those that can't be synthesized."""
 
         def phonetize_fn(*args, **kwargs):
             return self._phonetizer.translate_words(
@@ -198,6 +484,7 @@ class FastSpeech2Synthesizer(VersionedThing):
 
         ssml_reqs: typing.Dict = {"process_as_ssml": ssml, "alphabet": self._alphabet}
 
+        # Segment to decrease latency and memory usage
         for segment_words, phone_seq, phone_counts in preprocess_sentences(
             text_string, ssml_reqs, self._normalizer.normalize, phonetize_fn
         ):
@@ -217,71 +504,165 @@ class FastSpeech2Synthesizer(VersionedThing):
             ):
                 continue
 
-            text_seq = torch.tensor(
-                [[FASTSPEECH2_SYMBOLS[phoneme] for phoneme in phone_seq]],
-                dtype=torch.int64,
-                device=self._device,
+            yield segment_words, phone_seq, phone_counts, prosody
+
+    def _run_acoustic_model(
+        self,
+        phone_seq: typing.List[str],
+        controls: typing.Tuple[float, float, float],
+    ) -> typing.Tuple[torch.Tensor, typing.List[float]]:
+        """Run the acoustic model, returning the mel and phone durations in ms."""
+        (
+            mel_postnet,
+            # Duration of each phoneme in log(millisec)
+            log_duration_output,
+        ) = self._acoustic_scheduler.submit(
+            ([FASTSPEECH2_SYMBOLS[phoneme] for phoneme in phone_seq], controls)
+        )
+
+        phone_durations = self._to_phone_durations(
+            phone_seq, log_duration_output, controls[0]
+        )
+        return mel_postnet, phone_durations
+
+    def _predict_durations(
+        self,
+        phone_seq: typing.List[str],
+        controls: typing.Tuple[float, float, float],
+    ) -> typing.List[float]:
+        """Predict the phone durations in ms, without synthesizing a mel if possible."""
+        if not hasattr(self._fs_model, "durations_only"):
+            # Models converted before durations_only was added
+            _, phone_durations = self._run_acoustic_model(phone_seq, controls)
+            return phone_durations
+
+        with torch.no_grad():
+            log_duration_output = self._fs_model.durations_only(
+                torch.tensor(
+                    [[FASTSPEECH2_SYMBOLS[phoneme] for phoneme in phone_seq]],
+                    dtype=torch.int64,
+                    device=self._device,
+                )
             )
+        return self._to_phone_durations(phone_seq, log_duration_output, controls[0])
 
-            (
-                mel_postnet,
-                # Duration of each phoneme in log(millisec)
-                log_duration_output,
-            ) = self._fs_model.inference(
-                text_seq,
-                d_control=duration_control,
-                p_control=pitch_control,
-                e_control=energy_control,
+    def _to_phone_durations(
+        self,
+        phone_seq: typing.List[str],
+        log_duration_output: torch.Tensor,
+        d_control: float,
+    ) -> typing.List[float]:
+        # The model uses 10 ms as the unit (or, technically, log(dur*10ms)). The
+        # prediction is made before the duration control is applied.
+        phone_durations = (
+            10
+            * d_control
+            * torch.exp(log_duration_output.detach()[0].to(torch.float32))
+        ).tolist()
+        if self._segment_cache:
+            # The predicted durations only depend on the duration control
+            self._segment_cache.put_durations(
+                self.version_hash, phone_seq, phone_durations, d_control
+            )
+        return phone_durations
+
+    def _synthesize_speech_marks(
+        self, segments: typing.Iterable[_Segment], prosody_mode: ProsodyMode
+    ) -> typing.Iterable[bytes]:
+        duration_time_offset = 0
+        for segment_words, phone_seq, phone_counts, prosody in segments:
+            controls = _controls(prosody, prosody_mode)
+            phone_durations = self._cached_durations(phone_seq, controls[0])
+            if phone_durations is None:
+                phone_durations = self._predict_durations(phone_seq, controls)
+
+            duration_time_offset = set_word_start_times(
+                segment_words,
+                phone_counts,
+                phone_durations,
+                start_time_milli=duration_time_offset,
+                # The durations from the model already account for the rate
+                rate_applied=prosody_mode == "model",
             )
 
-            if output_format == "json":
-                # The model uses 10 ms as the unit (or, technically, log(dur*10ms))
-                phone_durations = (
-                    10 * torch.exp(log_duration_output.detach()[0].to(torch.float32))
-                ).tolist()
-                word_durations = []
-                offset = 0
-                for count in phone_counts:
-                    word_durations.append(
-                        # type: ignore
-                        sum(phone_durations[offset : offset + count])
-                    )
-                    offset += count
-
-                segment_duration_time_offset: int = duration_time_offset
-                for idx, dur in enumerate(word_durations):
-                    segment_words[idx].start_time_milli = segment_duration_time_offset
-                    segment_duration_time_offset += int(
-                        dur
-                        / (
-                            segment_words[idx].ssml_props.rate  # type: ignore
-                            if isinstance(segment_words[idx].ssml_props, ProsodyProps)
-                            else 1
-                        )
-                    )
-
-                for word in segment_words:
-                    if word.is_spoken():
-                        yield word.to_json().encode("utf-8") + b"\n"
-
-                duration_time_offset += segment_duration_time_offset
-            else:
-                # 22050 Hz 16 bit linear PCM chunks
-                wav = self._do_vocoder_pass(mel_postnet).numpy()
-                chunk = wavarray_to_pcm(
-                    wav, src_sample_rate=22050, dst_sample_rate=sample_rate
+            for word in segment_words:
+                if word.is_spoken():
+                    yield word.to_json().encode("utf-8") + b"\n"
+
+    def _acoustic_stage(self, segment: _AudioSegment) -> _AudioSegment:
+        segment.chunk = self._cached_audio(segment.phone_seq, *segment.cache_params)
+        if segment.chunk is None:
+            segment.mel, phone_durations = self._run_acoustic_model(
+                segment.phone_seq, segment.controls
+            )
+            if segment.with_durations:
+                segment.phone_durations = phone_durations
+        elif segment.with_durations:
+            segment.phone_durations = self._cached_durations(
+                segment.phone_seq, segment.controls[0]
+            )
+            if segment.phone_durations is None:
+                segment.phone_durations = self._predict_durations(
+                    segment.phone_seq, segment.controls
                 )
+        return segment
+
+    def _vocoder_stage(self, segment: _AudioSegment) -> _AudioSegment:
+        if segment.mel is not None:
+            # 22050 Hz 16 bit linear PCM chunks
+            segment.wav = self._do_vocoder_pass(segment.mel).numpy()
+            segment.mel = None
+        return segment
+
+    def _pcm_stage(
+        self,
+        segment: _AudioSegment,
+        *,
+        sample_rate: int,
+        prosody_mode: ProsodyMode,
+        use_ffmpeg: bool,
+    ) -> _AudioSegment:
+        if segment.chunk is not None:
+            return segment
+
+        segment.chunk = segment_to_pcm(
+            segment.wav,
+            (
+                # Only the volume is left to apply
+                ffmpeg.Prosody(volume=segment.prosody.volume)
+                if prosody_mode == "model"
+                else segment.prosody
+            ),
+            src_sample_rate=22050,
+            dst_sample_rate=sample_rate,
+            prosody_mode=prosody_mode,
+            use_ffmpeg=use_ffmpeg,
+        )
+
+        segment.wav = None
+
+        if self._segment_cache:
+            self._segment_cache.put_audio(
+                self.version_hash,
+                segment.phone_seq,
+                segment.chunk,
+                *segment.cache_params,
+            )
+        return segment
+
+    def _cached_durations(
+        self, phone_seq: typing.List[str], *controls
+    ) -> Optional[typing.List[float]]:
+        if not self._segment_cache:
+            return None
+        return self._segment_cache.get_durations(
+            self.version_hash, phone_seq, *controls
+        )
 
-                if use_ffmpeg:
-                    yield ffmpeg.to_format(
-                        out_format=output_format,
-                        audio_content=chunk,
-                        src_sample_rate=str(sample_rate),
-                        sample_rate=str(sample_rate),
-                        prosody=prosody,
-                    )
-                else:
-                    yield chunk
+    def _cached_audio(self, phone_seq: typing.List[str], *params) -> Optional[bytes]:
+        if not self._segment_cache:
+            return None
+        return self._segment_cache.get_audio(self.version_hash, phone_seq, *params)
 
     @property
     def version_hash(self) -> str:
@@ -328,6 +709,11 @@ class FastSpeech2Voice(VoiceBase):
             sample_rate=int(kwargs["SampleRate"]),
             output_format=kwargs["OutputFormat"],
             use_ffmpeg=current_app.config["USE_FFMPEG"],
+            audio_encoder=current_app.config["AUDIO_ENCODER"],
+            prosody_mode=current_app.config["PROSODY_MODE"],
+            pipeline_depth=current_app.config["SYNTHESIS_PIPELINE_DEPTH"],
+            include_speech_marks=kwargs.get("IncludeSpeechMarks", False),
+            priority=kwargs.get("Priority", "interactive"),
         )
 
     def synthesize(
@@ -11,10 +11,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import logging
+import os
 from pathlib import Path
-from typing import Dict, List, Literal, Optional, TextIO, Union
+from typing import Dict, Iterable, List, Literal, Optional, TextIO, Union
 
 import google.protobuf.text_format
+import torch
 
 from proto.tiro.tts import voice_pb2
 from src.frontend.grapheme_to_phoneme import (
@@ -23,6 +26,7 @@ from src.frontend.grapheme_to_phoneme import (
     IceG2PTranslator,
     LangID,
     LexiconGraphemeToPhonemeTranslator,
+    MemoizedTranslator,
 )
 from src.frontend.lexicon import SimpleInMemoryLexicon
 from src.frontend.normalization import (
@@ -31,13 +35,19 @@ from src.frontend.normalization import (
     NormalizerBase,
 )
 from src.frontend.phonemes import Alphabet
+from src.utils.cache import LRUCache
 
 from . import aws, espnet2, fastspeech
+from .admission import AdmissionController, AdmittedVoice
 from .aws import PollyVoice
+from .cache import CachedVoice, SegmentCache, SynthesisCache
 from .espnet2 import Espnet2Synthesizer, Espnet2Voice
 from .fastspeech import FastSpeech2Synthesizer, FastSpeech2Voice
+from .priority import PriorityGate
 from .voice_base import VoiceBase, VoiceProperties
 
+_logger = logging.getLogger(__name__)
+
 
 class VoiceManager:
     _synthesizers: Dict[str, VoiceBase]
@@ -52,12 +62,35 @@ class VoiceManager:
         self._synthesizers = synthesizers
 
     @staticmethod
-    def from_pbtxt(pbtxt_path: Path) -> "VoiceManager":
+    def from_pbtxt(
+        pbtxt_path: Path,
+        cache: Optional[SynthesisCache] = None,
+        segment_cache: Optional[SegmentCache] = None,
+        priority_gate: Optional[PriorityGate] = None,
+    ) -> "VoiceManager":
+        """Load the voices described by a text SynthesisSet protobuf.
+
+        Args:
+          pbtxt_path: Path to a text protobuf of tiro.tts.SynthesisSet
+
+          cache: If supplied, all voices are wrapped with this response cache.
+
+          segment_cache: If supplied, this per segment cache is shared by all local
+              synthesizer backends.
+
+          priority_gate: If supplied, this gate is shared by all local synthesizer
+              backends, so interactive requests go ahead of bulk requests to any
+              voice.
+
+        """
         with pbtxt_path.open("rt") as pb_obj:
             synthesis_set: voice_pb2.SynthesisSet = google.protobuf.text_format.Parse(
                 pb_obj.read(), voice_pb2.SynthesisSet()
             )
 
+        # Before any models are loaded, so their threads are created accordingly
+        _configure_inference(synthesis_set.inference)
+
         phonetizers: Dict[str, GraphemeToPhonemeTranslatorBase] = {}
         for phonetizer in synthesis_set.phonetizers:
             phonetizers[phonetizer.name] = ComposedTranslator(
@@ -66,6 +99,11 @@ class VoiceManager:
                     for translator in phonetizer.translators
                 )
             )
+            if phonetizer.cache.max_entries:
+                phonetizers[phonetizer.name] = MemoizedTranslator(
+                    phonetizers[phonetizer.name],
+                    LRUCache(max_size=phonetizer.cache.max_entries),
+                )
 
         normalizers: Dict[str, NormalizerBase] = {}
         for normalizer in synthesis_set.normalizers:
@@ -96,6 +134,18 @@ class VoiceManager:
                             voice.fs2melgan.normalizer_name or "fallback"
                         ],
                         alphabet=_alphabet_pb_as_str(voice.fs2melgan.alphabet),
+                        segment_cache=segment_cache,
+                        priority_gate=priority_gate,
+                        acoustic_batching=(
+                            voice.fs2melgan.acoustic_batching
+                            if voice.fs2melgan.HasField("acoustic_batching")
+                            else None
+                        ),
+                        vocoder_batching=(
+                            voice.fs2melgan.vocoder_batching
+                            if voice.fs2melgan.HasField("vocoder_batching")
+                            else None
+                        ),
                     ),
                 )
                 synthesizers[props.voice_id] = fs
@@ -111,6 +161,13 @@ class VoiceManager:
                             voice.espnet2.normalizer_name or "fallback"
                         ],
                         alphabet=_alphabet_pb_as_str(voice.espnet2.alphabet),
+                        segment_cache=segment_cache,
+                        priority_gate=priority_gate,
+                        vocoder_batching=(
+                            voice.espnet2.vocoder_batching
+                            if voice.espnet2.HasField("vocoder_batching")
+                            else None
+                        ),
                     ),
                 )
             elif backend_name == "polly":
@@ -119,6 +176,25 @@ class VoiceManager:
             else:
                 raise ValueError("Unsupported backend {}".format(backend_name))
 
+            if voice.HasField("admission") and voice.admission.max_concurrent:
+                synthesizers[props.voice_id] = AdmittedVoice(
+                    synthesizers[props.voice_id],
+                    AdmissionController(
+                        max_concurrent=voice.admission.max_concurrent,
+                        max_queued=voice.admission.max_queued,
+                        queue_timeout_ms=voice.admission.queue_timeout_ms,
+                    ),
+                )
+            # Cached responses don't take up a synthesis slot
+            if cache:
+                synthesizers[props.voice_id] = CachedVoice(
+                    synthesizers[props.voice_id], cache
+                )
+
+        for phonetizer in synthesis_set.phonetizers:
+            if phonetizer.cache.max_entries and phonetizer.cache.seed_words_uri:
+                _seed_translation_cache(phonetizer, phonetizers, synthesis_set.voices)
+
         return VoiceManager(synthesizers=synthesizers, phonetizers=phonetizers)
 
     def __getitem__(self, key: str) -> VoiceBase:
@@ -128,6 +204,51 @@ class VoiceManager:
         return self._synthesizers.items()
 
 
+def _configure_inference(inference: voice_pb2.InferenceConfig) -> None:
+    """Apply the process wide inference configuration and log the resulting layout."""
+    if inference.cpu_affinity:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, inference.cpu_affinity)
+        else:
+            _logger.warning(
+                "CPU affinity is not supported on this platform, ignoring cpu_affinity"
+            )
+    if inference.intra_op_threads:
+        torch.set_num_threads(inference.intra_op_threads)
+    if inference.inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inference.inter_op_threads)
+        except RuntimeError:
+            # Can only be set once, and before any inter-op work has been done
+            _logger.warning(
+                "Could not set inter-op threads, already %d",
+                torch.get_num_interop_threads(),
+            )
+
+    cpus = (
+        sorted(os.sched_getaffinity(0))
+        if hasattr(os, "sched_getaffinity")
+        else list(range(os.cpu_count() or 1))
+    )
+    _logger.info(
+        "Inference parallelism: %d intra-op threads, %d inter-op threads, "
+        + "%d CPUs available (%s) of %d",
+        torch.get_num_threads(),
+        torch.get_num_interop_threads(),
+        len(cpus),
+        ",".join(str(cpu) for cpu in cpus),
+        os.cpu_count() or 1,
+    )
+    if torch.get_num_threads() > len(cpus):
+        _logger.warning(
+            "More intra-op threads (%d) than available CPUs (%d), each inference "
+            + "will be oversubscribed",
+            torch.get_num_threads(),
+            len(cpus),
+        )
+    _logger.debug("PyTorch parallel backend:\n%s", torch.__config__.parallel_info())
+
+
 def _gender_pb_as_str(
     gender_pb: voice_pb2.Voice.Gender,
 ) -> Optional[Literal["Male", "Female"]]:
@@ -164,6 +285,43 @@ def _parse_uri(uri: str) -> Path:
     return Path(uri[7:])
 
 
+def _seed_translation_cache(
+    phonetizer: voice_pb2.Phonetizer,
+    phonetizers: Dict[str, GraphemeToPhonemeTranslatorBase],
+    voices: Iterable[voice_pb2.Voice],
+) -> None:
+    """Fill the cache of a phonetizer with the words of its frequency list."""
+    translator = phonetizers[phonetizer.name]
+    assert isinstance(translator, MemoizedTranslator)
+
+    alphabets = set()
+    for voice in voices:
+        backend = getattr(voice, voice.WhichOneof("backend") or "", None)
+        if getattr(backend, "phonetizer_name", None) == phonetizer.name:
+            alphabets.add(_alphabet_pb_as_str(backend.alphabet))
+    if not alphabets:
+        return
+
+    # Each alphabet has its own entries, which all have to fit
+    max_words = phonetizer.cache.max_entries // len(alphabets)
+    words: List[str] = []
+    with _parse_uri(phonetizer.cache.seed_words_uri).open("rt") as words_f:
+        for line in words_f:
+            if len(words) >= max_words:
+                break
+            if line.strip():
+                words.append(line.split()[0])
+
+    for alphabet in sorted(alphabets):
+        translator.seed(words, LangID(phonetizer.language_code), alphabet=alphabet)
+    _logger.info(
+        "Seeded the translation cache of %s with %d words for %s",
+        phonetizer.name,
+        len(words),
+        ", ".join(sorted(alphabets)),
+    )
+
+
 def _translator_from_pb(
     pb: voice_pb2.Phonetizer.Translator,
     language_code: str,
@@ -174,6 +332,12 @@ def _translator_from_pb(
             lexicon=_parse_uri(pb.lexicon.uri),
             language_code=LangID(language_code),
             alphabet=_alphabet_pb_as_str(pb.lexicon.alphabet),
+            precompute_stress=pb.lexicon.precompute_stress,
+            lexicon_format=(
+                "compiled"
+                if pb.lexicon.format == voice_pb2.Lexicon.Format.COMPILED
+                else "kaldi"
+            ),
         )
     elif model_kind == "ice_g2p":
         if language_code != "is-IS":
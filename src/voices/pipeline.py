@@ -0,0 +1,136 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Sequence
+
+_DONE = object()
+
+# How often blocked stages check whether the consumer has gone away, in seconds
+_POLL_INTERVAL = 0.1
+
+
+class _Failure:
+    exception: BaseException
+
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+def pipelined(
+    source: Iterable[Any],
+    stages: Sequence[Callable[[Any], Any]],
+    maxsize: int = 1,
+    name: str = "pipeline",
+) -> Iterator[Any]:
+    """Run each item from source through stages, with each stage in its own thread.
+
+    The stages are connected with bounded queues, so while stage N processes item K,
+    stage N-1 can process item K+1. The order of the items is preserved. Iterating
+    the source is also done in a separate thread.
+
+    If a stage (or the source) raises an exception, it is re-raised in the consuming
+    thread. If the consumer stops iterating, e.g. because the client disconnected, all
+    stages stop after finishing their current item.
+
+    Args:
+      source: The input items
+
+      stages: Functions that each take the output of the previous stage
+
+      maxsize: Maximum number of items waiting between two stages. If 0, the stages
+          are run sequentially in the consuming thread.
+
+      name: Prefix for the names of the stage threads
+
+    Yields:
+      The output of the last stage for each item in source
+
+    """
+    if maxsize <= 0:
+        for item in source:
+            for stage in stages:
+                item = stage(item)
+            yield item
+        return
+
+    stop = threading.Event()
+    queues: List[queue.Queue] = [queue.Queue(maxsize) for _ in range(len(stages) + 1)]
+
+    def put(out_q: queue.Queue, item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                out_q.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(in_q: queue.Queue) -> Any:
+        while not stop.is_set():
+            try:
+                return in_q.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def feed() -> None:
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+        except Exception as ex:
+            put(queues[0], _Failure(ex))
+            return
+        put(queues[0], _DONE)
+
+    def run_stage(
+        stage: Callable[[Any], Any], in_q: queue.Queue, out_q: queue.Queue
+    ) -> None:
+        while True:
+            item = get(in_q)
+            if item is _DONE or isinstance(item, _Failure):
+                put(out_q, item)
+                return
+            try:
+                result = stage(item)
+            except Exception as ex:
+                put(out_q, _Failure(ex))
+                return
+            if not put(out_q, result):
+                return
+
+    threads = [threading.Thread(target=feed, name=f"{name}-source", daemon=True)]
+    for idx, stage in enumerate(stages):
+        threads.append(
+            threading.Thread(
+                target=run_stage,
+                args=(stage, queues[idx], queues[idx + 1]),
+                name=f"{name}-stage-{idx}",
+                daemon=True,
+            )
+        )
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,75 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+from typing import Iterable, Iterator, Literal, TypeVar
+
+Priority = Literal["interactive", "bulk"]
+
+T = TypeVar("T")
+
+
+class PriorityGate:
+    """Lets interactive syntheses go ahead of bulk syntheses at segment boundaries.
+
+    Segments of bulk requests are held back while any interactive request is being
+    synthesized, so interactive requests don't queue behind them for the model. A
+    bulk segment waits at most max_bulk_delay_ms, so bulk requests are slowed down
+    but never starved.
+
+    Example usage:
+    >>> gate = PriorityGate(max_bulk_delay_ms=2000)
+    >>> for segment in gate.prioritized(segments, "bulk"):
+    ...     synthesize(segment)
+
+    """
+
+    _max_bulk_delay: float
+    _cond: threading.Condition
+    _interactive: int
+
+    def __init__(self, max_bulk_delay_ms: int = 2000):
+        self._max_bulk_delay = max_bulk_delay_ms / 1000
+        self._cond = threading.Condition()
+        self._interactive = 0
+
+    @property
+    def interactive(self) -> int:
+        """Number of interactive syntheses in progress."""
+        return self._interactive
+
+    def prioritized(self, segments: Iterable[T], priority: Priority) -> Iterator[T]:
+        """Iterate segments, yielding to interactive requests if priority is bulk."""
+        if priority == "interactive":
+            with self._cond:
+                self._interactive += 1
+            try:
+                yield from segments
+            finally:
+                with self._cond:
+                    self._interactive -= 1
+                    self._cond.notify_all()
+        else:
+            for segment in segments:
+                self._wait_turn()
+                yield segment
+
+    def _wait_turn(self) -> None:
+        deadline = time.monotonic() + self._max_bulk_delay
+        with self._cond:
+            while self._interactive > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                self._cond.wait(remaining)
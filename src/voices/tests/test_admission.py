@@ -0,0 +1,105 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+from typing import Iterable
+
+import pytest
+
+from src.voices.admission import AdmissionController, AdmittedVoice, OverloadedError
+from src.voices.voice_base import VoiceBase, VoiceProperties
+
+
+class FakeVoice(VoiceBase):
+    def synthesize(self, text: str, ssml: bool = False, **kwargs) -> Iterable[bytes]:
+        for word in text.split():
+            yield word.encode("utf-8")
+
+    @property
+    def properties(self) -> VoiceProperties:
+        return VoiceProperties(voice_id="Fake")
+
+    @property
+    def version_hash(self) -> str:
+        return "fake"
+
+
+class TestAdmissionController:
+    def test_queue_full(self):
+        admission = AdmissionController(
+            max_concurrent=1, max_queued=0, queue_timeout_ms=1000
+        )
+        release = admission.acquire()
+        with pytest.raises(OverloadedError) as exc_info:
+            admission.acquire()
+        assert exc_info.value.status_code == 429
+        assert exc_info.value.retry_after >= 1
+
+        release()
+        release()
+        assert admission.active == 0
+        admission.acquire()
+
+    def test_queue_timeout(self):
+        admission = AdmissionController(
+            max_concurrent=1, max_queued=1, queue_timeout_ms=10
+        )
+        admission.acquire()
+        with pytest.raises(OverloadedError) as exc_info:
+            admission.acquire()
+        assert exc_info.value.status_code == 503
+        assert admission.queued == 0
+
+    def test_slot_is_handed_to_waiter(self):
+        admission = AdmissionController(
+            max_concurrent=1, max_queued=1, queue_timeout_ms=5000
+        )
+        release = admission.acquire()
+        admitted = threading.Event()
+
+        def wait_for_slot():
+            admission.acquire()
+            admitted.set()
+
+        waiter = threading.Thread(target=wait_for_slot)
+        waiter.start()
+        assert not admitted.wait(0.05)
+        release()
+        waiter.join()
+        assert admitted.is_set()
+        assert admission.active == 1
+
+
+class TestAdmittedVoice:
+    def test_slot_held_until_response_is_done(self):
+        admission = AdmissionController(
+            max_concurrent=1, max_queued=0, queue_timeout_ms=0
+        )
+        voice = AdmittedVoice(FakeVoice(), admission)
+
+        chunks = voice.synthesize("eitt tvö")
+        with pytest.raises(OverloadedError):
+            voice.synthesize("þrjú")
+        assert list(chunks) == [b"eitt", "tvö".encode("utf-8")]
+        assert admission.active == 0
+
+    def test_slot_released_on_close(self):
+        admission = AdmissionController(
+            max_concurrent=1, max_queued=0, queue_timeout_ms=0
+        )
+        voice = AdmittedVoice(FakeVoice(), admission)
+
+        chunks = voice.synthesize("eitt tvö")
+        next(chunks)
+        chunks.close()
+        assert admission.active == 0
@@ -0,0 +1,63 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+
+import boto3
+import pytest
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from src.voices.aws import SUPPORTED_OUTPUT_FORMATS, PollySession, PollyVoice
+from src.voices.voice_base import VoiceProperties
+
+
+@pytest.fixture
+def polly(monkeypatch):
+    client = boto3.client(
+        "polly",
+        region_name="eu-west-1",
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+    )
+    # The stubber validates the request parameters against the Polly API
+    with Stubber(client) as stubber:
+        monkeypatch.setattr(PollySession, "get_client", classmethod(lambda _: client))
+        yield stubber
+
+
+class TestPollyVoice:
+    def test_synthesize(self, polly):
+        request = {
+            "OutputFormat": "mp3",
+            "SampleRate": "22050",
+            "Text": "Hæ hæ",
+            "TextType": "text",
+            "VoiceId": "Dora",
+        }
+        polly.add_response(
+            "synthesize_speech",
+            {"AudioStream": StreamingBody(io.BytesIO(b"audio"), len(b"audio"))},
+            expected_params=request,
+        )
+        voice = PollyVoice(
+            VoiceProperties(
+                voice_id="Dora", supported_output_formats=SUPPORTED_OUTPUT_FORMATS
+            )
+        )
+
+        chunks = voice.synthesize(
+            request["Text"], IncludeSpeechMarks=False, Priority="bulk", **request
+        )
+        assert list(chunks) == [b"audio"]
+        polly.assert_no_pending_responses()
@@ -0,0 +1,70 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import pytest
+
+from src.voices.batching import BatchScheduler
+
+
+class RecordingBatchFn:
+    batches: List[List[int]]
+
+    def __init__(self):
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def __call__(self, items: List[int]) -> List[int]:
+        with self._lock:
+            self.batches.append(list(items))
+        return [item * 2 for item in items]
+
+
+class TestBatchScheduler:
+    def test_unbatched(self):
+        batch_fn = RecordingBatchFn()
+        scheduler = BatchScheduler(batch_fn)
+        assert not scheduler.enabled
+        assert scheduler.submit(21) == 42
+        assert batch_fn.batches == [[21]]
+
+    def test_concurrent_items_are_batched(self):
+        batch_fn = RecordingBatchFn()
+        scheduler = BatchScheduler(batch_fn, max_batch_size=4, max_wait_ms=200)
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(scheduler.submit, range(4)))
+        assert results == [0, 2, 4, 6]
+        assert len(batch_fn.batches) < 4
+        assert sorted(sum(batch_fn.batches, [])) == [0, 1, 2, 3]
+        assert all(len(batch) <= 4 for batch in batch_fn.batches)
+
+    def test_groups_are_not_mixed(self):
+        batch_fn = RecordingBatchFn()
+        scheduler = BatchScheduler(
+            batch_fn, max_batch_size=8, max_wait_ms=200, group_key=lambda x: x % 2
+        )
+        with ThreadPoolExecutor(6) as executor:
+            list(executor.map(scheduler.submit, range(6)))
+        for batch in batch_fn.batches:
+            assert len({item % 2 for item in batch}) == 1
+
+    def test_exception_is_propagated(self):
+        def failing_fn(items):
+            raise RuntimeError("boom")
+
+        scheduler = BatchScheduler(failing_fn, max_batch_size=2, max_wait_ms=1)
+        with pytest.raises(RuntimeError):
+            scheduler.submit(1)
@@ -0,0 +1,137 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Iterable
+
+import pytest
+
+from src.utils.cache import LRUCache
+from src.voices.cache import CachedVoice, DiskCache, SegmentCache, SynthesisCache
+from src.voices.voice_base import VoiceBase, VoiceProperties
+
+
+class CountingVoice(VoiceBase):
+    calls: int
+
+    def __init__(self):
+        self.calls = 0
+
+    def synthesize(self, text: str, ssml: bool = False, **kwargs) -> Iterable[bytes]:
+        self.calls += 1
+        for word in text.split():
+            yield word.encode()
+
+    @property
+    def properties(self) -> VoiceProperties:
+        return VoiceProperties(voice_id="Counting")
+
+    @property
+    def version_hash(self) -> str:
+        return "counting-v1"
+
+
+REQUEST = {"VoiceId": "Counting", "OutputFormat": "mp3", "SampleRate": "22050"}
+
+
+class TestLRUCache:
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        assert cache.get("a") == 1
+        cache.put("c", 3)
+        assert "a" in cache
+        assert "b" not in cache
+        assert "c" in cache
+
+    def test_size_fn(self):
+        cache = LRUCache(max_size=10, size_fn=len)
+        cache.put("a", b"12345")
+        cache.put("b", b"123456")
+        assert "a" not in cache
+        assert cache.size == 6
+        cache.put("c", b"12345678901")
+        assert "c" not in cache
+
+    def test_counters(self):
+        cache = LRUCache(max_size=1)
+        cache.put("a", 1)
+        cache.get("a")
+        cache.get("b")
+        assert (cache.hits, cache.misses) == (1, 1)
+
+
+class TestDiskCache:
+    def test_roundtrip(self, tmp_path):
+        cache = DiskCache(tmp_path, max_bytes=100)
+        cache.put("abcdef", b"content")
+        assert cache.get("abcdef") == b"content"
+        assert cache.get("fedcba") is None
+
+    def test_size_based_eviction(self, tmp_path):
+        cache = DiskCache(tmp_path, max_bytes=10)
+        cache.put("aa01", b"123456")
+        cache.put("bb02", b"123456")
+        assert cache.get("aa01") is None
+        assert cache.get("bb02") == b"123456"
+
+
+class TestSegmentCache:
+    def test_durations_keyed_on_controls(self):
+        cache = SegmentCache(max_bytes=1024)
+        cache.put_durations("v1", ["a", "b"], [10.0, 20.0], 1.0)
+        assert cache.get_durations("v1", ["a", "b"], 1.0) == [10.0, 20.0]
+        assert cache.get_durations("v1", ["a", "b"], 1.5) is None
+        assert cache.get_durations("v2", ["a", "b"], 1.0) is None
+
+    def test_audio_keyed_on_params(self):
+        cache = SegmentCache(max_bytes=1024)
+        cache.put_audio("v1", ["a"], b"chunk", None, 22050, "mp3")
+        assert cache.get_audio("v1", ["a"], None, 22050, "mp3") == b"chunk"
+        assert cache.get_audio("v1", ["a"], None, 16000, "mp3") is None
+        assert cache.get_audio("v1", ["a", "b"], None, 22050, "mp3") is None
+
+
+class TestCachedVoice:
+    @pytest.fixture(params=[False, True])
+    def cache(self, request, tmp_path):
+        return SynthesisCache(
+            max_memory_bytes=1024,
+            disk_cache_dir=tmp_path if request.param else None,
+            max_disk_bytes=1024,
+        )
+
+    def test_second_request_is_cached(self, cache):
+        inner = CountingVoice()
+        voice = CachedVoice(inner, cache)
+        first = b"".join(voice.synthesize("hæ hæ", **REQUEST))
+        second = b"".join(voice.synthesize("hæ hæ", **REQUEST))
+        assert first == second
+        assert inner.calls == 1
+
+    def test_key_includes_request_params(self, cache):
+        inner = CountingVoice()
+        voice = CachedVoice(inner, cache)
+        list(voice.synthesize("hæ hæ", **REQUEST))
+        list(voice.synthesize("hæ hæ", **{**REQUEST, "OutputFormat": "ogg_vorbis"}))
+        list(voice.synthesize("hæ", **REQUEST))
+        list(voice.synthesize("hæ", **{**REQUEST, "IncludeSpeechMarks": True}))
+        assert inner.calls == 4
+
+    def test_interrupted_response_not_cached(self, cache):
+        inner = CountingVoice()
+        voice = CachedVoice(inner, cache)
+        chunks = iter(voice.synthesize("eitt tvö þrjú", **REQUEST))
+        next(chunks)
+        list(voice.synthesize("eitt tvö þrjú", **REQUEST))
+        assert inner.calls == 2
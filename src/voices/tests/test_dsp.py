@@ -0,0 +1,68 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+import pytest
+
+from src.ffmpeg import Prosody
+from src.voices import dsp
+
+SAMPLE_RATE = 22050
+
+
+def _tone(freq: float = 220.0, seconds: float = 1.0) -> np.ndarray:
+    t = np.arange(int(SAMPLE_RATE * seconds)) / SAMPLE_RATE
+    return (8000 * np.sin(2 * np.pi * freq * t)).astype(np.int16)
+
+
+def _peak_freq(samples: np.ndarray) -> float:
+    spectrum = np.abs(np.fft.rfft(samples * np.hanning(len(samples))))
+    return float(np.argmax(spectrum) * SAMPLE_RATE / len(samples))
+
+
+class TestTimeStretch:
+    @pytest.mark.parametrize("rate", [0.5, 0.75, 1.25, 2.0])
+    def test_duration_changes_pitch_does_not(self, rate):
+        samples = _tone()
+        stretched = dsp.time_stretch(samples, rate, SAMPLE_RATE)
+        assert len(stretched) == int(len(samples) / rate)
+        assert _peak_freq(stretched) == pytest.approx(220.0, abs=3.0)
+
+    def test_invalid_rate(self):
+        with pytest.raises(ValueError):
+            dsp.time_stretch(_tone(), 0.0, SAMPLE_RATE)
+
+
+class TestPitchShift:
+    @pytest.mark.parametrize("pitch", [0.8, 1.2])
+    def test_pitch_changes_duration_does_not(self, pitch):
+        samples = _tone()
+        shifted = dsp.pitch_shift(samples, pitch, SAMPLE_RATE)
+        assert abs(len(shifted) - len(samples)) <= 2
+        assert _peak_freq(shifted) == pytest.approx(220.0 * pitch, abs=3.0)
+
+
+class TestApplyProsody:
+    def test_default_prosody_is_a_noop(self):
+        samples = _tone()
+        assert dsp.apply_prosody(samples, SAMPLE_RATE, Prosody()) is samples
+
+    def test_volume(self):
+        samples = _tone()
+        louder = dsp.apply_prosody(samples, SAMPLE_RATE, Prosody(volume=6.0))
+        assert louder.dtype == np.int16
+        assert np.abs(louder).max() == pytest.approx(2 * 8000, rel=0.01)
+
+    def test_output_is_clipped(self):
+        louder = dsp.apply_prosody(_tone(), SAMPLE_RATE, Prosody(volume=20.0))
+        assert np.abs(louder.astype(np.int32)).max() <= 32768
@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
 from pathlib import Path
 
 import pytest
@@ -43,3 +44,20 @@ class TestEspnet2Backend:
         text = "Hehe hvað heiti ég?"
         chunks = list(self.backend.synthesize(text, sample_rate=8000))
         assert len(chunks) > 0
+
+    def test_speech_marks_follow_model_rate(self):
+        if not self.backend.supports_speech_marks:
+            pytest.skip("Model has no durations")
+
+        def last_word_time(text: str) -> int:
+            marks = b"".join(
+                self.backend.synthesize(
+                    text, ssml=True, output_format="json", prosody_mode="model"
+                )
+            )
+            return json.loads(marks.decode("utf-8").splitlines()[-1])["time"]
+
+        text = "Hæ hæ, hver ert þú?"
+        normal = last_word_time(f"<speak>{text}</speak>")
+        fast = last_word_time(f'<speak><prosody rate="200%">{text}</prosody></speak>')
+        assert fast < normal
@@ -0,0 +1,86 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+
+import pytest
+
+from src.voices.pipeline import pipelined
+
+
+@pytest.fixture(params=[0, 1, 3])
+def maxsize(request):
+    return request.param
+
+
+def test_order_is_preserved(maxsize):
+    stages = [lambda x: x + 1, lambda x: x * 2, str]
+    assert list(pipelined(range(10), stages, maxsize=maxsize)) == [
+        str((x + 1) * 2) for x in range(10)
+    ]
+
+
+def test_stages_overlap():
+    active = set()
+    overlapped = threading.Event()
+    lock = threading.Lock()
+
+    def make_stage(idx):
+        def stage(item):
+            with lock:
+                active.add(idx)
+                if len(active) > 1:
+                    overlapped.set()
+            time.sleep(0.05)
+            with lock:
+                active.discard(idx)
+            return item
+
+        return stage
+
+    list(pipelined(range(5), [make_stage(0), make_stage(1)], maxsize=1))
+    assert overlapped.is_set()
+
+
+def test_exception_is_propagated(maxsize):
+    def failing_stage(item):
+        if item == 3:
+            raise ValueError("bad item")
+        return item
+
+    with pytest.raises(ValueError):
+        list(pipelined(range(10), [failing_stage], maxsize=maxsize))
+
+
+def test_source_exception_is_propagated(maxsize):
+    def source():
+        yield 1
+        raise ValueError("bad source")
+
+    with pytest.raises(ValueError):
+        list(pipelined(source(), [lambda x: x], maxsize=maxsize))
+
+
+def test_closing_stops_stages():
+    processed = []
+
+    def stage(item):
+        processed.append(item)
+        return item
+
+    items = pipelined(range(1000), [stage], maxsize=1)
+    assert next(items) == 0
+    items.close()
+    time.sleep(0.5)
+    assert len(processed) < 1000
@@ -0,0 +1,53 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+
+from src.voices.priority import PriorityGate
+
+
+class TestPriorityGate:
+    def test_bulk_waits_for_interactive(self):
+        gate = PriorityGate(max_bulk_delay_ms=5000)
+        interactive = gate.prioritized(["a", "b"], "interactive")
+        assert next(interactive) == "a"
+        assert gate.interactive == 1
+
+        bulk_segments = []
+
+        def run_bulk():
+            bulk_segments.extend(gate.prioritized(["x", "y"], "bulk"))
+
+        bulk = threading.Thread(target=run_bulk)
+        bulk.start()
+        time.sleep(0.05)
+        assert bulk_segments == []
+
+        assert list(interactive) == ["b"]
+        assert gate.interactive == 0
+        bulk.join()
+        assert bulk_segments == ["x", "y"]
+
+    def test_bulk_is_not_starved(self):
+        gate = PriorityGate(max_bulk_delay_ms=10)
+        interactive = gate.prioritized(["a", "b"], "interactive")
+        next(interactive)
+        assert list(gate.prioritized(["x", "y"], "bulk")) == ["x", "y"]
+
+    def test_closed_interactive_request(self):
+        gate = PriorityGate()
+        interactive = gate.prioritized(["a", "b"], "interactive")
+        next(interactive)
+        interactive.close()
+        assert gate.interactive == 0
@@ -0,0 +1,91 @@
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import base64
+import json
+
+from src import ffmpeg, sndfile
+from src.frontend.words import ProsodyProps, Word
+from src.voices.utils import (
+    encode_pcm_stream,
+    encode_with_speech_marks,
+    set_word_start_times,
+)
+
+
+class TestEncodePcmStream:
+    def test_unsupported_soundfile_format_uses_ffmpeg(self, monkeypatch):
+        monkeypatch.setattr(sndfile, "is_supported", lambda out_format: False)
+        monkeypatch.setattr(
+            ffmpeg,
+            "to_format_stream",
+            lambda chunks, *, out_format, **kwargs: [out_format.encode("ascii")],
+        )
+        encoded = encode_pcm_stream(
+            [b"\x01\x00"],
+            output_format="mp3",
+            sample_rate=22050,
+            audio_encoder="soundfile",
+        )
+        assert list(encoded) == [b"mp3"]
+
+
+class TestEncodeWithSpeechMarks:
+    def test_marks_precede_audio(self):
+        first = [Word("hæ", "hæ"), Word("!", "!")]
+        second = [Word("þú", "þú")]
+        first[0].start_time_milli = 0
+        second[0].start_time_milli = 250
+
+        lines = [
+            json.loads(line)
+            for line in encode_with_speech_marks(
+                [(first, b"\x01\x00"), (second, b"\x02\x00")],
+                output_format="pcm",
+                sample_rate=22050,
+                use_ffmpeg=False,
+            )
+        ]
+        assert [line["type"] for line in lines] == ["word", "audio", "word", "audio"]
+        assert [line["value"] for line in lines if line["type"] == "word"] == [
+            "hæ",
+            "þú",
+        ]
+        assert lines[2]["time"] == 250
+        audio = b"".join(
+            base64.b64decode(line["data"]) for line in lines if line["type"] == "audio"
+        )
+        assert audio == b"\x01\x00\x02\x00"
+
+
+class TestSetWordStartTimes:
+    def test_start_times(self):
+        words = [Word("hæ", "hæ"), Word("þú", "þú")]
+        end = set_word_start_times(
+            words, [2, 2], [10.0, 20.0, 30.0, 40.0], start_time_milli=100
+        )
+        assert [word.start_time_milli for word in words] == [100, 130]
+        assert end == 200
+
+    def test_rate(self):
+        props = ProsodyProps(tag_val="<prosody>", data="", rate="200%")
+        words = [Word("hæ", "hæ", ssml_props=props), Word("þú", "þú", ssml_props=props)]
+        end = set_word_start_times(words, [1, 1], [100.0, 100.0], start_time_milli=0)
+        assert [word.start_time_milli for word in words] == [0, 50]
+        assert end == 100
+
+        end = set_word_start_times(
+            words, [1, 1], [50.0, 50.0], start_time_milli=0, rate_applied=True
+        )
+        assert [word.start_time_milli for word in words] == [0, 50]
+        assert end == 100
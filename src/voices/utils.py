@@ -11,11 +11,23 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import base64
+import collections
+import json
 import sys
+from typing import Deque, Iterable, Iterator, List, Literal, Tuple
 
 import numpy as np
 import resampy
 
+from src import ffmpeg, sndfile
+from src.frontend.words import ProsodyProps, Word
+
+from . import dsp
+
+# How SSML prosody is applied, see segment_to_pcm
+ProsodyMode = Literal["ffmpeg", "native", "model"]
+
 
 def wavarray_to_pcm(
     array: np.ndarray, src_sample_rate: int = 22050, dst_sample_rate: int = 22050
@@ -34,3 +46,181 @@ def wavarray_to_pcm(
     return to_pcm_bytes(
         resampy.resample(orig_samples, src_sample_rate, dst_sample_rate)
     )
+
+
+def segment_to_pcm(
+    array: np.ndarray,
+    prosody: ffmpeg.Prosody,
+    *,
+    src_sample_rate: int,
+    dst_sample_rate: int,
+    prosody_mode: ProsodyMode = "ffmpeg",
+    use_ffmpeg: bool = True,
+) -> bytes:
+    """Apply prosody to a synthesized segment and convert it to a PCM byte chunk.
+
+    Args:
+      array: int16 samples of the segment at src_sample_rate
+      prosody: The SSML prosody of the segment
+      src_sample_rate: Sample rate of array
+      dst_sample_rate: Sample rate of the returned PCM chunk
+      prosody_mode: Apply prosody with ffmpeg filters or in-process with NumPy. In
+          model mode, the model has already applied (some of) the prosody and the
+          rest is applied in-process, so prosody should only contain the rest.
+      use_ffmpeg: If False, prosody is ignored in ffmpeg mode
+
+    """
+    if prosody_mode in ("native", "model"):
+        array = dsp.apply_prosody(array, src_sample_rate, prosody)
+    elif prosody_mode != "ffmpeg":
+        raise ValueError(f"Unknown prosody mode '{prosody_mode}'")
+
+    chunk = wavarray_to_pcm(
+        array, src_sample_rate=src_sample_rate, dst_sample_rate=dst_sample_rate
+    )
+    if prosody_mode == "ffmpeg" and use_ffmpeg and not prosody.is_default:
+        chunk = ffmpeg.to_format(
+            out_format="pcm",
+            audio_content=chunk,
+            src_sample_rate=str(dst_sample_rate),
+            sample_rate=str(dst_sample_rate),
+            prosody=prosody,
+        )
+    return chunk
+
+
+def encode_pcm_stream(
+    chunks: Iterable[bytes],
+    *,
+    output_format: Literal["pcm", "mp3", "ogg_vorbis"],
+    sample_rate: int,
+    audio_encoder: Literal["ffmpeg", "soundfile"] = "ffmpeg",
+    use_ffmpeg: bool = True,
+) -> Iterable[bytes]:
+    """Encode the PCM chunks of a response as a single stream in output_format.
+
+    Args:
+      chunks: 16 bit linear PCM chunks at sample_rate
+      output_format: The output audio format
+      sample_rate: Sample rate of the chunks and the output
+      audio_encoder: Encode with an ffmpeg subprocess or in-process with libsndfile.
+          Formats the installed libsndfile can't encode are encoded with ffmpeg.
+      use_ffmpeg: If False and audio_encoder is ffmpeg, the PCM chunks are returned
+          unencoded
+
+    """
+    if audio_encoder == "soundfile":
+        if sndfile.is_supported(output_format):
+            return sndfile.to_format_stream(
+                chunks, out_format=output_format, sample_rate=str(sample_rate)
+            )
+    elif audio_encoder != "ffmpeg":
+        raise ValueError(f"Unknown audio encoder '{audio_encoder}'")
+    elif not use_ffmpeg:
+        return chunks
+    return ffmpeg.to_format_stream(
+        chunks,
+        out_format=output_format,
+        sample_rate=str(sample_rate),
+        src_sample_rate=str(sample_rate),
+    )
+
+
+def encode_with_speech_marks(
+    segments: Iterable[Tuple[List[Word], bytes]],
+    *,
+    output_format: Literal["pcm", "mp3", "ogg_vorbis"],
+    sample_rate: int,
+    audio_encoder: Literal["ffmpeg", "soundfile"] = "ffmpeg",
+    use_ffmpeg: bool = True,
+) -> Iterable[bytes]:
+    """Encode the PCM chunks of a response along with the speech marks of its words.
+
+    The output is a stream of JSON lines, where word speech marks are interleaved
+    with the encoded audio as base64 encoded chunks, e.g.
+
+        {"time": 0, "type": "word", "start": 0, "end": 3, "value": "Hæ"}
+        {"type": "audio", "data": "SUQzBAAAAAAAI1RTU0UAAAAPAAADTGF2ZjU4Lj..."}
+
+    The speech marks of a segment always come before any of its audio. Decoding the
+    audio chunks and concatenating them gives the same content as
+    `encode_pcm_stream`.
+
+    Args:
+      segments: The words of each segment, with their start times set, and the 16 bit
+          linear PCM chunk of the segment at sample_rate
+      output_format: The output audio format
+      sample_rate: Sample rate of the chunks and the output
+      audio_encoder: Encode with an ffmpeg subprocess or in-process with libsndfile
+      use_ffmpeg: If False and audio_encoder is ffmpeg, the PCM chunks are returned
+          unencoded
+
+    """
+    # The encoder may consume the chunks in another thread, the deque is thread safe
+    pending_marks: Deque[bytes] = collections.deque()
+
+    def pcm_chunks() -> Iterator[bytes]:
+        for segment_words, chunk in segments:
+            pending_marks.extend(
+                word.to_json().encode("utf-8") + b"\n"
+                for word in segment_words
+                if word.is_spoken()
+            )
+            yield chunk
+
+    def interleave(content_chunks: Iterable[bytes]) -> Iterator[bytes]:
+        for content in content_chunks:
+            # Audio only comes out of the encoder after the segment it belongs to has
+            # gone in, so its marks are already pending
+            while pending_marks:
+                yield pending_marks.popleft()
+            yield json.dumps(
+                {"type": "audio", "data": base64.b64encode(content).decode("ascii")}
+            ).encode("utf-8") + b"\n"
+        while pending_marks:
+            yield pending_marks.popleft()
+
+    return interleave(
+        encode_pcm_stream(
+            pcm_chunks(),
+            output_format=output_format,
+            sample_rate=sample_rate,
+            audio_encoder=audio_encoder,
+            use_ffmpeg=use_ffmpeg,
+        )
+    )
+
+
+def set_word_start_times(
+    segment_words: List[Word],
+    phone_counts: List[int],
+    phone_durations: List[float],
+    *,
+    start_time_milli: int,
+    rate_applied: bool = False,
+) -> int:
+    """Set the start times of the words in a segment from predicted phone durations.
+
+    Args:
+      segment_words: The words of the segment
+      phone_counts: The number of phones in each word
+      phone_durations: The duration of each phone in the segment in milliseconds
+      start_time_milli: The start time of the segment
+      rate_applied: Whether the durations already account for the SSML prosody rate
+          of the words, otherwise they are scaled by it
+
+    Returns:
+      The end time of the segment
+
+    """
+    time_milli = start_time_milli
+    offset = 0
+    for word, count in zip(segment_words, phone_counts):
+        duration = sum(phone_durations[offset : offset + count])
+        offset += count
+
+        word.start_time_milli = time_milli
+        if isinstance(word.ssml_props, ProsodyProps) and not rate_applied:
+            duration /= word.ssml_props.rate
+        time_milli += int(duration)
+    return time_milli
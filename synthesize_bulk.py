@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# Copyright 2022 Tiro ehf.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import base64
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import textwrap
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import torch
+from flask import Flask
+
+from src import ffmpeg
+from src.config import EnvvarConfig
+from src.voices import VoiceManager
+from src.voices.admission import OverloadedError
+from src.voices.cache import SegmentCache
+
+_EXTENSIONS = {"mp3": "mp3", "ogg_vorbis": "ogg", "pcm": "pcm"}
+
+# Item IDs are used as file names
+_ITEM_ID_RE = re.compile(r"[\w-][\w.-]*")
+
+# Per process state, set up by _init_worker
+_app: Flask
+_voices: VoiceManager
+_options: argparse.Namespace
+
+
+def read_manifest(path: Path) -> Iterator[Dict[str, Any]]:
+    """Read the items of a JSONL or TSV manifest.
+
+    Each line of a JSONL manifest is an object with the keys Id, VoiceId and Text and
+    optionally TextType, OutputFormat and SampleRate, i.e. the same as a request to
+    /v0/speech. Each line of a TSV manifest has the columns id, voice ID and text.
+    """
+    with path.open("rt", encoding="utf-8") as manifest_f:
+        if path.suffix == ".tsv":
+            for row in csv.reader(
+                manifest_f, delimiter="\t", quoting=csv.QUOTE_NONE, strict=True
+            ):
+                if row:
+                    item_id, voice_id, text = row
+                    yield {"Id": item_id, "VoiceId": voice_id, "Text": text}
+        else:
+            for line in manifest_f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def output_paths(
+    item: Dict[str, Any], options: argparse.Namespace
+) -> Tuple[Path, Path]:
+    """Get the paths to the audio and speech marks outputs of an item."""
+    if not _ITEM_ID_RE.fullmatch(str(item["Id"])):
+        raise ValueError(f"Invalid item ID '{item['Id']}'")
+    output_format = item.get("OutputFormat", options.output_format)
+    return (
+        options.output_dir / f"{item['Id']}.{_EXTENSIONS[output_format]}",
+        options.output_dir / f"{item['Id']}.marks.jsonl",
+    )
+
+
+def _init_worker(options: argparse.Namespace):
+    global _app, _voices, _options
+
+    # The voices read their configuration from the Flask app config, the context is
+    # pushed again on the threads that synthesize, see _synthesize_item
+    app = Flask(__name__)
+    app.config.from_object(EnvvarConfig)
+    app.app_context().push()
+
+    ffmpeg.configure(
+        max_processes=app.config["FFMPEG_MAX_PROCESSES"],
+        warm_processes=app.config["FFMPEG_WARM_PROCESSES"],
+    )
+    _voices = VoiceManager.from_pbtxt(
+        options.synthesis_set,
+        segment_cache=(
+            SegmentCache(max_bytes=app.config["SEGMENT_CACHE_MAX_BYTES"])
+            if app.config["SEGMENT_CACHE_MAX_BYTES"] > 0
+            else None
+        ),
+    )
+    # Overrides the inference config of the SynthesisSet
+    if options.torch_threads:
+        torch.set_num_threads(options.torch_threads)
+    _app = app
+    _options = options
+
+
+def _synthesize_items(items: List[Dict[str, Any]]) -> List[Tuple[str, Optional[str]]]:
+    # Synthesize concurrently, so the segments of different items can be batched by
+    # the voices, see BatchingConfig in voice.proto
+    with ThreadPoolExecutor(max_workers=_options.threads) as executor:
+        return list(executor.map(_synthesize_item, items))
+
+
+def _synthesize_item(item: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+    """Synthesize an item, returning its ID and an error message if it failed."""
+    # Runs on an executor thread, which doesn't inherit the app context
+    with _app.app_context():
+        return _synthesize_item_in_context(item)
+
+
+def _synthesize_item_in_context(item: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+    try:
+        audio_path, marks_path = output_paths(item, _options)
+        voice = _voices[item["VoiceId"]]
+        request = {
+            "OutputFormat": item.get("OutputFormat", _options.output_format),
+            "SampleRate": str(item.get("SampleRate", _options.sample_rate)),
+            "Text": item["Text"],
+            "TextType": item.get("TextType", "text"),
+            "VoiceId": item["VoiceId"],
+        }
+        if (
+            request["OutputFormat"] not in _EXTENSIONS
+            or (request["OutputFormat"], request["SampleRate"])
+            not in voice.properties.supported_output_formats
+        ):
+            raise ValueError("Unsupported output format or sample rate")
+        if _options.speech_marks:
+            request.update(IncludeSpeechMarks=True, SpeechMarkTypes=["word"])
+
+        # Written to temporary files first, so an output only exists once complete
+        audio_tmp = audio_path.with_name(audio_path.name + ".tmp")
+        marks_tmp = marks_path.with_name(marks_path.name + ".tmp")
+        while True:
+            try:
+                chunks = voice.synthesize(
+                    item["Text"], ssml=request["TextType"] == "ssml", **request
+                )
+                break
+            except OverloadedError as ex:
+                # The voice has admission control configured, wait for a slot
+                time.sleep(ex.retry_after)
+        with audio_tmp.open("wb") as audio_f:
+            if _options.speech_marks:
+                with marks_tmp.open("wb") as marks_f:
+                    _split_speech_marks(chunks, audio_f, marks_f)
+                os.replace(marks_tmp, marks_path)
+            else:
+                for chunk in chunks:
+                    audio_f.write(chunk)
+        # The audio is moved in place last, its existence marks the item as done
+        os.replace(audio_tmp, audio_path)
+    except Exception as ex:
+        logging.debug("Synthesis of item %s failed", item.get("Id"), exc_info=True)
+        return str(item.get("Id")), f"{type(ex).__name__}: {ex}"
+    return str(item["Id"]), None
+
+
+def _split_speech_marks(chunks: Iterable[bytes], audio_f, marks_f) -> None:
+    """Split a response with IncludeSpeechMarks into audio and speech marks."""
+    pending = b""
+    for chunk in chunks:
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            mark = json.loads(line)
+            if mark["type"] == "audio":
+                audio_f.write(base64.b64decode(mark["data"]))
+            else:
+                marks_f.write(line + b"\n")
+
+
+def _batches(items: List[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    for idx in range(0, len(items), size):
+        yield items[idx : idx + size]
+
+
+def main(args: argparse.Namespace) -> int:
+    logging.basicConfig(level=args.log_level)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    items = list(read_manifest(args.manifest))
+    todo = []
+    for item in items:
+        audio_path, _ = output_paths(item, args)
+        if not (args.resume and audio_path.exists()):
+            todo.append(item)
+    logging.info(
+        "Synthesizing %d items, skipping %d already done",
+        len(todo),
+        len(items) - len(todo),
+    )
+
+    failed = 0
+    # Spawn, since forking after PyTorch has been initialized is unsafe
+    with multiprocessing.get_context("spawn").Pool(
+        args.processes, initializer=_init_worker, initargs=(args,)
+    ) as pool:
+        for results in pool.imap_unordered(
+            _synthesize_items, _batches(todo, args.threads)
+        ):
+            for item_id, error in results:
+                if error:
+                    failed += 1
+                    logging.error("Item %s failed: %s", item_id, error)
+                else:
+                    logging.info("Item %s done", item_id)
+
+    logging.info("Done, %d of %d items failed", failed, len(todo))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(
+            """\
+            Synthesize a manifest of texts to files with the voices of a SynthesisSet,
+            without going through the HTTP service. The service configuration
+            environment variables (see src/config.py) apply.
+            """
+        )
+    )
+    parser.add_argument(
+        "manifest",
+        type=Path,
+        help=(
+            "JSONL manifest with the keys Id, VoiceId, Text and optionally TextType, "
+            + "OutputFormat and SampleRate, or a TSV manifest (*.tsv) with the "
+            + "columns id, voice ID and text"
+        ),
+    )
+    parser.add_argument(
+        "output_dir",
+        type=Path,
+        help="Output directory, the output of each item is named after its Id",
+    )
+    parser.add_argument(
+        "--synthesis-set",
+        type=Path,
+        default=Path(EnvvarConfig.SYNTHESIS_SET_PB),
+        help="Text SynthesisSet protobuf with the voices",
+    )
+    parser.add_argument("--output-format", choices=tuple(_EXTENSIONS), default="mp3")
+    parser.add_argument("--sample-rate", default="22050")
+    parser.add_argument(
+        "--speech-marks",
+        action="store_true",
+        help=(
+            "Also write word speech marks for each item to <Id>.marks.jsonl, from "
+            + "the same synthesis pass as the audio"
+        ),
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Number of worker processes, each with its own copy of the models",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=4,
+        help=(
+            "Number of items synthesized concurrently in each process, which can "
+            + "then be batched if the voices have batching configured"
+        ),
+    )
+    parser.add_argument(
+        "--torch-threads",
+        type=int,
+        default=0,
+        help=(
+            "Number of PyTorch intra-op threads per process, 0 for the inference "
+            + "config of the SynthesisSet or the PyTorch default"
+        ),
+    )
+    parser.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        help="Synthesize all items, even those whose output already exists",
+    )
+    parser.add_argument(
+        "--log-level", choices=("DEBUG", "INFO", "WARNING", "ERROR"), default="INFO"
+    )
+    args = parser.parse_args()
+
+    sys.exit(main(args))